@@ -1,16 +1,67 @@
-from . import digest_generation, digest_pandas, mercator, permanence
-from .analysis import generate_digests_observation_window
-from .digest_pandas import digest_multi_user
-from .permanence import TimePeriod, get_permanence, permanence_multi_user
+"""Digests and permanence of mobile network events.
+
+The submodules and the functions exported here are imported on first use
+(see __getattr__), so that importing the package, e.g. to run the CLI,
+does not import pandas until it is needed.
+"""
+
+import importlib
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from . import (
+        digest_generation,
+        digest_pandas,
+        external_sort,
+        mercator,
+        permanence,
+        profiling,
+        scheduling,
+    )
+    from .analysis import generate_digests_observation_window
+    from .digest_generation import UnorderedEventsError
+    from .digest_pandas import digest_multi_user
+    from .permanence import get_permanence, permanence_multi_user
+    from .time_periods import TimePeriod
+
+_ATTRIBUTES = {
+    "digest_multi_user": "digest_pandas",
+    "generate_digests_observation_window": "analysis",
+    "get_permanence": "permanence",
+    "permanence_multi_user": "permanence",
+    "TimePeriod": "time_periods",
+    "UnorderedEventsError": "digest_generation",
+}
 
 __all__ = [
     "digest_generation",
     "digest_pandas",
     "digest_multi_user",
+    "external_sort",
     "generate_digests_observation_window",
     "get_permanence",
     "permanence_multi_user",
     "TimePeriod",
+    "UnorderedEventsError",
     "permanence",
     "mercator",
+    "profiling",
+    "scheduling",
 ]
+
+
+def __getattr__(name: str):
+    if name in _ATTRIBUTES:
+        module = importlib.import_module(f".{_ATTRIBUTES[name]}", __name__)
+        value = getattr(module, name)
+    elif name in __all__:
+        # importing a submodule also sets it as an attribute of the package
+        value = importlib.import_module(f".{name}", __name__)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
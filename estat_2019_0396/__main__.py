@@ -1,34 +1,39 @@
+import contextlib
 import datetime
 import enum
+import io
 import json
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional, Union
 
-import pandas as pd
 import typer
 
-from estat_2019_0396 import (
-    TimePeriod,
-    digest_multi_user,
-    generate_digests_observation_window,
-    permanence_multi_user,
-)
-from estat_2019_0396.mercator import distance_codes
+from estat_2019_0396 import profiling
+from estat_2019_0396.time_periods import TimePeriod
+
+# pandas and the engines are imported within the commands, so that the CLI
+# starts (e.g. for --help) without them
 
 
 class Compression(enum.Enum):
     ZIP = "zip"
     GZIP = "gzip"
     BZ2 = "bz2"
+    ZSTD = "zstd"
+    LZ4 = "lz4"
 
 
 class Format(enum.Enum):
     csv = "csv"
     parquet = "parquet"
+    jsonl = "jsonl"
 
 
 DEFAULT_FORMAT = Format.csv
 
+# click validates the default like a value from the command line
+format_option = typer.Option(DEFAULT_FORMAT.value)
+
 input_file = typer.Argument(
     ...,
     exists=True,
@@ -41,48 +46,359 @@ output_file = typer.Option(
 )
 
 
-def read_dataset(path, format):
+profile_option = typer.Option(
+    False,
+    help="Print the time spent in each stage, events/s and peak memory as JSON.",
+)
+
+cache_dir_option = typer.Option(
+    None,
+    envvar="ESTAT_CACHE_DIR",
+    help="Cache results in this directory, reused by runs with the same input and parameters.",
+)
+
+cache_size_option = typer.Option(
+    1024, help="Size of the result cache in MiB, evicting the least recently used."
+)
+
+cache_hash_option = typer.Option(
+    False, help="Identify the input by the hash of its contents, not its mtime."
+)
+
+sidecar_option = typer.Option(
+    False,
+    help="Keep the parsed CSV input in a Parquet sidecar, reused while the CSV is unchanged.",
+)
+
+sidecar_dir_option = typer.Option(
+    None,
+    envvar="ESTAT_SIDECAR_DIR",
+    help="Keep the sidecars in this directory instead of next to the CSV.",
+)
+
+optimize_dtypes_option = typer.Option(
+    False,
+    help="Load user, user_type and cell as categoricals and downcast integers, printing the memory saved to stderr.",
+)
+
+compression_level_option = typer.Option(
+    None, help="Compression level of the output, e.g. 1 to 22 for zstd."
+)
+
+compression_threads_option = typer.Option(
+    None,
+    help="Compress CSV and JSONL outputs in this many threads (default: all CPUs).",
+)
+
+validate_option = typer.Option(
+    False,
+    help="Drop the events without a time or cell and the duplicate (user, time, cell) events, printing the counts to stderr.",
+)
+
+geometry_file_option = typer.Option(
+    None,
+    envvar="ESTAT_GEOMETRY_FILE",
+    help="Load the tile geometry lookup table from this file, if it exists, and save it back after the run.",
+)
+
+chunksize_option = typer.Option(
+    None,
+    help="Read and sort the input out of core, this many rows at a time.",
+)
+
+
+def read_dataset(
+    path, format, sidecar=False, sidecar_dir=None, optimize=False, validate=False
+):
+    df = _read_dataset(path, format, sidecar, sidecar_dir)
+    if validate:
+        df = validate_dataset(df)
+    if optimize:
+        df = optimize_dataset(df)
+    return df
+
+
+def optimize_dataset(df):
+    """Shrink the dtypes of *df*, printing the memory saved to stderr."""
+    from estat_2019_0396.dtypes import optimize_dtypes_report
+
+    with profiling.stage("optimize_dtypes", len(df)):
+        df, report = optimize_dtypes_report(df)
+    typer.echo(json.dumps(report), err=True)
+    return df
+
+
+def validate_dataset(df):
+    """Drop the invalid events of *df*, printing their counts to stderr."""
+    from estat_2019_0396.validation import validate_events
+
+    with profiling.stage("validate_events", len(df)):
+        df, report = validate_events(df)
+    typer.echo(json.dumps(report), err=True)
+    return df
+
+
+def _read_dataset(path, format, sidecar, sidecar_dir):
+    import pandas as pd
+
+    from estat_2019_0396.cache import read_csv_cached
+
+    with profiling.stage("read_dataset"):
+        if format == Format.csv and (sidecar or sidecar_dir):
+            return read_csv_cached(path, directory=sidecar_dir, parse_dates=["time"])
+        elif format == Format.csv:
+            return pd.read_csv(path, parse_dates=["time"])
+        elif format == Format.parquet:
+            return pd.read_parquet(path)
+        elif format == Format.jsonl:
+            from estat_2019_0396.jsonl import read_jsonl
+
+            return read_jsonl(path)
+        else:
+            raise NotImplementedError(f"Unknown format: {format}")
+
+
+def read_dataset_chunks(path, format, chunksize):
+    import pandas as pd
+
     if format == Format.csv:
-        return pd.read_csv(path, parse_dates=["time"])
+        chunks = pd.read_csv(path, parse_dates=["time"], chunksize=chunksize)
     elif format == Format.parquet:
-        return pd.read_parquet(path)
+        import pyarrow.parquet as pq
+
+        batches = pq.ParquetFile(path).iter_batches(batch_size=chunksize)
+        chunks = (batch.to_pandas() for batch in batches)
+    elif format == Format.jsonl:
+        from estat_2019_0396.jsonl import read_jsonl
+
+        chunks = read_jsonl(path, chunksize=chunksize)
     else:
         raise NotImplementedError(f"Unknown format: {format}")
+    while True:
+        with profiling.stage("read_dataset"):
+            chunk = next(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
 
 
-def write_dataset(df, path, format, compression):
-    if format == Format.csv:
-        return df.to_csv(
-            path, compression=compression.value if compression else None, index=False
+def sorted_dataset_chunks(path, format, chunksize, optimize=False, validate=False):
+    """Yield the dataset sorted by user and time, in frames of complete users.
+
+    If *validate*, the invalid events of each frame are dropped (the
+    duplicates of an event are in the same frame), and if *optimize* the
+    dtypes of each frame are shrunk.
+    """
+    from estat_2019_0396.external_sort import external_sort
+
+    chunks = read_dataset_chunks(path, format, chunksize)
+    if validate:
+        chunks = drop_null_users(chunks)
+    frames = external_sort(chunks, batch_size=chunksize)
+    for df in frames:
+        if validate:
+            df = validate_dataset(df)
+        if optimize:
+            df = optimize_dataset(df)
+        yield df
+
+
+def drop_null_users(chunks):
+    """Drop the events without user, which the external sort drops silently.
+
+    Their counts are printed to stderr, like the other invalid events.
+    """
+    for chunk in chunks:
+        null = chunk["user"].isna()
+        if null.any():
+            chunk = chunk[~null]
+            report = {"null_users": int(null.sum()), "dropped": int(null.sum())}
+            typer.echo(json.dumps(report), err=True)
+        yield chunk
+
+
+def check_chunksize(chunksize, sidecar, sidecar_dir):
+    """Reject the sidecar options with *chunksize*: a sidecar is read whole."""
+    if chunksize and (sidecar or sidecar_dir):
+        raise typer.BadParameter(
+            "the sidecar holds the whole input, it cannot be read in chunks. "
+            "Drop --sidecar and --sidecar-dir.",
+            param_hint="--chunksize",
         )
+
+
+def concat_frames(frames):
+    import pandas as pd
+
+    frames = list(frames)
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+def write_dataset(df, path, format, compression, **options):
+    with profiling.stage("write_dataset", len(df)):
+        return _write_dataset(df, path, format, compression, **options)
+
+
+def _write_dataset(
+    df,
+    path,
+    format,
+    compression,
+    level=None,
+    threads=None,
+    column_compression=None,
+    column_encoding=None,
+):
+    if format == Format.csv:
+        if path is None or compression in (None, Compression.ZIP):
+            return df.to_csv(
+                path,
+                compression=compression.value if compression else None,
+                index=False,
+            )
+        with open_output(path, compression, level, threads) as f:
+            with io.TextIOWrapper(f, encoding="utf-8", newline="") as text:
+                df.to_csv(text, index=False)
     elif format == Format.parquet:
-        return df.to_parquet(
-            path, compression=compression.value if compression else None, index=False
-        )
+        from estat_2019_0396.compression import write_parquet
+
+        codec = compression.value if compression else None
+        if column_compression:
+            codec = {
+                col: column_compression.get(col, codec or "none") for col in df.columns
+            }
+        return write_parquet(df, path, codec, level, column_encoding)
+    elif format == Format.jsonl:
+        from estat_2019_0396.jsonl import dataframe_to_jsonl, write_dataframe_jsonl
+
+        if path is None:
+            return dataframe_to_jsonl(df)
+        with open_output(path, compression, level, threads) as f:
+            write_dataframe_jsonl(df, f)
     else:
         raise NotImplementedError(f"Unknown format: {format}")
 
 
+def open_output(path, compression, level=None, threads=None):
+    """Open *path* to write bytes, compressed with *compression*."""
+    from estat_2019_0396.compression import open_compressed
+
+    if compression is None:
+        return open(path, "wb")
+    elif compression == Compression.ZIP:
+        raise NotImplementedError(f"Unsupported compression: {compression}")
+    return open_compressed(path, compression.value, level, threads)
+
+
+def cached_result(
+    cache_dir, cache_size_mb, cache_hash, command, input_file, params, compute
+):
+    """Return compute() for *command*, or its result stored in *cache_dir*."""
+    if cache_dir is None:
+        return compute()
+    from estat_2019_0396.cache import ResultCache, cache_key, file_fingerprint
+    from estat_2019_0396.digest_generation import CUTOFF, LONG_DT, SHORT_DT
+
+    cache = ResultCache(cache_dir, max_bytes=cache_size_mb * 2**20)
+    params = {
+        "short_dt": SHORT_DT,
+        "long_dt": LONG_DT,
+        "cutoff": CUTOFF,
+        **params,
+    }
+    key = cache_key(command, file_fingerprint(input_file, content=cache_hash), params)
+    return cache.cached(key, compute)
+
+
+@contextlib.contextmanager
+def geometry_file_table(path: Optional[Path], zoom: int):
+    """Load the tile geometry table of *zoom* from *path*, saving it at the end."""
+    if path is None:
+        yield
+        return
+    from estat_2019_0396.mercator import geometry_table
+
+    geometry_table(zoom, path=path)
+    yield
+    geometry_table(zoom).save(path)
+
+
+@contextlib.contextmanager
+def profiled(enabled: bool):
+    """Profile the command and print the report as JSON, if *enabled*."""
+    if not enabled:
+        yield
+        return
+    with profiling.profile() as profiler:
+        yield
+    print(json.dumps(profiler.report()))
+
+
 def main(
     input_file: Path = input_file,
     output: Path = output_file,
     compression: Optional[Compression] = None,
-    input_format: Format = DEFAULT_FORMAT,
-    output_format: Format = DEFAULT_FORMAT,
+    compression_level: Optional[int] = compression_level_option,
+    compression_threads: Optional[int] = compression_threads_option,
+    input_format: Format = format_option,
+    output_format: Format = format_option,
+    profile: bool = profile_option,
+    workers: int = typer.Option(
+        1, help="Digest in this many processes, splitting heavy users."
+    ),
+    chunksize: Optional[int] = chunksize_option,
+    sidecar: bool = sidecar_option,
+    sidecar_dir: Optional[Path] = sidecar_dir_option,
+    optimize_dtypes: bool = optimize_dtypes_option,
+    validate: bool = validate_option,
 ):
-    df = read_dataset(input_file, input_format)
-    if "user_type" in df:
-        user_props = ["user_type"]
-    else:
-        user_props = []
-    print(
-        write_dataset(
-            digest_multi_user(df, user_props=user_props),
-            output,
-            output_format,
-            compression,
+    """Digest the events of every user."""
+    check_chunksize(chunksize, sidecar, sidecar_dir)
+
+    def digest(df):
+        from estat_2019_0396.digest_pandas import digest_multi_user
+        from estat_2019_0396.digest_parallel import digest_multi_user_parallel
+
+        if "user_type" in df:
+            user_props = ["user_type"]
+        else:
+            user_props = []
+        if workers > 1:
+            return digest_multi_user_parallel(
+                df, user_props=user_props, max_workers=workers
+            )
+        else:
+            return digest_multi_user(df, user_props=user_props)
+
+    with profiled(profile):
+        if chunksize:
+            digests = concat_frames(
+                digest(df)
+                for df in sorted_dataset_chunks(
+                    input_file, input_format, chunksize, optimize_dtypes, validate
+                )
+            )
+        else:
+            digests = digest(
+                read_dataset(
+                    input_file,
+                    input_format,
+                    sidecar,
+                    sidecar_dir,
+                    optimize_dtypes,
+                    validate,
+                )
+            )
+        print(
+            write_dataset(
+                digests,
+                output,
+                output_format,
+                compression,
+                level=compression_level,
+                threads=compression_threads,
+            )
         )
-    )
 
 
 def analysis(
@@ -92,54 +408,176 @@ def analysis(
     input_file: str = input_file,
     output: str = output_file,
     compression: Optional[Compression] = None,
-    input_format: Format = DEFAULT_FORMAT,
-    output_format: Format = DEFAULT_FORMAT,
+    compression_level: Optional[int] = compression_level_option,
+    compression_threads: Optional[int] = compression_threads_option,
+    input_format: Format = format_option,
+    output_format: Format = format_option,
     meta: bool = False,
+    window_period: List[TimePeriod] = typer.Option(
+        [],
+        help="Also digest each period of this kind within the observation window.",
+    ),
+    profile: bool = profile_option,
+    cache_dir: Optional[Path] = cache_dir_option,
+    cache_size_mb: int = cache_size_option,
+    cache_hash: bool = cache_hash_option,
+    sidecar: bool = sidecar_option,
+    sidecar_dir: Optional[Path] = sidecar_dir_option,
+    optimize_dtypes: bool = optimize_dtypes_option,
+    validate: bool = validate_option,
 ):
-    df = read_dataset(input_file, input_format)
-    digests, metadata = generate_digests_observation_window(
-        df, ow_start, ow_end, user_props=["user_type"]
-    )
-    print(
-        write_dataset(
-            digests,
-            output,
-            output_format,
-            compression,
+    """Digest the events of the observation window (and of its periods)."""
+
+    def compute():
+        from estat_2019_0396.analysis import (
+            generate_digests_observation_window,
+            generate_digests_observation_windows,
+            split_window,
         )
-    )
-    if meta:
-        print(json.dumps(metadata))
 
+        df = read_dataset(
+            input_file,
+            input_format,
+            sidecar,
+            sidecar_dir,
+            optimize_dtypes,
+            validate,
+        )
+        if window_period:
+            windows = [(ow_start, ow_end)] + [
+                window
+                for period in window_period
+                for window in split_window(ow_start, ow_end, period)
+            ]
+            return generate_digests_observation_windows(
+                df, windows, user_props=["user_type"]
+            )
+        else:
+            return generate_digests_observation_window(
+                df, ow_start, ow_end, user_props=["user_type"]
+            )
 
-def distance_func(c1, c2):
-    return pd.Series(distance_codes(c1, c2, z=15))
+    with profiled(profile):
+        metadata: Union[dict, list]
+        digests, metadata = cached_result(
+            cache_dir,
+            cache_size_mb,
+            cache_hash,
+            "analysis",
+            input_file,
+            {
+                "input_format": input_format,
+                "optimize_dtypes": optimize_dtypes,
+                "validate": validate,
+                "ow_start": ow_start,
+                "ow_end": ow_end,
+                "window_period": window_period,
+                "user_props": ["user_type"],
+            },
+            compute,
+        )
+        print(
+            write_dataset(
+                digests,
+                output,
+                output_format,
+                compression,
+                level=compression_level,
+                threads=compression_threads,
+            )
+        )
+        if meta:
+            print(json.dumps(metadata))
 
 
 def presence(
     input_file: str = input_file,
     output: str = output_file,
     compression: Optional[Compression] = None,
-    input_format: Format = DEFAULT_FORMAT,
-    output_format: Format = DEFAULT_FORMAT,
+    compression_level: Optional[int] = compression_level_option,
+    compression_threads: Optional[int] = compression_threads_option,
+    input_format: Format = format_option,
+    output_format: Format = format_option,
+    split_intervals: bool = False,
     # meta: bool = False,
+    profile: bool = profile_option,
+    chunksize: Optional[int] = chunksize_option,
+    cache_dir: Optional[Path] = cache_dir_option,
+    cache_size_mb: int = cache_size_option,
+    cache_hash: bool = cache_hash_option,
+    sidecar: bool = sidecar_option,
+    sidecar_dir: Optional[Path] = sidecar_dir_option,
+    optimize_dtypes: bool = optimize_dtypes_option,
+    validate: bool = validate_option,
+    geometry_file: Optional[Path] = geometry_file_option,
 ):
-    df = read_dataset(input_file, input_format)
-    permanence = permanence_multi_user(
-        df,
-        footprint_col="tile15",
-        user_props=["user_type"],
-        distance_func=distance_func,
-        time_grouping=TimePeriod.daily,
-    )
-    print(
-        write_dataset(
-            permanence,
-            output,
-            output_format,
-            compression,
+    """Compute the daily permanence of every user in each tile15."""
+    check_chunksize(chunksize, sidecar, sidecar_dir)
+
+    def compute_permanence(df):
+        from estat_2019_0396.permanence import permanence_multi_user
+
+        return permanence_multi_user(
+            df,
+            footprint_col="tile15",
+            user_props=["user_type"],
+            footprint_zoom=15,
+            time_grouping=TimePeriod.daily,
+            split_intervals=split_intervals,
+        )
+
+    def compute():
+        if chunksize:
+            return (
+                concat_frames(
+                    compute_permanence(df)
+                    for df in sorted_dataset_chunks(
+                        input_file, input_format, chunksize, optimize_dtypes, validate
+                    )
+                ),
+                None,
+            )
+        else:
+            df = read_dataset(
+                input_file,
+                input_format,
+                sidecar,
+                sidecar_dir,
+                optimize_dtypes,
+                validate,
+            )
+            return compute_permanence(df), None
+
+    with profiled(profile), geometry_file_table(geometry_file, 15):
+        permanence, _ = cached_result(
+            cache_dir,
+            cache_size_mb,
+            cache_hash,
+            "presence",
+            input_file,
+            {
+                "input_format": input_format,
+                "chunked": bool(chunksize),
+                "optimize_dtypes": optimize_dtypes,
+                "validate": validate,
+                "footprint_col": "tile15",
+                "footprint_zoom": 15,
+                "time_grouping": TimePeriod.daily,
+                "split_intervals": split_intervals,
+                "user_props": ["user_type"],
+            },
+            compute,
+        )
+        print(
+            write_dataset(
+                permanence,
+                output,
+                output_format,
+                compression,
+                level=compression_level,
+                threads=compression_threads,
+            )
         )
-    )
     # if meta:
     #     print(json.dumps(metadata))
 
@@ -179,8 +617,143 @@ def presence(
 #     )
 
 
+def load_job(path: Path) -> dict:
+    """Load the job spec at *path*, as YAML if its suffix is .yml or .yaml."""
+    with open(path) as f:
+        if path.suffix in (".yml", ".yaml"):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("PyYAML is required to read YAML job specs")
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def run_output(df, spec: dict, user_props: List[str], base: Path):
+    """Compute the output of *spec* from the events *df* (sorted by user and time)."""
+    from estat_2019_0396.analysis import (
+        generate_digests_observation_window,
+        generate_digests_observation_windows,
+        split_window,
+    )
+    from estat_2019_0396.digest_pandas import digest_multi_user
+    from estat_2019_0396.digest_parallel import digest_multi_user_parallel
+    from estat_2019_0396.permanence import permanence_multi_user
+
+    command = spec["command"]
+    metadata: Union[dict, list, None] = None
+    if command == "digests":
+        workers = spec.get("workers", 1)
+        if workers > 1:
+            result = digest_multi_user_parallel(
+                df, user_props=user_props, max_workers=workers, sort=False
+            )
+        else:
+            result = digest_multi_user(
+                df,
+                user_props=user_props,
+                engine=spec.get("engine", "python"),
+                sort=False,
+            )
+    elif command == "analysis":
+        ow_start = datetime.datetime.fromisoformat(str(spec["ow_start"]))
+        ow_end = datetime.datetime.fromisoformat(str(spec["ow_end"]))
+        window_period = [TimePeriod(period) for period in spec.get("window_period", [])]
+        if window_period:
+            windows = [(ow_start, ow_end)] + [
+                window
+                for period in window_period
+                for window in split_window(ow_start, ow_end, period)
+            ]
+            result, metadata = generate_digests_observation_windows(
+                df, windows, user_props=user_props, sort=False
+            )
+        else:
+            result, metadata = generate_digests_observation_window(
+                df, ow_start, ow_end, user_props=user_props, sort=False
+            )
+    elif command == "presence":
+        footprint_zoom = spec.get("footprint_zoom", 15)
+        geometry_file = (
+            base / spec["geometry_file"] if "geometry_file" in spec else None
+        )
+        with geometry_file_table(geometry_file, footprint_zoom):
+            result = permanence_multi_user(
+                df,
+                footprint_col=spec.get("footprint_col", "tile15"),
+                user_props=user_props,
+                footprint_zoom=footprint_zoom,
+                time_grouping=TimePeriod(spec.get("time_grouping", "D")),
+                split_intervals=spec.get("split_intervals", False),
+                sort=False,
+            )
+    else:
+        raise NotImplementedError(f"Unknown command: {command}")
+
+    compression = spec.get("compression")
+    write_dataset(
+        result,
+        base / spec["output"],
+        Format(spec.get("format", DEFAULT_FORMAT.value)),
+        Compression(compression) if compression else None,
+        level=spec.get("compression_level"),
+        threads=spec.get("compression_threads"),
+        column_compression=spec.get("column_compression"),
+        column_encoding=spec.get("column_encoding"),
+    )
+    if metadata is not None and "meta" in spec:
+        with open(base / spec["meta"], "w") as f:
+            json.dump(metadata, f)
+
+
+def run_all(
+    job_file: Path = typer.Argument(..., exists=True, readable=True),
+    profile: bool = profile_option,
+):
+    """Read and sort the input of the job spec once and write all its outputs.
+
+    The job spec is a JSON (or YAML) file like:
+
+        {"input": "events.csv", "input_format": "csv", "outputs": [
+            {"command": "digests", "output": "digests.csv"},
+            {"command": "analysis", "output": "ow.csv", "meta": "ow.json",
+             "ow_start": "2022-01-01", "ow_end": "2022-01-08",
+             "window_period": ["D"]},
+            {"command": "presence", "output": "presence.parquet",
+             "format": "parquet", "split_intervals": true}]}
+
+    Outputs also take compression_level and compression_threads, and
+    Parquet outputs a column_compression and column_encoding per column.
+    Presence outputs may keep the tile geometry in a geometry_file.
+    Paths are relative to the job spec. The input also takes the sidecar,
+    sidecar_dir, optimize_dtypes and validate options, and user_props defaults to
+    user_type if the input has it.
+    """
+    job = load_job(job_file)
+    base = job_file.parent
+    with profiled(profile):
+        df = read_dataset(
+            base / job["input"],
+            Format(job.get("input_format", DEFAULT_FORMAT.value)),
+            job.get("sidecar", False),
+            base / job["sidecar_dir"] if "sidecar_dir" in job else None,
+            job.get("optimize_dtypes", False),
+            job.get("validate", False),
+        )
+        with profiling.stage("sort_values", len(df)):
+            df = df.sort_values(by=["user", "time"])
+        user_props = job.get("user_props", ["user_type"] if "user_type" in df else [])
+        for spec in job["outputs"]:
+            run_output(df, spec, user_props, base)
+
+
+app = typer.Typer()
+app.command("digests")(main)
+app.command()(analysis)
+app.command()(presence)
+app.command("run-all")(run_all)
+
+
 if __name__ == "__main__":
-    # typer.run(main)
-    # typer.run(parametric_study)
-    # typer.run(analysis)
-    typer.run(presence)
+    # app.command()(parametric_study)
+    app()
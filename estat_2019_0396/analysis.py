@@ -1,9 +1,81 @@
 import datetime
-from typing import Dict, List, Tuple
+from typing import Any, Dict, List, Sequence, Tuple
 
+import numpy as np
 import pandas as pd
 
-from .digest_pandas import digest_multi_user_clip
+from . import profiling
+from .digest_generation import LONG_DT, digest_generation_iter
+from .digest_pandas import (
+    DIGEST_COLUMNS,
+    clip_bounds,
+    digest_multi_user_clip,
+    digest_to_dataframe,
+    group_segments,
+    segment_bounds,
+    segment_ranges,
+    segment_searchsorted,
+    time_values,
+)
+from .permanence import TimePeriod, period_edges
+
+Window = Tuple[datetime.datetime, datetime.datetime]
+
+
+class _UserTimeline:
+    """Times of the events sorted by user and time, split by user."""
+
+    def __init__(self, events: pd.DataFrame, time_col: str, user_col: str):
+        self.times = time_values(events[time_col])
+        self.starts, self.stops = segment_bounds(events[user_col])
+        self.is_user = events[user_col].notna().to_numpy()[self.starts]
+        self.first_time = events[time_col].min()
+        self.last_time = events[time_col].max()
+
+    def metadata(
+        self, ow_start: datetime.datetime, ow_end: datetime.datetime
+    ) -> Dict[str, Dict[str, int]]:
+        warmup_end = segment_searchsorted(
+            self.times, self.starts, self.stops, pd.Timestamp(ow_start).value, "left"
+        )
+        buffer_start = segment_searchsorted(
+            self.times, self.starts, self.stops, pd.Timestamp(ow_end).value, "right"
+        )
+        warmup = warmup_end - self.starts
+        buffer = self.stops - buffer_start
+        observation = self.stops - self.starts - warmup - buffer
+        return {
+            "warmup": {
+                "duration": (ow_start - self.first_time) / pd.Timedelta("1s"),
+                "events": int(warmup.sum()),
+                "users": int(np.count_nonzero(self.is_user & (warmup > 0))),
+            },
+            "buffer": {
+                "duration": (self.last_time - ow_end) / pd.Timedelta("1s"),
+                "events": int(buffer.sum()),
+                "users": int(np.count_nonzero(self.is_user & (buffer > 0))),
+            },
+            "observation": {
+                "duration": (ow_end - ow_start) / pd.Timedelta("1s"),
+                "events": int(observation.sum()),
+                "users": int(np.count_nonzero(self.is_user & (observation > 0))),
+            },
+        }
+
+
+def observation_window_metadata(
+    events: pd.DataFrame,
+    ow_start: datetime.datetime,
+    ow_end: datetime.datetime,
+    time_col: str = "time",
+    user_col: str = "user",
+) -> Dict[str, Dict[str, int]]:
+    """Return the duration, number of events and users of each part of the window.
+
+    The *events* must be sorted by user and time: the events of each user
+    before, during and after the window are counted with a binary search.
+    """
+    return _UserTimeline(events, time_col, user_col).metadata(ow_start, ow_end)
 
 
 def generate_digests_observation_window(
@@ -13,29 +85,22 @@ def generate_digests_observation_window(
     time_col: str = "time",
     user_col: str = "user",
     user_props: List[str] = [],
+    sort: bool = True,
     **kwargs,
 ) -> Tuple[pd.DataFrame, Dict[str, Dict[str, int]]]:
+    """Digest the events of the observation window [ow_start, ow_end].
 
-    # metadata about the events
-    warmup_mask = events[time_col] < ow_start
-    buffer_mask = events[time_col] > ow_end
-    meta = {
-        "warmup": {
-            "duration": (ow_start - events[time_col].min()) / pd.Timedelta("1s"),
-            "events": events[warmup_mask].shape[0],
-            "users": events.loc[warmup_mask, user_col].nunique(),
-        },
-        "buffer": {
-            "duration": (events[time_col].max() - ow_end) / pd.Timedelta("1s"),
-            "events": events[buffer_mask].shape[0],
-            "users": events.loc[buffer_mask, user_col].nunique(),
-        },
-        "observation": {
-            "duration": (ow_end - ow_start) / pd.Timedelta("1s"),
-            "events": events[~buffer_mask & ~warmup_mask].shape[0],
-            "users": events.loc[~buffer_mask & ~warmup_mask, user_col].nunique(),
-        },
-    }
+    Returns the digests that start in the window and its metadata (see
+    observation_window_metadata). Pass *sort=False* if *events* are already
+    sorted by user and time.
+    """
+    if sort:
+        with profiling.stage("sort_values", len(events)):
+            events = events.sort_values(by=[user_col, time_col])
+    with profiling.stage("metadata", len(events)):
+        meta = observation_window_metadata(
+            events, ow_start, ow_end, time_col=time_col, user_col=user_col
+        )
     digests = digest_multi_user_clip(
         events,
         user_props=user_props,
@@ -43,7 +108,96 @@ def generate_digests_observation_window(
         max_time=ow_end,
         time_col=time_col,
         user_col=user_col,
+        sort=False,
         **kwargs,
     )
 
     return digests, meta
+
+
+def split_window(
+    ow_start: datetime.datetime, ow_end: datetime.datetime, period: TimePeriod
+) -> List[Window]:
+    """Split [ow_start, ow_end] into the (clipped) windows of each *period*."""
+    edges = [pd.Timestamp(edge) for edge in period_edges(ow_start, ow_end, period)]
+    return [
+        (max(start, ow_start), min(end - pd.Timedelta(1, "ns"), ow_end))
+        for start, end in zip(edges[:-1], edges[1:])
+        if start <= ow_end and end > ow_start
+    ]
+
+
+def generate_digests_observation_windows(
+    events,
+    windows: Sequence[Window],
+    time_col: str = "time",
+    user_col: str = "user",
+    cell_col: str = "cell",
+    user_props: List[str] = [],
+    sort: bool = True,
+    **kwargs,
+) -> Tuple[pd.DataFrame, List[Dict[str, Any]]]:
+    """Digest the events once for several observation windows.
+
+    Each user's timeline is digested once, from the earliest to the latest
+    event that any of the *windows* needs (see digest_pandas.clip_bounds).
+    Every digest is then assigned to each window it starts in, which gives
+    the same digests as generate_digests_observation_window for each of
+    them. The result has a `window` column with the position of the window
+    in *windows*, and the metadata is a list with one entry per window.
+    Pass *sort=False* if *events* are already sorted by user and time.
+    """
+    by = [user_col] + user_props
+    if sort:
+        with profiling.stage("sort_values", len(events)):
+            events = events.sort_values(by=[user_col, time_col])
+    with profiling.stage("metadata", len(events)):
+        timeline = _UserTimeline(events, time_col, user_col)
+        meta = [
+            {
+                "window": {"start": str(ow_start), "end": str(ow_end)},
+                **timeline.metadata(ow_start, ow_end),
+            }
+            for ow_start, ow_end in windows
+        ]
+
+    with profiling.stage("clip", len(events)):
+        events, starts, stops = group_segments(events, by)
+        times = time_values(events[time_col])
+        renewal_dt = kwargs.get("long_dt", LONG_DT)
+        clip_start, clip_stop = stops.copy(), starts.copy()
+        for ow_start, ow_end in windows:
+            start, stop = clip_bounds(
+                times, starts, stops, ow_start, ow_end, renewal_dt
+            )
+            clip_start = np.where(
+                start < stop, np.minimum(clip_start, start), clip_start
+            )
+            clip_stop = np.where(start < stop, np.maximum(clip_stop, stop), clip_stop)
+        clip_stop = np.maximum(clip_stop, clip_start)
+        events = events.iloc[segment_ranges(clip_start, clip_stop)]
+
+    columns = ["window"] + by + ["digest_id"] + DIGEST_COLUMNS
+    with profiling.stage("digest", len(events)):
+        digests = events.groupby(by, group_keys=True, observed=True).apply(
+            lambda x: digest_to_dataframe(
+                digest_generation_iter(
+                    x.reset_index(drop=True)[time_col],
+                    x.reset_index(drop=True)[cell_col],
+                    **kwargs,
+                )
+            )
+        )
+    if digests.empty or not windows:
+        return pd.DataFrame(columns=columns), meta
+    digests = digests.reset_index(level=by).reset_index(drop=True)
+
+    windowed = []
+    for window, (ow_start, ow_end) in enumerate(windows):
+        in_window = digests[digests["start_time"].between(ow_start, ow_end)]
+        windowed.append(
+            in_window.assign(
+                window=window, digest_id=in_window.groupby(by, observed=True).cumcount()
+            )
+        )
+    return pd.concat(windowed, ignore_index=True)[columns], meta
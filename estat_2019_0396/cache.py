@@ -0,0 +1,284 @@
+"""On-disk caches of parsed inputs and command results.
+
+Results are stored as Parquet files named after a key that hashes the
+fingerprint of the input file, the command and its parameters, so a run
+with the same input and parameters reads the stored result instead of
+recomputing it:
+
+    cache = ResultCache(directory)
+    key = cache_key("presence", file_fingerprint(path), {"zoom": 15})
+    df, metadata = cache.cached(key, compute)
+
+The cache is bounded in size; the least recently used results are evicted,
+and so are the entries that cannot be read back (e.g. truncated files).
+
+CSV inputs can also be parsed once into a Parquet sidecar, see read_csv_cached.
+"""
+
+import hashlib
+import json
+import os
+import uuid
+import warnings
+from pathlib import Path
+from typing import Any, Callable, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from . import profiling
+
+METADATA_KEY = b"estat_2019_0396.metadata"
+COLUMNS_KEY = b"estat_2019_0396.columns"
+SOURCE_KEY = b"estat_2019_0396.source"
+
+
+def file_fingerprint(path, content: bool = False) -> dict:
+    """Return the size and modification time of the file at *path*.
+
+    With *content*, the SHA-256 of the contents is used instead of the
+    modification time, so that copies and touched files still match.
+    """
+    path = Path(path)
+    stat = path.stat()
+    if not content:
+        return {
+            "path": str(path.resolve()),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+        }
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            sha.update(block)
+    return {"size": stat.st_size, "sha256": sha.hexdigest()}
+
+
+def cache_key(command: str, fingerprint: dict, params: dict) -> str:
+    """Return the key of the result of *command* with *params* on an input.
+
+    The parameters must be JSON-serializable, or have a str representation
+    that identifies them (e.g. datetimes and enums).
+    """
+    payload = json.dumps(
+        {"command": command, "input": fingerprint, "params": params},
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def sidecar_path(path, directory=None) -> Path:
+    """Return the path of the Parquet sidecar of the CSV at *path*.
+
+    The sidecar is a hidden file next to the CSV or, with *directory*, a
+    file in *directory* named after the hash of the path of the CSV.
+    """
+    path = Path(path)
+    if directory is None:
+        return path.with_name(f".{path.name}.parquet")
+    name = hashlib.sha256(str(path.resolve()).encode()).hexdigest()
+    return Path(directory) / f"{name}.parquet"
+
+
+def read_csv_cached(path, directory=None, **kwargs) -> pd.DataFrame:
+    """Same as pd.read_csv(*path*, ***kwargs*), through a Parquet sidecar.
+
+    The parsed frame is written to the sidecar (see sidecar_path) the first
+    time, and read from it while the size and mtime of the CSV and the
+    *kwargs* do not change. Frames that Parquet cannot store are returned
+    without sidecar.
+    """
+    source = json.dumps(
+        {"input": file_fingerprint(path), "read_csv": kwargs},
+        sort_keys=True,
+        default=str,
+    ).encode()
+    sidecar = sidecar_path(path, directory)
+    try:
+        table = pq.read_table(sidecar)
+    except (FileNotFoundError, pa.ArrowException):
+        pass
+    else:
+        if (table.schema.metadata or {}).get(SOURCE_KEY) == source:
+            return table.to_pandas()
+
+    df = pd.read_csv(path, **kwargs)
+    try:
+        table = pa.Table.from_pandas(df)
+        table = table.replace_schema_metadata(
+            {**table.schema.metadata, SOURCE_KEY: source}
+        )
+        sidecar.parent.mkdir(parents=True, exist_ok=True)
+        tmp = sidecar.with_name(f".{sidecar.name}.{uuid.uuid4().hex}.tmp")
+        pq.write_table(table, tmp)
+        os.replace(tmp, sidecar)
+    except pa.ArrowException as e:
+        warnings.warn(f"Could not write the sidecar of {path}: {e}")
+    return df
+
+
+def _dict_arrays(df: pd.DataFrame) -> dict:
+    """Return Arrow maps of the columns of *df* whose values are all dicts.
+
+    Unlike the structs pyarrow infers, maps keep the keys of each dict (and
+    their type), e.g. for the events_in_cell of the digests.
+    """
+    arrays = {}
+    for col in df.columns[(df.dtypes == object).to_numpy()]:
+        values = df[col].tolist()
+        if values and all(isinstance(value, dict) for value in values):
+            offsets = np.cumsum([0] + [len(value) for value in values])
+            arrays[col] = pa.MapArray.from_arrays(
+                pa.array(offsets, type=pa.int32()),
+                pa.array([key for value in values for key in value]),
+                pa.array([item for value in values for item in value.values()]),
+            )
+    return arrays
+
+
+def _encode_label(value):
+    # JSON default for the column labels that JSON does not represent
+    if value is pd.NaT:
+        return {"timestamp": None}
+    elif isinstance(value, pd.Timestamp):
+        return {"timestamp": value.value, "tz": str(value.tz) if value.tz else None}
+    elif isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Cannot store a column label of type {type(value).__name__}")
+
+
+def _decode_label(obj: dict):
+    if "timestamp" not in obj:
+        return obj
+    elif obj["timestamp"] is None:
+        return pd.NaT
+    time = pd.Timestamp(obj["timestamp"])
+    return time.tz_localize("UTC").tz_convert(obj["tz"]) if obj["tz"] else time
+
+
+def columns_to_json(columns: pd.Index) -> bytes:
+    """Return the labels, names and dtype of *columns* as JSON."""
+    return json.dumps(
+        {
+            "labels": columns.tolist(),
+            "names": list(columns.names),
+            "dtype": None if columns.nlevels > 1 else str(columns.dtype),
+        },
+        default=_encode_label,
+    ).encode()
+
+
+def columns_from_json(data: bytes) -> pd.Index:
+    """Inverse of columns_to_json."""
+    columns = json.loads(data, object_hook=_decode_label)
+    if columns["dtype"] is None:
+        return pd.MultiIndex.from_tuples(
+            [tuple(label) for label in columns["labels"]], names=columns["names"]
+        )
+    return pd.Index(columns["labels"], dtype=columns["dtype"], name=columns["names"][0])
+
+
+class ResultCache:
+    def __init__(self, directory, max_bytes: int = 2**30):
+        """Cache of results in *directory*, with at most *max_bytes* in total."""
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path(self, key: str) -> Path:
+        return self.directory / f"{key}.parquet"
+
+    def get(self, key: str) -> Optional[Tuple[pd.DataFrame, Any]]:
+        """Return the result and metadata stored under *key*, if any.
+
+        Entries that cannot be read are removed, and reported as missing.
+        """
+        path = self.path(key)
+        try:
+            with profiling.stage("read_cache"):
+                table = pq.read_table(path)
+                result = self._decode(table)
+            # mark as recently used
+            os.utime(path)
+        except FileNotFoundError:  # not cached, or evicted concurrently
+            return None
+        except (pa.ArrowException, OSError, KeyError, ValueError) as e:
+            warnings.warn(f"Removing the unreadable cache entry {path}: {e}")
+            path.unlink(missing_ok=True)
+            return None
+        return result
+
+    @staticmethod
+    def _decode(table: pa.Table) -> Tuple[pd.DataFrame, Any]:
+        schema_metadata = table.schema.metadata or {}
+        df = table.to_pandas()
+        # maps are read as lists of (key, value) pairs
+        for field in table.schema:
+            if pa.types.is_map(field.type):
+                df[field.name] = [dict(items) for items in df[field.name]]
+        df.columns = columns_from_json(schema_metadata[COLUMNS_KEY])
+        metadata = schema_metadata.get(METADATA_KEY)
+        return df, json.loads(metadata) if metadata else None
+
+    def put(self, key: str, df: pd.DataFrame, metadata: Any = None) -> None:
+        """Store *df* and its JSON-serializable *metadata* under *key*."""
+        with profiling.stage("write_cache", len(df)):
+            # Parquet needs string column names, and the wide results (e.g. of
+            # permanence_multi_user) have a MultiIndex of tiles and times
+            columns = df.columns
+            df = df.set_axis([str(i) for i in range(len(columns))], axis=1)
+            arrays = _dict_arrays(df)
+            table = pa.Table.from_pandas(
+                df.assign(**{col: None for col in arrays}), preserve_index=False
+            )
+            for col, array in arrays.items():
+                table = table.set_column(table.column_names.index(col), col, array)
+            schema_metadata = {
+                **table.schema.metadata,
+                COLUMNS_KEY: columns_to_json(columns),
+            }
+            if metadata is not None:
+                schema_metadata[METADATA_KEY] = json.dumps(metadata).encode()
+            table = table.replace_schema_metadata(schema_metadata)
+            # write aside and rename, so that readers never see partial files
+            tmp = self.directory / f".{key}.{uuid.uuid4().hex}.tmp"
+            pq.write_table(table, tmp)
+            os.replace(tmp, self.path(key))
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove the least recently used results beyond max_bytes."""
+        entries = []
+        for path in self.directory.glob("*.parquet"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # removed concurrently
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+    def cached(
+        self, key: str, compute: Callable[[], Tuple[pd.DataFrame, Any]]
+    ) -> Tuple[pd.DataFrame, Any]:
+        """Return the result stored under *key*, or compute and store it.
+
+        Results that Parquet cannot store (e.g. dicts with keys of mixed
+        types, or columns labelled by other objects) are returned without
+        caching them.
+        """
+        result = self.get(key)
+        if result is None:
+            result = compute()
+            try:
+                self.put(key, *result)
+            except (pa.ArrowException, TypeError) as e:
+                warnings.warn(f"Could not cache the result: {e}")
+        return result
@@ -0,0 +1,164 @@
+"""Compression of the outputs.
+
+Text outputs (CSV and JSON Lines) are compressed in independent blocks, in
+a pool of threads, and the compressed blocks are written in order. The
+formats (gzip, bz2, zstd and lz4 frames) all allow concatenated streams,
+so the files are read as usual:
+
+    with CompressedWriter(open("digests.csv.zst", "wb"), "zstd") as f:
+        f.write(data)
+
+Parquet outputs are compressed per column by pyarrow (see write_parquet).
+"""
+
+import bz2
+import collections
+import functools
+import io
+import os
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import IO, Deque, Dict, Optional, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+BLOCK_SIZE = 4 * 2**20
+
+DELTA_BINARY_PACKED = "DELTA_BINARY_PACKED"
+
+
+def _gzip(block: bytes, level: int) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush()
+
+
+def _compressor(codec: str, level: Optional[int]):
+    # the pyarrow codecs, bz2 and zlib all release the GIL while compressing
+    if codec == "bz2":
+        # pyarrow only streams bz2
+        return functools.partial(bz2.compress, compresslevel=level or 9)
+    elif codec == "gzip":
+        # pyarrow fails on incompressible blocks
+        return functools.partial(
+            _gzip, level=zlib.Z_DEFAULT_COMPRESSION if level is None else level
+        )
+    return functools.partial(
+        pa.Codec(codec, compression_level=level).compress, asbytes=True
+    )
+
+
+class CompressedWriter(io.RawIOBase):
+    """Binary file compressing what is written to *raw* with *codec*.
+
+    The data is compressed in blocks of *block_size* bytes, in *threads*
+    threads (all CPUs by default), at most two blocks per thread being
+    pending at a time. flush() compresses and writes the partial block.
+    Closing the writer closes *raw*.
+    """
+
+    def __init__(
+        self,
+        raw: IO[bytes],
+        codec: str,
+        level: Optional[int] = None,
+        threads: Optional[int] = None,
+        block_size: int = BLOCK_SIZE,
+    ):
+        super().__init__()
+        self._raw = raw
+        self._compress = _compressor(codec, level)
+        threads = threads or os.cpu_count() or 1
+        self._executor = ThreadPoolExecutor(threads)
+        self._max_pending = 2 * threads
+        self._block_size = block_size
+        self._buffer = bytearray()
+        self._pending: Deque[Future] = collections.deque()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            self._submit(bytes(self._buffer[: self._block_size]))
+            del self._buffer[: self._block_size]
+        return memoryview(data).nbytes
+
+    def _submit(self, block: bytes):
+        self._pending.append(self._executor.submit(self._compress, block))
+        while len(self._pending) > self._max_pending:
+            self._raw.write(self._pending.popleft().result())
+
+    def flush(self):
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        while self._pending:
+            self._raw.write(self._pending.popleft().result())
+        self._raw.flush()
+
+    def close(self):
+        if not self.closed:
+            try:
+                super().close()  # flushes
+            finally:
+                self._executor.shutdown()
+                self._raw.close()
+
+
+def open_compressed(
+    path, codec: str, level: Optional[int] = None, threads: Optional[int] = None
+) -> CompressedWriter:
+    """Open *path* to write bytes, compressed with *codec*."""
+    return CompressedWriter(open(path, "wb"), codec, level=level, threads=threads)
+
+
+@functools.lru_cache(maxsize=None)
+def delta_encoding_supported() -> bool:
+    """Whether this pyarrow writes DELTA_BINARY_PACKED columns (10.0 does not)."""
+    try:
+        pq.write_table(
+            pa.table({"x": [0]}),
+            pa.BufferOutputStream(),
+            use_dictionary=False,
+            column_encoding={"x": DELTA_BINARY_PACKED},
+        )
+    except (OSError, pa.ArrowException):  # "Not yet implemented"
+        return False
+    return True
+
+
+def write_parquet(
+    df: pd.DataFrame,
+    path,
+    compression: Union[str, Dict[str, str], None] = None,
+    level: Optional[int] = None,
+    column_encoding: Optional[Dict[str, str]] = None,
+):
+    """Write *df* as Parquet to *path*, or return the Parquet if it is None.
+
+    *compression* is a codec (e.g. zstd or lz4) or a codec per column. The
+    time columns are delta encoded if pyarrow supports it, and the other
+    columns dictionary encoded, unless *column_encoding* sets an encoding
+    for them.
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    encoding = {
+        field.name: DELTA_BINARY_PACKED
+        for field in table.schema
+        if pa.types.is_timestamp(field.type) and delta_encoding_supported()
+    }
+    encoding.update(column_encoding or {})
+    sink = pa.BufferOutputStream() if path is None else path
+    pq.write_table(
+        table,
+        sink,
+        compression=compression,
+        compression_level=level,
+        use_dictionary=[name for name in table.column_names if name not in encoding],
+        column_encoding=encoding or None,
+    )
+    if path is None:
+        return sink.getvalue().to_pybytes()
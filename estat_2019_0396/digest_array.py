@@ -0,0 +1,530 @@
+"""Array-based digest generation.
+
+The state machine of digest_generation.Digestor is encoded as an integer
+transition table, and all the users are advanced in lockstep: step k
+processes the k-th event of every user with a few NumPy operations. The
+Digestor class remains the reference implementation.
+
+Every digest is closed after a gap of max(short_dt, long_dt), so users are
+split into independent segments at such gaps. The few segments much longer
+than the others, which would leave the lockstep loop running over a handful
+of rows, are digested one event at a time with the same transition table.
+"""
+
+from dataclasses import dataclass
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from .digest_generation import (
+    CUTOFF,
+    LONG_DT,
+    MAX_CELLS,
+    SHORT_DT,
+    Digest,
+    DigestType,
+    UnorderedEventsError,
+    check_times,
+)
+
+# States of a digest (the type of the digest being built).
+ONE_CELL, TWO_CELL, THREE_CELL, LONG_ONE_CELL = range(4)
+NO_DIGEST = -1
+# Transition that closes the current digest.
+CLOSE = -1
+
+STATE_TYPES = [
+    DigestType.ShortOneCell,
+    DigestType.ShortTwoCell,
+    DigestType.ShortThreeCell,
+    DigestType.LongOneCell,
+]
+
+
+def transition_table() -> np.ndarray:
+    """Return the table of the next state, indexed by [state, dt_class, new_cell].
+
+    *dt_class* is `2 * (dt < short_dt) + (dt < long_dt)` and *new_cell* is 1
+    if the cell of the event is not yet in the digest. Note that
+    DigestType.LongOneCell and DigestType.ShortOneCell share their value, so
+    they are the same enum member and the Digestor handles a LongOneCell
+    digest like a ShortOneCell one: both rows are identical.
+    """
+    table = np.full((4, 4, 2), CLOSE, dtype="int8")
+    for state in [ONE_CELL, LONG_ONE_CELL]:
+        table[state, 2:, 0] = state  # dt < short_dt, same cell
+        table[state, 2:, 1] = TWO_CELL  # dt < short_dt, new cell
+        table[state, 1, 0] = LONG_ONE_CELL  # short_dt <= dt < long_dt, same cell
+    table[TWO_CELL, 2:, 0] = TWO_CELL
+    table[TWO_CELL, 2:, 1] = THREE_CELL
+    table[THREE_CELL, 2:, 0] = THREE_CELL
+    return table
+
+
+TRANSITIONS = transition_table()
+
+# A step of the lockstep loop costs about as much as digesting this many
+# events one at a time (see _scalar_segments).
+STEP_COST_EVENTS = 20
+
+
+@dataclass
+class DigestArrays:
+    """Columnar digests. Times are int64 ns and cells int32 codes.
+
+    *segment* is the index of the segment (user) of each digest and *cells*
+    and *counts* hold the (up to three) cells of each digest in order of
+    appearance, with -1 for unused slots.
+    """
+
+    segment: np.ndarray
+    start_time: np.ndarray
+    start_cell: np.ndarray
+    end_time: np.ndarray
+    end_cell: np.ndarray
+    state: np.ndarray
+    num_events: np.ndarray
+    num_cells: np.ndarray
+    cells: np.ndarray
+    counts: np.ndarray
+
+    def __len__(self):
+        return self.segment.shape[0]
+
+    def take(self, rows) -> "DigestArrays":
+        return DigestArrays(
+            **{name: values[rows] for name, values in vars(self).items()}
+        )
+
+    @classmethod
+    def concatenate(cls, chunks: List["DigestArrays"]) -> "DigestArrays":
+        return cls(
+            **{
+                name: np.concatenate([vars(chunk)[name] for chunk in chunks])
+                for name in cls.__dataclass_fields__
+            }
+        )
+
+
+class _LockstepDigestor:
+    """State of the digests being built for every segment."""
+
+    def __init__(self, num_segments: int):
+        self.state = np.full(num_segments, NO_DIGEST, dtype="int8")
+        self.start_time = np.zeros(num_segments, dtype="int64")
+        self.start_cell = np.zeros(num_segments, dtype="int32")
+        self.last_time = np.zeros(num_segments, dtype="int64")
+        self.last_cell = np.zeros(num_segments, dtype="int32")
+        self.num_events = np.zeros(num_segments, dtype="int64")
+        self.num_cells = np.zeros(num_segments, dtype="int64")
+        self.cells = np.full((num_segments, MAX_CELLS), -1, dtype="int32")
+        self.counts = np.zeros((num_segments, MAX_CELLS), dtype="int64")
+        self.closed: List[DigestArrays] = []
+
+    def start(self, rows, time, cell):
+        """Start a new digest in *rows* with a single event."""
+        self.state[rows] = ONE_CELL
+        self.start_time[rows] = time
+        self.start_cell[rows] = cell
+        self.last_time[rows] = time
+        self.last_cell[rows] = cell
+        self.num_events[rows] = 1
+        self.num_cells[rows] = 1
+        self.cells[rows] = -1
+        self.cells[rows, 0] = cell
+        self.counts[rows] = 0
+        self.counts[rows, 0] = 1
+
+    def close(self, rows, segments):
+        """Store the digests of *rows* as closed digests of *segments*."""
+        self.closed.append(
+            DigestArrays(
+                segment=segments,
+                start_time=self.start_time[rows],
+                start_cell=self.start_cell[rows],
+                end_time=self.last_time[rows],
+                end_cell=self.last_cell[rows],
+                state=self.state[rows],
+                num_events=self.num_events[rows],
+                num_cells=self.num_cells[rows],
+                cells=self.cells[rows],
+                counts=self.counts[rows],
+            )
+        )
+
+    def process(self, rows, segments, time, cell, short_dt, long_dt, cutoff):
+        """Process one event (time, cell) for each of *rows*.
+
+        Vectorized Digestor.process_event: digests that cannot absorb the
+        event are closed and restarted. When the closed digest had more than
+        one event, the new one starts at the last event and the current one
+        is processed again, without closing digests a second time.
+        """
+        can_close = np.ones(rows.shape[0], dtype=bool)
+        while rows.shape[0]:
+            dt = time - self.last_time[rows]
+            slots = self.cells[rows] == cell[:, None]
+            is_new = ~slots.any(axis=1)
+            dt_class = 2 * (dt < short_dt) + (dt < long_dt)
+            next_state = TRANSITIONS[self.state[rows], dt_class, is_new.view("int8")]
+
+            # add the event to the digests that continue
+            cont = next_state != CLOSE
+            crows, cslots, cnew = rows[cont], slots[cont], is_new[cont]
+            new_rows = crows[cnew]
+            new_slots = self.num_cells[new_rows]
+            cslots[np.flatnonzero(cnew), new_slots] = True
+            self.cells[new_rows, new_slots] = cell[cont][cnew]
+            self.num_cells[new_rows] += 1
+            self.counts[crows] += cslots
+            self.num_events[crows] += 1
+            self.last_time[crows] = time[cont]
+            self.last_cell[crows] = cell[cont]
+            self.state[crows] = next_state[cont]
+            closing = ~cont
+            closing[cont] = (time[cont] - self.start_time[crows]) > cutoff
+
+            # close the others and start new digests
+            emit = closing & can_close
+            self.close(rows[emit], segments[emit])
+            restart = closing & (self.num_events[rows] > 1)
+            fresh = closing & ~restart
+            self.start(rows[fresh], time[fresh], cell[fresh])
+            rows, segments = rows[restart], segments[restart]
+            time, cell = time[restart], cell[restart]
+            self.start(rows, self.last_time[rows], self.last_cell[rows])
+            can_close = np.zeros(rows.shape[0], dtype=bool)
+
+    def closed_digests(self) -> DigestArrays:
+        if not self.closed:
+            self.close(np.empty(0, dtype="int64"), np.empty(0, dtype="int64"))
+        return DigestArrays.concatenate(self.closed)
+
+
+def check_ordered(times: np.ndarray, starts: np.ndarray) -> None:
+    """Raise if *times* decrease within a segment (segments begin at *starts*)."""
+    check_times(times)
+    unordered = np.flatnonzero(np.diff(times) < 0) + 1
+    unordered = unordered[~np.isin(unordered, starts)]
+    if unordered.size:
+        raise UnorderedEventsError(
+            f"events are not ordered in time. Event {unordered[0]} at "
+            f"{pd.Timestamp(times[unordered[0]])} follows one at "
+            f"{pd.Timestamp(times[unordered[0] - 1])}."
+        )
+
+
+def split_segments(
+    times: np.ndarray, starts: np.ndarray, stops: np.ndarray, gap: float
+):
+    """Split the segments [starts, stops) where *times* jump by *gap* or more.
+
+    Returns the starts and stops of the pieces and the segment of each, the
+    pieces of a segment being consecutive and in order.
+    """
+    # the last break (past every segment) keeps the indices below in bounds
+    breaks = np.append(np.flatnonzero(np.diff(times) >= gap) + 1, times.shape[0])
+    first = np.searchsorted(breaks, starts, side="right")
+    num_breaks = np.maximum(np.searchsorted(breaks, stops, side="left") - first, 0)
+    segments = np.repeat(np.arange(starts.shape[0]), num_breaks + 1)
+    offsets = np.cumsum(num_breaks + 1) - (num_breaks + 1)
+    piece = np.arange(segments.shape[0]) - offsets[segments]
+    piece_starts = np.where(
+        piece > 0, breaks[first[segments] + piece - 1], starts[segments]
+    )
+    piece_stops = np.where(
+        piece < num_breaks[segments], breaks[first[segments] + piece], stops[segments]
+    )
+    return piece_starts, piece_stops, segments
+
+
+def _scalar_segments(lengths: np.ndarray) -> np.ndarray:
+    """Return the segments to digest one at a time instead of in lockstep.
+
+    Taking the k longest segments out of the lockstep loop saves the steps
+    between the (k+1)-th and the longest length, at the cost of digesting
+    their events one at a time. The k with the lowest total cost is chosen.
+    """
+    order = np.argsort(-lengths, kind="stable")
+    sorted_lengths = np.append(lengths[order], 0)
+    cost = STEP_COST_EVENTS * sorted_lengths + np.cumsum(
+        np.concatenate([[0], sorted_lengths[:-1]])
+    )
+    return order[: np.argmin(cost)]
+
+
+def _digest_segment_scalar(
+    times: list, cells: list, segment: int, short_dt, long_dt, cutoff
+) -> list:
+    """Digest one segment, as _LockstepDigestor does for each of its rows.
+
+    Returns the closed digests as tuples of the fields of DigestArrays.
+    """
+    transitions = TRANSITIONS.tolist()
+    digests = []
+    for i, (time, cell) in enumerate(zip(times, cells)):
+        if i == 0:
+            state, start_time, start_cell, last_time, last_cell = (
+                ONE_CELL,
+                time,
+                cell,
+                time,
+                cell,
+            )
+            digest_cells, counts = [cell], [1]
+            continue
+        can_close = True
+        while True:
+            dt = time - last_time
+            is_new = cell not in digest_cells
+            dt_class = 2 * (dt < short_dt) + (dt < long_dt)
+            next_state = transitions[state][dt_class][is_new]
+            if next_state != CLOSE:
+                if is_new:
+                    digest_cells.append(cell)
+                    counts.append(1)
+                else:
+                    counts[digest_cells.index(cell)] += 1
+                last_time, last_cell, state = time, cell, next_state
+                if time - start_time <= cutoff:
+                    break
+            if can_close:
+                digests.append(
+                    (
+                        segment,
+                        start_time,
+                        start_cell,
+                        last_time,
+                        last_cell,
+                        state,
+                        sum(counts),
+                        digest_cells,
+                        counts,
+                    )
+                )
+            if sum(counts) > 1:
+                # start again at the last event and process this one again
+                state, start_time, start_cell = ONE_CELL, last_time, last_cell
+                digest_cells, counts = [last_cell], [1]
+                can_close = False
+                continue
+            state, start_time, start_cell, last_time, last_cell = (
+                ONE_CELL,
+                time,
+                cell,
+                time,
+                cell,
+            )
+            digest_cells, counts = [cell], [1]
+            break
+    if times:
+        digests.append(
+            (
+                segment,
+                start_time,
+                start_cell,
+                last_time,
+                last_cell,
+                state,
+                sum(counts),
+                digest_cells,
+                counts,
+            )
+        )
+    return digests
+
+
+def _scalar_digest_arrays(digests: list) -> DigestArrays:
+    cells = np.full((len(digests), MAX_CELLS), -1, dtype="int32")
+    counts = np.zeros((len(digests), MAX_CELLS), dtype="int64")
+    for row, digest in enumerate(digests):
+        cells[row, : len(digest[7])] = digest[7]
+        counts[row, : len(digest[8])] = digest[8]
+    columns = list(zip(*digests)) if digests else [()] * 7
+    return DigestArrays(
+        segment=np.array(columns[0], dtype="int64"),
+        start_time=np.array(columns[1], dtype="int64"),
+        start_cell=np.array(columns[2], dtype="int32"),
+        end_time=np.array(columns[3], dtype="int64"),
+        end_cell=np.array(columns[4], dtype="int32"),
+        state=np.array(columns[5], dtype="int8"),
+        num_events=np.array(columns[6], dtype="int64"),
+        num_cells=(counts > 0).sum(axis=1),
+        cells=cells,
+        counts=counts,
+    )
+
+
+def digest_arrays(
+    times: np.ndarray,
+    cells: np.ndarray,
+    starts: np.ndarray,
+    stops: np.ndarray,
+    short_dt=SHORT_DT,
+    long_dt=LONG_DT,
+    cutoff=CUTOFF,
+) -> DigestArrays:
+    """Digest each segment [starts, stops) of the events (times, cells).
+
+    *times* are int64 nanoseconds sorted within each segment and *cells*
+    non-negative int32 codes. Returns the digests ordered by segment and
+    start, as digest_generation.digest_generation_iter would per segment.
+    """
+    times = np.asarray(times, dtype="int64")
+    cells = np.asarray(cells, dtype="int32")
+    starts = np.asarray(starts, dtype="int64")
+    stops = np.asarray(stops, dtype="int64")
+    check_ordered(times, starts)
+    short_ns, long_ns, cutoff_ns = (x * 1e9 for x in (short_dt, long_dt, cutoff))
+
+    starts, stops, segments = split_segments(
+        times, starts, stops, max(short_ns, long_ns)
+    )
+    lengths = stops - starts
+    scalar = np.zeros(lengths.shape[0], dtype=bool)
+    scalar[_scalar_segments(lengths)] = True
+    lockstep = np.flatnonzero(~scalar)
+    scalar_digests = [
+        digest
+        for piece in np.flatnonzero(scalar).tolist()
+        for digest in _digest_segment_scalar(
+            times[starts[piece] : stops[piece]].tolist(),
+            cells[starts[piece] : stops[piece]].tolist(),
+            piece,
+            short_ns,
+            long_ns,
+            cutoff_ns,
+        )
+    ]
+    digests = DigestArrays.concatenate(
+        [
+            _digest_lockstep(
+                times,
+                cells,
+                starts[lockstep],
+                lengths[lockstep],
+                lockstep,
+                short_ns,
+                long_ns,
+                cutoff_ns,
+            ),
+            _scalar_digest_arrays(scalar_digests),
+        ]
+    )
+    # the digests of each piece are in order, and the pieces of a segment too
+    digests = digests.take(np.argsort(digests.segment, kind="stable"))
+    digests.segment = segments[digests.segment]
+    return digests
+
+
+def _digest_lockstep(
+    times, cells, starts, lengths, pieces, short_ns, long_ns, cutoff_ns
+) -> DigestArrays:
+    # sort the pieces by decreasing length, so the active ones are a prefix
+    order = np.argsort(-lengths, kind="stable")
+    starts, lengths, order = starts[order], lengths[order], pieces[order]
+    num_active = np.searchsorted(
+        -lengths, -np.arange(lengths.max(initial=0)), side="left"
+    )
+    digestor = _LockstepDigestor(order.shape[0])
+    for step, active in enumerate(num_active):
+        events = starts[:active] + step
+        rows = np.arange(active)
+        if step == 0:
+            digestor.start(rows, times[events], cells[events])
+        else:
+            digestor.process(
+                rows,
+                order[:active],
+                times[events],
+                cells[events],
+                short_ns,
+                long_ns,
+                cutoff_ns,
+            )
+    rows = np.flatnonzero(digestor.state != NO_DIGEST)
+    digestor.close(rows, order[rows])
+    return digestor.closed_digests()
+
+
+def digest_arrays_to_dataframe(
+    digests: DigestArrays, cell_values: np.ndarray, tz=None
+) -> pd.DataFrame:
+    """Return the digests as digest_pandas.digest_to_dataframe would.
+
+    *cell_values* maps the cell codes back to the cells, and the times are
+    converted to timestamps (in *tz*, if given).
+    """
+
+    def to_datetime(values):
+        times = pd.to_datetime(values)
+        return times.tz_localize("UTC").tz_convert(tz) if tz is not None else times
+
+    cells = cell_values[np.maximum(digests.cells, 0)]
+    events_in_cell = [
+        {cell: int(count) for cell, count in zip(row_cells[:n], row_counts[:n])}
+        for row_cells, row_counts, n in zip(
+            cells, digests.counts, digests.num_cells.tolist()
+        )
+    ]
+    types = np.array([digest_type.value for digest_type in STATE_TYPES])
+    return pd.DataFrame(
+        {
+            "start_time": to_datetime(digests.start_time),
+            "start_cell": cell_values[digests.start_cell],
+            "events_in_cell": events_in_cell,
+            "num_events": digests.num_events,
+            "num_cells": digests.num_cells,
+            "type": pd.array(types[digests.state], dtype="string"),
+            "end_time": to_datetime(digests.end_time),
+            "end_cell": cell_values[digests.end_cell],
+        }
+    )
+
+
+def digest_arrays_to_digests(
+    digests: DigestArrays, cell_values: np.ndarray, tz=None
+) -> List[Digest]:
+    """Return the digests as Digest objects, with timestamps (in *tz*, if given)."""
+
+    def to_timestamps(values):
+        times = pd.to_datetime(values)
+        return times.tz_localize("UTC").tz_convert(tz) if tz is not None else times
+
+    return [
+        Digest(
+            start_time=start_time,
+            start_cell=cell_values[start_cell],
+            events_in_cell={
+                cell_values[cell]: count
+                for cell, count in zip(cells[:num_cells], counts[:num_cells])
+            },
+            num_events=num_events,
+            num_cells=num_cells,
+            type=STATE_TYPES[state],
+            end_time=end_time,
+            end_cell=cell_values[end_cell],
+        )
+        for (
+            start_time,
+            start_cell,
+            end_time,
+            end_cell,
+            state,
+            num_events,
+            num_cells,
+            cells,
+            counts,
+        ) in zip(
+            to_timestamps(digests.start_time),
+            digests.start_cell.tolist(),
+            to_timestamps(digests.end_time),
+            digests.end_cell.tolist(),
+            digests.state.tolist(),
+            digests.num_events.tolist(),
+            digests.num_cells.tolist(),
+            digests.cells.tolist(),
+            digests.counts.tolist(),
+        )
+    ]
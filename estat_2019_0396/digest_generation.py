@@ -3,7 +3,11 @@ import datetime
 import json
 from dataclasses import dataclass
 from enum import Enum
-from typing import List, Optional
+from typing import Iterator, List, Optional, Sized
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_datetime64_any_dtype
 
 
 class DigestType(Enum):
@@ -18,6 +22,31 @@ SHORT_DT = 15
 LONG_DT = 8 * 60 * 60  # 8 hours
 CUTOFF = 24 * 60 * 60  # 1 day
 
+# Maximum number of cells of a digest (see DigestType).
+MAX_CELLS = 3
+
+
+class UnorderedEventsError(Exception):
+    """The events (of a user) are not ordered in time."""
+
+
+# pd.NaT as int64 nanoseconds
+NAT = np.iinfo("int64").min
+
+
+def check_times(times: np.ndarray) -> None:
+    """Raise ValueError if some of *times* (int64 nanoseconds) are missing.
+
+    A missing time would otherwise be reported as an unordered event.
+    """
+    missing = np.flatnonzero(times == NAT)
+    if missing.size:
+        raise ValueError(
+            f"{missing.size} events have no time (NaT), the first being event "
+            f"{missing[0]}. Drop them before digesting, e.g. with "
+            "validation.validate_events(drop=True)."
+        )
+
 
 @dataclass
 class Digest:
@@ -54,7 +83,8 @@ class DigestEncoder(json.JSONEncoder):
         elif isinstance(obj, DigestType):
             return obj.value
         elif isinstance(obj, Digest):
-            dataclasses.asdict(obj)
+            return dataclasses.asdict(obj)
+        return super().default(obj)
 
 
 def create_digest(time, cell):
@@ -111,7 +141,11 @@ class Digestor:
         self.last_cell = cell
         self.current_digest.add_event(cell)
 
-    def process_event(self, time, cell, last_time=None) -> Optional[Digest]:
+    def elapsed(self, time, since) -> float:
+        """Return the seconds between *since* and *time*."""
+        return (time - since).total_seconds()
+
+    def process_event(self, time, cell, last_time=None, dt=None) -> Optional[Digest]:
         """Advance the state by processing the current event.
 
         This function encodes the logic of digest generation by
@@ -123,7 +157,8 @@ class Digestor:
         The transition between states depends on the amount of time
         between the last and current event (`dt`) and wether the
         current event's cell is in the set of cells in the digest
-        (`dc=0`) or not (`dc=1`).
+        (`dc=0`) or not (`dc=1`). Pass *dt* (in seconds) if it is already
+        known.
 
         Graph representation of state transitions:
 
@@ -138,24 +173,27 @@ class Digestor:
         ```
         """
         if self.current_digest:
-            dt = (time - (last_time or self.last_time)).total_seconds()
+            if dt is None:
+                dt = self.elapsed(time, last_time or self.last_time)
             if dt < 0:
-                raise Exception(
+                raise UnorderedEventsError(
                     f"events are not ordered in time. Last event was at {self.last_time} and the current one at {time}."
                 )
+            # membership does not change until the event is added
+            known_cell = cell in self.current_digest.events_in_cell
             if self.current_digest.type == DigestType.ShortOneCell:
-                if dt < self.short_dt and cell in self.current_digest.cells:
+                if dt < self.short_dt and known_cell:
                     self.continue_digest(time, cell)
                 elif dt < self.short_dt:
                     self.continue_digest(time, cell)
                     self.current_digest.type = DigestType.ShortTwoCell
-                elif dt < self.long_dt and cell in self.current_digest.cells:
+                elif dt < self.long_dt and known_cell:
                     self.continue_digest(time, cell)
                     self.current_digest.type = DigestType.LongOneCell
                 else:
                     return self.close_and_start(time, cell)
             elif self.current_digest.type == DigestType.ShortTwoCell:
-                if dt < self.short_dt and cell in self.current_digest.cells:
+                if dt < self.short_dt and known_cell:
                     self.continue_digest(time, cell)
                 elif dt < self.short_dt:
                     self.continue_digest(time, cell)
@@ -163,12 +201,12 @@ class Digestor:
                 else:
                     return self.close_and_start(time, cell)
             elif self.current_digest.type == DigestType.ShortThreeCell:
-                if dt < self.short_dt and cell in self.current_digest.cells:
+                if dt < self.short_dt and known_cell:
                     self.continue_digest(time, cell)
                 else:
                     return self.close_and_start(time, cell)
             elif self.current_digest.type == DigestType.LongOneCell:
-                if dt < self.long_dt and cell in self.current_digest.cells:
+                if dt < self.long_dt and known_cell:
                     self.continue_digest(time, cell)
                 else:
                     return self.close_and_start(time, cell)
@@ -178,9 +216,8 @@ class Digestor:
                 )
 
             if (
-                self.current_digest.start_time
-                and (time - self.current_digest.start_time).total_seconds()
-                > self.cutoff
+                self.current_digest.start_time is not None
+                and self.elapsed(time, self.current_digest.start_time) > self.cutoff
             ):
                 return self.close_and_start(time, cell)
         else:
@@ -195,62 +232,177 @@ class Digestor:
 
         Returns the list of _closed_ digests.
         """
-        digests = [
-            self.process_event(event["time"], event["cell"]) for event in ordered_events
-        ]
-        return [digest for digest in digests if digest]
+        return list(self.iter_events_dict(ordered_events))
 
     def _process_events_iter(self, ordered_times, ordered_cells) -> List[Digest]:
         """Process a sequence of ordered events.
 
         Returns the list of _closed_ digests.
         """
-        if len(ordered_times) != len(ordered_cells):
+        return list(self.iter_events(ordered_times, ordered_cells))
+
+    def iter_events_dict(self, ordered_events) -> Iterator[Digest]:
+        """Process a sequence of ordered events, yielding the _closed_ digests."""
+        for event in ordered_events:
+            digest = self.process_event(event["time"], event["cell"])
+            if digest:
+                yield digest
+
+    def iter_events(self, ordered_times, ordered_cells) -> Iterator[Digest]:
+        """Process a sequence of ordered events, yielding the _closed_ digests.
+
+        *ordered_times* and *ordered_cells* may be any iterables (e.g.
+        generators), and are only checked to have the same length if sized.
+        """
+        if (
+            isinstance(ordered_times, Sized)
+            and isinstance(ordered_cells, Sized)
+            and len(ordered_times) != len(ordered_cells)
+        ):
             raise Exception(
                 f"Unequal number of entries: {len(ordered_times)} times but {len(ordered_cells)} cells"
             )
-        digests = [
-            self.process_event(
-                ordered_times[i],
-                ordered_cells[i],
-                last_time=(
-                    ordered_times[i - 1]
-                    if i > 0
-                    else datetime.datetime(1900, 1, 1, 0, 0, 0)
-                ),
+        for time, cell in zip(ordered_times, ordered_cells):
+            digest = self.process_event(time, cell)
+            if digest:
+                yield digest
+
+
+class EpochDigestor(Digestor):
+    def __init__(self, short_dt=SHORT_DT, long_dt=LONG_DT, cutoff=CUTOFF):
+        """Digestor over int64 epoch nanoseconds instead of datetimes."""
+        super().__init__(short_dt=short_dt, long_dt=long_dt, cutoff=cutoff, t0=0)
+
+    def elapsed(self, time, since) -> float:
+        return (time - since) / 1e9
+
+    def iter_events(self, ordered_times, ordered_cells) -> Iterator[Digest]:
+        """Process a sequence of ordered events, yielding the _closed_ digests.
+
+        *ordered_times* are int64 nanoseconds: the time differences between
+        events are computed once, in a single array operation.
+        """
+        times = np.asarray(ordered_times, dtype="int64")
+        if times.shape[0] != len(ordered_cells):
+            raise Exception(
+                f"Unequal number of entries: {times.shape[0]} times but {len(ordered_cells)} cells"
+            )
+        check_times(times)
+        dts = np.diff(times, prepend=times[:1]) / 1e9
+        unordered = np.flatnonzero(dts < 0)
+        if unordered.size:
+            raise UnorderedEventsError(
+                f"events are not ordered in time. Last event was at {pd.Timestamp(times[unordered[0] - 1])} and the current one at {pd.Timestamp(times[unordered[0]])}."
             )
-            for i in range(len(ordered_times))
-        ]
-        return [digest for digest in digests if digest]
+        for time, dt, cell in zip(times.tolist(), dts.tolist(), ordered_cells):
+            digest = self.process_event(time, cell, dt=dt)
+            if digest:
+                yield digest
+
+
+def _iter_digests_epoch(
+    ordered_times, ordered_cells, short_dt, long_dt, cutoff
+) -> Iterator[Digest]:
+    """Same as iter_digests for datetime64 times, digested as int64 nanoseconds."""
+    times = pd.DatetimeIndex(ordered_times)
+    digestor = EpochDigestor(short_dt=short_dt, long_dt=long_dt, cutoff=cutoff)
+
+    def with_timestamps(digest):
+        digest.start_time = pd.Timestamp(digest.start_time, tz=times.tz)
+        digest.end_time = pd.Timestamp(digest.end_time, tz=times.tz)
+        return digest
+
+    for digest in digestor.iter_events(times.asi8, ordered_cells):
+        yield with_timestamps(digest)
+    last_digest = digestor.close_digest()
+    if last_digest:
+        yield with_timestamps(last_digest)
 
 
-def digest_generation_dict(
+def iter_digests_dict(
     ordered_events,
     short_dt=SHORT_DT,
     long_dt=LONG_DT,
     cutoff=CUTOFF,
-):
+) -> Iterator[Digest]:
+    """Yield the digests of the ordered events as soon as they are closed."""
     digestor = Digestor(short_dt=short_dt, long_dt=long_dt, cutoff=cutoff)
-    digests = digestor._process_events_dict(ordered_events)
+    yield from digestor.iter_events_dict(ordered_events)
     last_digest = digestor.close_digest()
     if last_digest:
-        digests.append(last_digest)
-    return digests
+        yield last_digest
 
 
-def digest_generation_iter(
+def iter_digests(
     ordered_times,
     ordered_cells,
     short_dt=SHORT_DT,
     long_dt=LONG_DT,
     cutoff=CUTOFF,
-):
+) -> Iterator[Digest]:
+    """Yield the digests of the ordered events as soon as they are closed.
+
+    Only the digest being built is kept in memory, so long histories can be
+    streamed (e.g. from a file) into a writer. Datetime64 arrays (e.g. a
+    pandas Series) are digested as int64 nanoseconds, which is faster than
+    subtracting timestamps.
+    """
+    if is_datetime64_any_dtype(getattr(ordered_times, "dtype", None)):
+        yield from _iter_digests_epoch(
+            ordered_times, ordered_cells, short_dt, long_dt, cutoff
+        )
+        return
     digestor = Digestor(short_dt=short_dt, long_dt=long_dt, cutoff=cutoff)
-    digests = digestor._process_events_iter(ordered_times, ordered_cells)
+    yield from digestor.iter_events(ordered_times, ordered_cells)
     last_digest = digestor.close_digest()
     if last_digest:
-        digests.append(last_digest)
-    return digests
+        yield last_digest
+
+
+def digest_generation_dict(
+    ordered_events,
+    short_dt=SHORT_DT,
+    long_dt=LONG_DT,
+    cutoff=CUTOFF,
+):
+    return list(
+        iter_digests_dict(
+            ordered_events, short_dt=short_dt, long_dt=long_dt, cutoff=cutoff
+        )
+    )
+
+
+def digest_generation_iter(
+    ordered_times,
+    ordered_cells,
+    short_dt=SHORT_DT,
+    long_dt=LONG_DT,
+    cutoff=CUTOFF,
+    engine="python",
+):
+    """Return the digests of the ordered events.
+
+    With *engine="numba"* the events are digested by the compiled kernel of
+    digest_numba, if numba is installed (and by the Digestor otherwise).
+    """
+    if engine == "numba":
+        from .digest_numba import digest_events_compiled, digest_kernel
+
+        if digest_kernel is not None:
+            return digest_events_compiled(
+                ordered_times, ordered_cells, short_dt, long_dt, cutoff
+            )
+    elif engine != "python":
+        raise NotImplementedError(f"unexpected engine: {engine}")
+    return list(
+        iter_digests(
+            ordered_times,
+            ordered_cells,
+            short_dt=short_dt,
+            long_dt=long_dt,
+            cutoff=cutoff,
+        )
+    )
 
 
 digest_generation = digest_generation_dict
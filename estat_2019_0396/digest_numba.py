@@ -0,0 +1,208 @@
+"""Compiled digest generation.
+
+A sequential version of the Digestor state machine over int64 times and
+int32 cell codes, written in the subset of Python that numba compiles. It
+is compiled when numba is installed; otherwise the "numba" engine falls
+back to the Digestor.
+"""
+
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from .digest_array import (
+    CLOSE,
+    MAX_CELLS,
+    ONE_CELL,
+    TRANSITIONS,
+    DigestArrays,
+    check_ordered,
+    digest_arrays_to_digests,
+)
+from .digest_generation import CUTOFF, LONG_DT, SHORT_DT, Digest
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _digest_kernel(
+    times,
+    cells,
+    starts,
+    stops,
+    short_dt,
+    long_dt,
+    cutoff,
+    transitions,
+    out_segment,
+    out_start_time,
+    out_start_cell,
+    out_end_time,
+    out_end_cell,
+    out_state,
+    out_num_events,
+    out_num_cells,
+    out_cells,
+    out_counts,
+):
+    """Digest each segment [starts, stops) into the out_* arrays.
+
+    Returns the number of digests.
+    """
+    slot_cells = np.empty(MAX_CELLS, dtype=np.int32)
+    slot_counts = np.empty(MAX_CELLS, dtype=np.int64)
+    k = 0
+    for segment in range(starts.shape[0]):
+        if starts[segment] >= stops[segment]:
+            continue
+        start_time = last_time = times[starts[segment]]
+        start_cell = last_cell = cells[starts[segment]]
+        state, num_events, num_cells = ONE_CELL, 1, 1
+        slot_cells[:] = -1
+        slot_counts[:] = 0
+        slot_cells[0], slot_counts[0] = start_cell, 1
+        for i in range(starts[segment] + 1, stops[segment]):
+            time, cell = times[i], cells[i]
+            can_close = True
+            while True:
+                dt = time - last_time
+                slot = -1
+                for j in range(num_cells):
+                    if slot_cells[j] == cell:
+                        slot = j
+                dt_class = 2 * (dt < short_dt) + (dt < long_dt)
+                next_state = transitions[state, dt_class, int(slot < 0)]
+                if next_state != CLOSE:
+                    if slot < 0:
+                        slot = num_cells
+                        slot_cells[slot] = cell
+                        num_cells += 1
+                    slot_counts[slot] += 1
+                    num_events += 1
+                    last_time, last_cell, state = time, cell, next_state
+                    if time - start_time <= cutoff:
+                        break
+
+                # close the digest and start a new one
+                if can_close:
+                    out_segment[k] = segment
+                    out_start_time[k] = start_time
+                    out_start_cell[k] = start_cell
+                    out_end_time[k] = last_time
+                    out_end_cell[k] = last_cell
+                    out_state[k] = state
+                    out_num_events[k] = num_events
+                    out_num_cells[k] = num_cells
+                    out_cells[k] = slot_cells
+                    out_counts[k] = slot_counts
+                    k += 1
+                restart = num_events > 1
+                if not restart:
+                    last_time, last_cell = time, cell
+                start_time, start_cell = last_time, last_cell
+                state, num_events, num_cells = ONE_CELL, 1, 1
+                slot_cells[:] = -1
+                slot_counts[:] = 0
+                slot_cells[0], slot_counts[0] = start_cell, 1
+                if not restart:
+                    break
+                can_close = False
+
+        out_segment[k] = segment
+        out_start_time[k] = start_time
+        out_start_cell[k] = start_cell
+        out_end_time[k] = last_time
+        out_end_cell[k] = last_cell
+        out_state[k] = state
+        out_num_events[k] = num_events
+        out_num_cells[k] = num_cells
+        out_cells[k] = slot_cells
+        out_counts[k] = slot_counts
+        k += 1
+    return k
+
+
+digest_kernel = numba.njit(nogil=True, cache=True)(_digest_kernel) if numba else None
+
+
+def digest_arrays_compiled(
+    times: np.ndarray,
+    cells: np.ndarray,
+    starts: np.ndarray,
+    stops: np.ndarray,
+    short_dt=SHORT_DT,
+    long_dt=LONG_DT,
+    cutoff=CUTOFF,
+    kernel=None,
+) -> DigestArrays:
+    """Same as digest_array.digest_arrays, with *kernel* (compiled by default).
+
+    Pass `kernel=_digest_kernel` to run the kernel without numba.
+    """
+    kernel = kernel or digest_kernel
+    if kernel is None:
+        raise ImportError("numba is required to compile the digest kernel")
+    times = np.asarray(times, dtype="int64")
+    cells = np.asarray(cells, dtype="int32")
+    starts = np.asarray(starts, dtype="int64")
+    stops = np.asarray(stops, dtype="int64")
+    check_ordered(times, starts)
+    # every event closes at most one digest, and the first one of a segment none
+    capacity = times.shape[0]
+    digests = DigestArrays(
+        segment=np.empty(capacity, dtype="int64"),
+        start_time=np.empty(capacity, dtype="int64"),
+        start_cell=np.empty(capacity, dtype="int32"),
+        end_time=np.empty(capacity, dtype="int64"),
+        end_cell=np.empty(capacity, dtype="int32"),
+        state=np.empty(capacity, dtype="int8"),
+        num_events=np.empty(capacity, dtype="int64"),
+        num_cells=np.empty(capacity, dtype="int64"),
+        cells=np.empty((capacity, MAX_CELLS), dtype="int32"),
+        counts=np.empty((capacity, MAX_CELLS), dtype="int64"),
+    )
+    num_digests = kernel(
+        times,
+        cells,
+        starts,
+        stops,
+        short_dt * 1e9,
+        long_dt * 1e9,
+        cutoff * 1e9,
+        TRANSITIONS,
+        *vars(digests).values(),
+    )
+    return digests.take(slice(0, num_digests))
+
+
+def digest_events_compiled(
+    ordered_times,
+    ordered_cells,
+    short_dt=SHORT_DT,
+    long_dt=LONG_DT,
+    cutoff=CUTOFF,
+    kernel=None,
+) -> List[Digest]:
+    """Same as digest_generation.digest_generation_iter, with the compiled kernel."""
+    if len(ordered_times) != len(ordered_cells):
+        raise Exception(
+            f"Unequal number of entries: {len(ordered_times)} times but {len(ordered_cells)} cells"
+        )
+    times = pd.DatetimeIndex(ordered_times)
+    codes, cell_values = pd.factorize(
+        pd.Series(ordered_cells, dtype=object), use_na_sentinel=False
+    )
+    digests = digest_arrays_compiled(
+        times.asi8,
+        codes,
+        np.array([0]),
+        np.array([len(times)]),
+        short_dt=short_dt,
+        long_dt=long_dt,
+        cutoff=cutoff,
+        kernel=kernel,
+    )
+    return digest_arrays_to_digests(digests, np.asarray(cell_values), tz=times.tz)
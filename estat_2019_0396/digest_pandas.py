@@ -3,9 +3,13 @@ import datetime
 from enum import Enum
 from typing import Dict, List
 
+import numpy as np
 import pandas as pd
 
+from . import profiling
+from .digest_array import digest_arrays, digest_arrays_to_dataframe
 from .digest_generation import LONG_DT, Digest, digest_generation_iter
+from .digest_numba import digest_arrays_compiled, digest_kernel
 
 
 def series_to_events(times: pd.Series, cells: pd.Series) -> List[Dict]:
@@ -51,7 +55,10 @@ def digest_to_dataframe_clipped(
 
 
 def digest_single_user(times: pd.Series, cells: pd.Series, **kwargs) -> pd.DataFrame:
-    return digest_to_dataframe(digest_generation_iter(times, cells, **kwargs))
+    with profiling.stage("digest_generation", len(times)):
+        digests = digest_generation_iter(times, cells, **kwargs)
+    with profiling.stage("digest_to_dataframe"):
+        return digest_to_dataframe(digests)
 
 
 def clip_until_first_renewal(times: pd.Series, renewal_dt: int):
@@ -78,6 +85,92 @@ def clip_from_last_renewal(times: pd.Series, renewal_dt: int):
         return times.index[0]
 
 
+def time_values(times: pd.Series) -> np.ndarray:
+    """Return the times as int64 nanoseconds since the epoch (UTC if tz-aware)."""
+    return pd.DatetimeIndex(times).asi8
+
+
+def segment_bounds(keys: pd.Series):
+    """Return the start and stop offsets of the runs of equal (sorted) *keys*.
+
+    Missing keys form their own runs.
+    """
+    codes = pd.factorize(keys)[0]
+    starts = np.flatnonzero(np.diff(codes, prepend=-2))
+    stops = np.append(starts[1:], codes.shape[0]) if starts.size else starts
+    return starts, stops
+
+
+def segment_searchsorted(values, starts, stops, value, side="left") -> np.ndarray:
+    """Find the position of *value* in each sorted segment of *values*.
+
+    Equivalent to `starts + np.searchsorted(values[start:stop], value, side)`
+    for every segment, but with a binary search over all segments at once.
+    """
+    lo = np.array(starts, dtype="int64")
+    hi = np.array(stops, dtype="int64")
+    last = max(values.shape[0] - 1, 0)
+    active = lo < hi
+    while active.any():
+        mid = (lo + hi) // 2
+        probe = values[np.minimum(mid, last)]
+        right = active & ((probe < value) if side == "left" else (probe <= value))
+        lo = np.where(right, mid + 1, lo)
+        hi = np.where(active & ~right, mid, hi)
+        active = lo < hi
+    return lo
+
+
+def clip_bounds(
+    times: np.ndarray,
+    starts: np.ndarray,
+    stops: np.ndarray,
+    min_time: datetime.datetime,
+    max_time: datetime.datetime,
+    renewal_dt: int,
+):
+    """Return the [start, stop) offsets of the events to digest for each segment.
+
+    *times* are int64 nanoseconds (see time_values) sorted within each
+    segment [starts, stops), e.g. a user. For every segment, this is the
+    vectorized equivalent of clipping the events before *min_time* with
+    clip_from_last_renewal and those after *max_time* with
+    clip_until_first_renewal: digests that start in [min_time, max_time]
+    only depend on the events in the returned ranges.
+    """
+    warmup_end = segment_searchsorted(
+        times, starts, stops, pd.Timestamp(min_time).value, side="left"
+    )
+    buffer_start = segment_searchsorted(
+        times, starts, stops, pd.Timestamp(max_time).value, side="right"
+    )
+    # renewals: first event after a jump longer than renewal_dt within a segment
+    jumps = np.diff(times) > pd.Timedelta(renewal_dt, unit="s").value
+    renewals = np.flatnonzero(jumps) + 1
+    renewals = renewals[~np.isin(renewals, starts)]
+    if renewals.size == 0:
+        return np.array(starts), np.maximum(stops, starts)
+
+    # last renewal within the warmup (the jump is between two warmup events)
+    last = np.searchsorted(renewals, warmup_end, side="left") - 1
+    renewal = renewals[np.maximum(last, 0)]
+    clip_start = np.where((last >= 0) & (renewal > starts), renewal, starts)
+    # first renewal within the buffer (the jump is between two buffer events)
+    first = np.searchsorted(renewals, buffer_start + 1, side="left")
+    renewal = renewals[np.minimum(first, renewals.shape[0] - 1)]
+    clip_stop = np.where(
+        (first < renewals.shape[0]) & (renewal < stops), renewal, stops
+    )
+    return clip_start, np.maximum(clip_stop, clip_start)
+
+
+def segment_ranges(starts: np.ndarray, stops: np.ndarray) -> np.ndarray:
+    """Return the concatenation of np.arange(start, stop) for all segments."""
+    lengths = stops - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return np.arange(lengths.sum()) + offsets
+
+
 def digest_single_user_clip(
     times: pd.Series,
     cells: pd.Series,
@@ -86,31 +179,40 @@ def digest_single_user_clip(
     **kwargs,
 ) -> pd.DataFrame:
     """Only consider digests that _start_ between min_time and max_time."""
-    # try:
-    renewal_dt = kwargs.get("long_dt", LONG_DT)
-    warmup = times[times < min_time]
-    last_warmup_renewal = (
-        clip_from_last_renewal(warmup, renewal_dt)
-        if len(warmup) > 0
-        else times.index[0]
-    )
-    buffer = times[times > max_time]
-    first_buffer_renewal = (
-        clip_until_first_renewal(buffer, renewal_dt)
-        if len(buffer) > 0
-        else times.index[-1]
+    (start,), (stop,) = clip_bounds(
+        time_values(times),
+        np.array([0]),
+        np.array([len(times)]),
+        min_time,
+        max_time,
+        kwargs.get("long_dt", LONG_DT),
     )
     return digest_to_dataframe_clipped(
         digest_generation_iter(
-            times.loc[last_warmup_renewal:first_buffer_renewal],
-            cells.loc[last_warmup_renewal:first_buffer_renewal],
+            times.iloc[start:stop].reset_index(drop=True),
+            cells.iloc[start:stop].reset_index(drop=True),
             **kwargs,
         ),
         min_time,
         max_time,
     )
-    # except KeyError:
-    #     return pd.DataFrame(columns=DIGEST_COLUMNS)
+
+
+def group_segments(df: pd.DataFrame, keys: List[str]):
+    """Return *df* with the rows of each group of *keys* made contiguous.
+
+    Also returns the start and stop offsets of the groups, in the order of
+    groupby(keys). The order of the rows within each group is preserved and
+    rows with missing keys are dropped (as in groupby).
+    """
+    codes = df.groupby(keys, sort=True, observed=True).ngroup().to_numpy()
+    if (codes < 0).any() or (np.diff(codes) < 0).any():
+        order = np.argsort(codes, kind="stable")
+        order = order[codes[order] >= 0]
+        df, codes = df.iloc[order], codes[order]
+    starts = np.flatnonzero(np.diff(codes, prepend=-1))
+    stops = np.append(starts[1:], codes.shape[0]) if starts.size else starts
+    return df, starts, stops
 
 
 def digest_multi_user(
@@ -119,22 +221,87 @@ def digest_multi_user(
     time_col: str = "time",
     cell_col: str = "cell",
     user_props: List[str] = [],
+    engine: str = "python",
+    sort: bool = True,
     **kwargs,
 ) -> pd.DataFrame:
-    digest_df = (
-        df.sort_values(by=[user_col, time_col])
-        .groupby([user_col] + user_props, group_keys=True)
-        .apply(
-            lambda x: digest_single_user(
-                x.reset_index(drop=True)[time_col],
-                x.reset_index(drop=True)[cell_col],
-                **kwargs,
-            ).rename_axis("digest_id")
+    """Digest each user.
+
+    *engine* selects the implementation: "python" runs the Digestor on each
+    user, "numpy" advances all users at once (see digest_array) and "numba"
+    runs the compiled kernel of digest_numba over all users, if numba is
+    installed (and falls back to "python" otherwise). Pass *sort=False* if
+    *df* is already sorted by user and time.
+    """
+    if engine == "numpy" or (engine == "numba" and digest_kernel is not None):
+        return digest_multi_user_arrays(
+            df,
+            user_col,
+            time_col,
+            cell_col,
+            user_props,
+            engine=engine,
+            sort=sort,
+            **kwargs,
         )
-    )
+    elif engine not in ["python", "numba"]:
+        raise NotImplementedError(f"unexpected engine: {engine}")
+    if sort:
+        with profiling.stage("sort_values", len(df)):
+            df = df.sort_values(by=[user_col, time_col])
+    with profiling.stage("digest", len(df)):
+        digest_df = df.groupby(
+            [user_col] + user_props, group_keys=True, observed=True
+        ).apply(lambda x: _digest_group(x, time_col, cell_col, **kwargs))
     return digest_df if digest_df.empty else digest_df.reset_index()
 
 
+def _digest_group(group: pd.DataFrame, time_col: str, cell_col: str, **kwargs):
+    with profiling.user(group.name, len(group)):
+        return digest_single_user(
+            group.reset_index(drop=True)[time_col],
+            group.reset_index(drop=True)[cell_col],
+            **kwargs,
+        ).rename_axis("digest_id")
+
+
+def digest_multi_user_arrays(
+    df: pd.DataFrame,
+    user_col: str = "user",
+    time_col: str = "time",
+    cell_col: str = "cell",
+    user_props: List[str] = [],
+    engine: str = "numpy",
+    sort: bool = True,
+    **kwargs,
+) -> pd.DataFrame:
+    """Digest each user with digest_array.digest_arrays (or the compiled kernel
+    of digest_numba if *engine="numba"*).
+
+    Returns the same frame as digest_multi_user with the python engine.
+    """
+    digest_func = digest_arrays_compiled if engine == "numba" else digest_arrays
+    keys = [user_col] + user_props
+    with profiling.stage("sort_values", len(df)):
+        if sort:
+            df = df.sort_values(by=[user_col, time_col])
+        df, starts, stops = group_segments(df, keys)
+    with profiling.stage("digest", len(df)):
+        codes, cell_values = pd.factorize(df[cell_col], use_na_sentinel=False)
+        digests = digest_func(time_values(df[time_col]), codes, starts, stops, **kwargs)
+    if not len(digests):
+        return pd.DataFrame(columns=keys + ["digest_id"] + DIGEST_COLUMNS)
+    with profiling.stage("digest_to_dataframe"):
+        users = df[keys].iloc[starts[digests.segment]].reset_index(drop=True)
+        users["digest_id"] = np.arange(len(digests)) - np.searchsorted(
+            digests.segment, digests.segment
+        )
+        digest_df = digest_arrays_to_dataframe(
+            digests, np.asarray(cell_values), tz=df[time_col].dt.tz
+        )
+        return pd.concat([users, digest_df], axis=1)
+
+
 def digest_multi_user_clip(
     df: pd.DataFrame,
     min_time: datetime.datetime,
@@ -143,19 +310,54 @@ def digest_multi_user_clip(
     time_col: str = "time",
     cell_col: str = "cell",
     user_props: List[str] = [],
+    sort: bool = True,
     **kwargs,
 ) -> pd.DataFrame:
-    digest_df = (
-        df.sort_values(by=[user_col, time_col])
-        .groupby([user_col] + user_props, group_keys=True)
-        .apply(
-            lambda x: digest_single_user_clip(
-                x.reset_index(drop=True)[time_col],
-                x.reset_index(drop=True)[cell_col],
-                min_time,
-                max_time,
-                **kwargs,
-            ).rename_axis("digest_id")
+    """Digest each user, keeping the digests that start in [min_time, max_time].
+
+    Pass *sort=False* if *df* is already sorted by user and time.
+    """
+    if sort:
+        with profiling.stage("sort_values", len(df)):
+            df = df.sort_values(by=[user_col, time_col])
+    with profiling.stage("clip", len(df)):
+        df, starts, stops = group_segments(df, [user_col] + user_props)
+        clip_start, clip_stop = clip_bounds(
+            time_values(df[time_col]),
+            starts,
+            stops,
+            min_time,
+            max_time,
+            kwargs.get("long_dt", LONG_DT),
+        )
+        df = df.iloc[segment_ranges(clip_start, clip_stop)]
+    with profiling.stage("digest", len(df)):
+        digest_df = df.groupby(
+            [user_col] + user_props, group_keys=True, observed=True
+        ).apply(
+            lambda x: _digest_group_clipped(
+                x, time_col, cell_col, min_time, max_time, **kwargs
+            )
         )
-    )
     return digest_df if digest_df.empty else digest_df.reset_index()
+
+
+def _digest_group_clipped(
+    group: pd.DataFrame,
+    time_col: str,
+    cell_col: str,
+    min_time: datetime.datetime,
+    max_time: datetime.datetime,
+    **kwargs,
+):
+    with profiling.user(group.name, len(group)):
+        with profiling.stage("digest_generation", len(group)):
+            digests = digest_generation_iter(
+                group.reset_index(drop=True)[time_col],
+                group.reset_index(drop=True)[cell_col],
+                **kwargs,
+            )
+        with profiling.stage("digest_to_dataframe"):
+            return digest_to_dataframe_clipped(digests, min_time, max_time).rename_axis(
+                "digest_id"
+            )
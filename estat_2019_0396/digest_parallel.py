@@ -0,0 +1,145 @@
+"""Parallel digest generation.
+
+The state of the Digestor is reset by any gap between events of at least
+max(short_dt, long_dt): the digest in progress is closed and the next event
+starts a new one, as if it were the first event of the user. The timelines
+of the users are split at such renewal gaps into chunks, which are digested
+independently in a pool of processes and stitched back in order.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+from . import profiling
+from .digest_generation import LONG_DT, SHORT_DT
+from .digest_pandas import (
+    DIGEST_COLUMNS,
+    digest_multi_user,
+    group_segments,
+    time_values,
+)
+from .scheduling import pack_costs
+
+CHUNK_COL = "_chunk"
+
+
+def renewal_chunks(
+    times: np.ndarray,
+    starts: np.ndarray,
+    stops: np.ndarray,
+    renewal_dt: float,
+    chunk_events: int,
+):
+    """Split the segments [starts, stops) at renewal gaps into chunks.
+
+    *times* are int64 nanoseconds sorted within each (contiguous) segment.
+    A chunk ends at the first renewal (the first event after a gap longer
+    than *renewal_dt* seconds) after every *chunk_events* events of its
+    segment, so segments shorter than that are not split. Returns the start
+    and stop offsets of the chunks, and the segment of each chunk.
+    """
+    starts = np.asarray(starts, dtype="int64")
+    stops = np.asarray(stops, dtype="int64")
+    if not starts.size:
+        return starts, stops, np.arange(0)
+    renewals = np.flatnonzero(np.diff(times) > renewal_dt * 1e9) + 1
+    renewals = renewals[~np.isin(renewals, starts)]
+
+    # for every chunk_events events of each segment, cut at the next renewal
+    num_targets = np.maximum((stops - starts - 1) // chunk_events, 0)
+    segments = np.repeat(np.arange(starts.shape[0]), num_targets)
+    offsets = np.arange(segments.shape[0]) - np.repeat(
+        np.cumsum(num_targets) - num_targets, num_targets
+    )
+    targets = starts[segments] + chunk_events * (offsets + 1)
+    found = np.searchsorted(renewals, targets)
+    cuts = renewals[np.minimum(found, max(renewals.shape[0] - 1, 0))]
+    valid = (found < renewals.shape[0]) & (cuts < stops[segments])
+
+    chunk_starts = np.union1d(starts, cuts[valid] if renewals.size else [])
+    chunk_starts = chunk_starts.astype("int64")
+    chunk_stops = np.append(chunk_starts[1:], stops[-1])
+    return (
+        chunk_starts,
+        chunk_stops,
+        np.searchsorted(starts, chunk_starts, side="right") - 1,
+    )
+
+
+def _digest_chunks(
+    events: pd.DataFrame, time_col: str, cell_col: str, kwargs: dict
+) -> pd.DataFrame:
+    return digest_multi_user(
+        events,
+        user_col=CHUNK_COL,
+        time_col=time_col,
+        cell_col=cell_col,
+        sort=False,
+        **kwargs,
+    )
+
+
+def digest_multi_user_parallel(
+    df: pd.DataFrame,
+    user_col: str = "user",
+    time_col: str = "time",
+    cell_col: str = "cell",
+    user_props: List[str] = [],
+    max_workers: Optional[int] = None,
+    chunk_events: int = 100_000,
+    sort: bool = True,
+    **kwargs,
+) -> pd.DataFrame:
+    """Same as digest_pandas.digest_multi_user, in *max_workers* processes.
+
+    Users are split at renewal gaps into chunks of about *chunk_events*
+    events (see renewal_chunks), which are packed into balanced work units,
+    one per worker. With *max_workers=1* the chunks are digested in this
+    process. Other *kwargs* (e.g. engine) are passed to digest_multi_user.
+    Pass *sort=False* if *df* is already sorted by user and time.
+    """
+    keys = [user_col] + user_props
+    max_workers = max_workers or os.cpu_count() or 1
+    with profiling.stage("sort_values", len(df)):
+        if sort:
+            df = df.sort_values(by=[user_col, time_col])
+        df, starts, stops = group_segments(df, keys)
+    renewal_dt = max(kwargs.get("short_dt", SHORT_DT), kwargs.get("long_dt", LONG_DT))
+    chunk_starts, chunk_stops, chunk_segments = renewal_chunks(
+        time_values(df[time_col]), starts, stops, renewal_dt, chunk_events
+    )
+    if not chunk_starts.size:
+        return pd.DataFrame(columns=keys + ["digest_id"] + DIGEST_COLUMNS)
+
+    with profiling.stage("digest", len(df)):
+        chunks = np.repeat(np.arange(chunk_starts.shape[0]), chunk_stops - chunk_starts)
+        events = df[[time_col, cell_col]].assign(**{CHUNK_COL: chunks})
+        units = pack_costs(chunk_stops - chunk_starts, max_workers)[chunks]
+        work = [events[units == unit] for unit in np.unique(units)]
+        args = (time_col, cell_col, kwargs)
+        if max_workers == 1 or len(work) == 1:
+            results = [_digest_chunks(events, *args) for events in work]
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = list(
+                    executor.map(
+                        _digest_chunks,
+                        work,
+                        *([arg] * len(work) for arg in args),
+                    )
+                )
+
+    # stitch the chunks in order and number the digests of each user
+    digests = pd.concat(results).sort_values(
+        [CHUNK_COL, "digest_id"], kind="stable", ignore_index=True
+    )
+    segments = chunk_segments[digests[CHUNK_COL].to_numpy()]
+    users = df[keys].iloc[starts[segments]].reset_index(drop=True)
+    users["digest_id"] = np.arange(segments.shape[0]) - np.searchsorted(
+        segments, segments
+    )
+    return pd.concat([users, digests[DIGEST_COLUMNS]], axis=1)
@@ -0,0 +1,69 @@
+"""Compact dtypes for the event datasets.
+
+The identifiers of users, user types and cells are read as Python strings
+(object columns), which take tens of bytes per event and are slow to sort
+and group. As categoricals they are stored as small integer codes into the
+(few) distinct values. Integer columns (e.g. the tile15 geocodes) are also
+downcast to the smallest integer type that holds their values.
+"""
+
+from typing import Dict, Iterable, Tuple
+
+import pandas as pd
+
+CATEGORICAL_COLUMNS = ("user", "user_type", "cell")
+
+
+def optimize_dtypes(
+    df: pd.DataFrame, categorical: Iterable[str] = CATEGORICAL_COLUMNS
+) -> pd.DataFrame:
+    """Return *df* with the *categorical* object columns as categoricals.
+
+    The categories are sorted and ordered, so sorting and grouping by the
+    categoricals (with observed=True) gives the same order as by the
+    original values. Integer columns are downcast.
+    """
+    columns = {}
+    for col in categorical:
+        if col in df and df[col].dtype == object:
+            columns[col] = pd.Categorical(df[col], ordered=True)
+    for col in df.columns:
+        if col not in columns and pd.api.types.is_integer_dtype(df[col].dtype):
+            columns[col] = pd.to_numeric(df[col], downcast="integer")
+    return df.assign(**columns)
+
+
+def memory_usage(df: pd.DataFrame) -> pd.Series:
+    """Return the bytes taken by each column of *df* (including strings)."""
+    return df.memory_usage(deep=True, index=False)
+
+
+def memory_report(before: pd.DataFrame, after: pd.DataFrame) -> Dict[str, dict]:
+    """Return the memory (in MiB) of each column of *before* and *after*."""
+    usage_before, usage_after = memory_usage(before), memory_usage(after)
+    columns = {
+        col: {
+            "dtype": str(after[col].dtype),
+            "before_mb": usage_before[col] / 2**20,
+            "after_mb": usage_after[col] / 2**20,
+        }
+        for col in after.columns
+    }
+    total_before, total_after = usage_before.sum(), usage_after.sum()
+    return {
+        "total": {
+            "before_mb": total_before / 2**20,
+            "after_mb": total_after / 2**20,
+            "saved_mb": (total_before - total_after) / 2**20,
+            "ratio": total_before / total_after if total_after else None,
+        },
+        "columns": columns,
+    }
+
+
+def optimize_dtypes_report(
+    df: pd.DataFrame, categorical: Iterable[str] = CATEGORICAL_COLUMNS
+) -> Tuple[pd.DataFrame, Dict[str, dict]]:
+    """Same as optimize_dtypes, also returning the memory_report."""
+    optimized = optimize_dtypes(df, categorical)
+    return optimized, memory_report(df, optimized)
@@ -0,0 +1,127 @@
+"""Out-of-core sort of events by user and time.
+
+Chunks of events are sorted in memory and spilled as sorted runs to
+Parquet files, which are then merged batch by batch. The merge yields
+frames sorted by user and time in which every user is complete, so each
+frame can be digested (or its permanence computed) on its own.
+"""
+
+import tempfile
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from . import profiling
+
+
+def sort_runs(
+    chunks: Iterable[pd.DataFrame],
+    directory: Path,
+    user_col: str = "user",
+    time_col: str = "time",
+) -> List[Path]:
+    """Sort each chunk by user and time and write it to a Parquet file.
+
+    Events without user are dropped (as in groupby). Returns the paths of the
+    sorted runs.
+    """
+    paths = []
+    for i, chunk in enumerate(chunks):
+        with profiling.stage("sort_runs", len(chunk)):
+            run = chunk.dropna(subset=[user_col]).sort_values(by=[user_col, time_col])
+            path = Path(directory) / f"run-{i:05d}.parquet"
+            run.to_parquet(path, index=False)
+        paths.append(path)
+    return paths
+
+
+def merge_runs(
+    paths: List[Path],
+    user_col: str = "user",
+    time_col: str = "time",
+    batch_size: int = 100_000,
+) -> Iterator[pd.DataFrame]:
+    """Merge the sorted runs, yielding frames of complete users in order.
+
+    At most about *batch_size* rows of each run are held in memory, plus the
+    rows of the users that span several batches, and the frames have at
+    least *batch_size* rows (except the last one).
+    """
+    batches = [
+        pq.ParquetFile(path).iter_batches(batch_size=batch_size) for path in paths
+    ]
+    buffers: List[pd.DataFrame] = [pd.DataFrame()] * len(batches)
+    exhausted = [False] * len(batches)
+
+    def refill(run):
+        batch = next(batches[run], None)
+        if batch is None:
+            exhausted[run] = True
+        else:
+            rows = batch.to_pandas()
+            buffers[run] = (
+                rows if buffers[run].empty else pd.concat([buffers[run], rows])
+            )
+
+    def merge(parts):
+        with profiling.stage("merge_runs", sum(len(part) for part in parts)):
+            return pd.concat(parts, ignore_index=True).sort_values(
+                by=[user_col, time_col], kind="stable", ignore_index=True
+            )
+
+    merged: List[pd.DataFrame] = []
+    while True:
+        for run in range(len(batches)):
+            while not exhausted[run] and buffers[run].empty:
+                refill(run)
+        # the users below the last one buffered from each unfinished run are
+        # complete in the buffers
+        unfinished = [run for run in range(len(batches)) if not exhausted[run]]
+        bound = min(
+            (buffers[run][user_col].iloc[-1] for run in unfinished), default=None
+        )
+        parts = []
+        for run, buffer in enumerate(buffers):
+            if bound is None:
+                stop = len(buffer)
+            else:
+                stop = buffer[user_col].searchsorted(bound, side="left")
+            if stop:
+                parts.append(buffer.iloc[:stop])
+                buffers[run] = buffer.iloc[stop:]
+        if parts:
+            merged.append(merge(parts))
+            if sum(len(frame) for frame in merged) >= batch_size:
+                yield pd.concat(merged, ignore_index=True)
+                merged = []
+        elif bound is None:
+            if merged:
+                yield pd.concat(merged, ignore_index=True)
+            return
+        else:
+            # the bound user may continue in the next batch of these runs
+            for run in unfinished:
+                if buffers[run][user_col].iloc[-1] == bound:
+                    refill(run)
+
+
+def external_sort(
+    chunks: Iterable[pd.DataFrame],
+    user_col: str = "user",
+    time_col: str = "time",
+    batch_size: int = 100_000,
+    directory: Optional[Path] = None,
+) -> Iterator[pd.DataFrame]:
+    """Sort the events in *chunks* by user and time out of core.
+
+    The sorted runs are spilled to a temporary directory (within
+    *directory*, if given) which is removed once the merge is consumed.
+    Yields frames of complete users, see merge_runs.
+    """
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        paths = sort_runs(chunks, Path(tmp), user_col=user_col, time_col=time_col)
+        yield from merge_runs(
+            paths, user_col=user_col, time_col=time_col, batch_size=batch_size
+        )
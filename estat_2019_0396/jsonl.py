@@ -0,0 +1,173 @@
+"""JSON Lines export of the digests, and import of the events.
+
+One JSON object per line, written in batches, so that consumers can read
+the digests as they are written:
+
+    with open("digests.jsonl", "wb") as f:
+        write_digests_jsonl(iter_digests(times, cells), f)
+
+Digest objects are serialized with orjson if it is installed (directly
+from the dataclass, without an intermediate dict) or with DigestEncoder.
+Frames (e.g. from digest_multi_user) are serialized column by column, and
+the JSON of the columns is then spliced into the lines.
+
+Events in JSON Lines (e.g. written by dataframe_to_jsonl) are read back
+with read_jsonl.
+"""
+
+import json
+from typing import IO, Iterable, Iterator, Optional, Union
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_bool_dtype, is_datetime64_any_dtype, is_integer_dtype
+
+from .digest_generation import Digest, DigestEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
+
+def _default(obj):
+    # types orjson does not serialize natively (e.g. pd.Timestamp)
+    if isinstance(obj, pd.Timestamp):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj) -> bytes:
+    """Return the (compact) JSON of *obj*, e.g. a Digest."""
+    if orjson is not None:
+        return orjson.dumps(
+            obj,
+            default=_default,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY,
+        )
+    return json.dumps(
+        obj, cls=DigestEncoder, separators=(",", ":"), ensure_ascii=False
+    ).encode()
+
+
+def digest_to_json(digest: Digest) -> bytes:
+    """Return *digest* as a JSON object."""
+    return dumps(digest)
+
+
+def iter_digests_jsonl(digests: Iterable[Digest]) -> Iterator[bytes]:
+    """Yield the lines of the JSON Lines of *digests*."""
+    for digest in digests:
+        yield digest_to_json(digest) + b"\n"
+
+
+def write_digests_jsonl(
+    digests: Iterable[Digest], f: IO[bytes], batch_size: int = 10_000
+) -> int:
+    """Write *digests* as JSON Lines to the binary file *f*.
+
+    The lines are written (and flushed) every *batch_size* digests. Returns
+    the number of digests written.
+    """
+    count = 0
+    batch = []
+    for line in iter_digests_jsonl(digests):
+        batch.append(line)
+        if len(batch) == batch_size:
+            count += _write_batch(f, batch)
+            batch = []
+    if batch:
+        count += _write_batch(f, batch)
+    return count
+
+
+def _write_batch(f: IO[bytes], lines: list) -> int:
+    f.write(b"".join(lines))
+    f.flush()
+    return len(lines)
+
+
+def json_values(values: pd.Series) -> np.ndarray:
+    """Return the JSON of each of the *values*, as an array of str.
+
+    Times are ISO 8601 strings, in UTC (with a Z) if they are tz-aware, to
+    the second (or to the finest fraction of a second of the column).
+    """
+    isna = values.isna().to_numpy()
+    if is_datetime64_any_dtype(values.dtype):
+        tz = getattr(values.dtype, "tz", None)
+        if tz is not None:
+            values = values.dt.tz_convert("UTC").dt.tz_localize(None)
+        times = values.to_numpy(dtype="datetime64[ns]")
+        strings = np.datetime_as_string(
+            times, unit=_time_unit(times[~isna]), timezone="UTC" if tz else "naive"
+        )
+        encoded = np.array([f'"{string}"' for string in strings.tolist()], dtype=object)
+    elif is_bool_dtype(values.dtype) and not isna.any():
+        encoded = np.where(values.to_numpy(), "true", "false").astype(object)
+    elif is_integer_dtype(values.dtype) and not isna.any():
+        encoded = np.array(list(map(str, values.tolist())), dtype=object)
+    else:
+        # repeated values (e.g. users and cells) are encoded once
+        try:
+            codes, uniques = pd.factorize(values)
+        except TypeError:  # unhashable values, e.g. the dicts of events_in_cell
+            return np.array(
+                [dumps(value).decode() for value in values.tolist()], dtype=object
+            )
+        unique_json = [dumps(value).decode() for value in uniques.tolist()]
+        return np.array(unique_json + ["null"], dtype=object)[codes]
+    encoded[isna] = "null"
+    return encoded
+
+
+def _time_unit(times):
+    ns = times.view("int64")
+    for unit, size in (("s", 10**9), ("ms", 10**6), ("us", 10**3)):
+        if not (ns % size).any():
+            return unit
+    return "ns"
+
+
+def dataframe_to_jsonl(df: pd.DataFrame) -> str:
+    """Return the rows of *df* as JSON Lines (see json_values)."""
+    keys = [json.dumps(str(col)).replace("%", "%%") for col in df.columns]
+    line = "{" + ",".join(f"{key}:%s" for key in keys) + "}\n"
+    columns = [json_values(df.iloc[:, i]) for i in range(df.shape[1])]
+    return "".join(line % row for row in zip(*columns))
+
+
+def write_dataframe_jsonl(
+    df: pd.DataFrame, f: IO[bytes], batch_size: int = 100_000
+) -> int:
+    """Write the rows of *df* as JSON Lines to the binary file *f*.
+
+    The rows are serialized (and flushed) every *batch_size* rows. Returns
+    the number of rows written.
+    """
+    for start in range(0, len(df), batch_size):
+        f.write(dataframe_to_jsonl(df.iloc[start : start + batch_size]).encode())
+        f.flush()
+    return len(df)
+
+
+def _parse_times(df: pd.DataFrame, time_col: str) -> pd.DataFrame:
+    if time_col in df:
+        df[time_col] = pd.to_datetime(df[time_col])
+    return df
+
+
+def read_jsonl(
+    path, chunksize: Optional[int] = None, time_col: str = "time"
+) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
+    """Read the JSON Lines at *path* as a frame, or frames of *chunksize* rows.
+
+    The values keep their JSON types, except *time_col*, parsed from ISO 8601
+    strings (tz-aware if they have an offset, e.g. a Z). The compression is
+    inferred from the suffix, as in pd.read_json.
+    """
+    options = dict(lines=True, dtype=False, convert_dates=False)
+    if chunksize is None:
+        return _parse_times(pd.read_json(path, **options), time_col)
+    reader = pd.read_json(path, chunksize=chunksize, **options)
+    return (_parse_times(chunk, time_col) for chunk in reader)
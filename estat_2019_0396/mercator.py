@@ -1,4 +1,9 @@
+import os
+from pathlib import Path
+from typing import Dict, Optional, Union
+
 import numpy as np
+import pandas as pd
 
 
 def lonlat_to_tile0(lng, lat):
@@ -27,8 +32,8 @@ def tile_to_lonlat(xtile, ytile, zoom, center=False):
     is returned. If *center=True* the lon, lat of the center of the tile is.
     """
     if center:
-        xtile += 0.5
-        ytile += 0.5
+        xtile = xtile + 0.5
+        ytile = ytile + 0.5
     n = 2.0**zoom
     lon_deg = xtile / n * 360.0 - 180.0
     lat_rad = np.arctan(np.sinh(np.pi * (1.0 - 2.0 * ytile / n)))
@@ -47,45 +52,116 @@ def encode(lng, lat, z=32):
     return x * 2**z + y
 
 
-def decode(geocode, z=32, center=True):
+def decode(geocode, z=32, center=True, geometry=None):
     """Transform a *geocode* obtained with *encode* to an approximate lon, lat.
 
     The returned lon, lat is equal to the original encoded values up to the
     precision of the z level. Note that the value of z _must_ be the same
     used with the function *encode* for results to be consistent.
+    If a *geometry* table (see *TileGeometry*) is given, the lon, lat are
+    looked up from it instead of being computed.
     """
+    if geometry is not None:
+        geometry.check_zoom(z)
+        if center:
+            return geometry.center(geocode)
+        return geometry.min_corner(geocode)
     x = geocode // 2**z
     y = geocode % (2**z)
     return tile_to_lonlat(x, y, z, center=center)
 
 
-def average_tiles(xs, ys, xz, weights=None, grouping=None):
-    """Return the average lon/lat of tiles with optional weighting and grouping.
+def weighted_centroids(
+    lons, lats, codes, weights=None, num_groups=None, cartesian=False
+):
+    """Return the (weighted) mean lon/lat of each group of points.
 
-    The average is computed as arithmetic mean of the lon/lats of the tiles
-    defined by xs, ys, zs. If a grouping is given, the xs, ys, zs must be
-    pandas.Series, otherwise they can be pandas.Series or numpy arrays.
+    The groups are given by the non-negative integer *codes* (e.g. obtained
+    with pandas.factorize), and all the sums are computed in a single pass
+    over the data with numpy.bincount. Negative codes are ignored. If
+    *cartesian=True* the points are averaged as 3D unit vectors, which keeps
+    the result correct for groups spanning the antimeridian or the poles.
+    Groups without points (or with zero total weight) are returned as NaN.
     """
-    lons, lats = tile_to_lonlat(xs, ys, xz, center=True)
+    codes = np.asarray(codes)
+    lons = np.asarray(lons, dtype="float64")
+    lats = np.asarray(lats, dtype="float64")
+    weights = None if weights is None else np.asarray(weights, dtype="float64")
+    valid = codes >= 0
+    if not valid.all():
+        codes, lons, lats = codes[valid], lons[valid], lats[valid]
+        weights = None if weights is None else weights[valid]
+    if num_groups is None:
+        num_groups = int(codes.max()) + 1 if codes.size else 0
+
+    def group_sum(values):
+        if weights is not None:
+            values = values * weights
+        return np.bincount(codes, weights=values, minlength=num_groups)
+
     if weights is not None:
-        lons *= weights
-        lats *= weights
-        if grouping is not None:
-            norm = weights.groupby(grouping).mean()
-        else:
-            norm = weights.mean()
+        norm = np.bincount(codes, weights=weights, minlength=num_groups)
     else:
-        norm = 1
+        norm = np.bincount(codes, minlength=num_groups).astype("float64")
 
-    if grouping is not None:
-        mean_lons = lons.groupby(grouping).mean() / norm
-        mean_lats = lats.groupby(grouping).mean() / norm
-    else:
-        mean_lons = lons.mean() / norm
-        mean_lats = lats.mean() / norm
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if cartesian:
+            lon_rad, lat_rad = np.radians(lons), np.radians(lats)
+            cos_lat = np.cos(lat_rad)
+            x = group_sum(cos_lat * np.cos(lon_rad)) / norm
+            y = group_sum(cos_lat * np.sin(lon_rad)) / norm
+            z = group_sum(np.sin(lat_rad)) / norm
+            mean_lons = np.degrees(np.arctan2(y, x))
+            mean_lats = np.degrees(np.arctan2(z, np.hypot(x, y)))
+            empty = norm == 0
+            mean_lons[empty] = np.nan
+            mean_lats[empty] = np.nan
+        else:
+            mean_lons = group_sum(lons) / norm
+            mean_lats = group_sum(lats) / norm
     return mean_lons, mean_lats
 
 
+def average_tiles(
+    xs, ys, xz, weights=None, grouping=None, cartesian=False, geometry=None
+):
+    """Return the average lon/lat of tiles with optional weighting and grouping.
+
+    The average is computed as arithmetic mean of the lon/lats of the tiles
+    defined by xs, ys, zs. If a grouping is given, the result is a pair of
+    pandas.Series indexed by the (sorted) group keys, otherwise a pair of
+    floats. See *weighted_centroids* for the meaning of *cartesian*. If a
+    *geometry* table is given the tile centers are looked up from it.
+    """
+    if geometry is not None:
+        geometry.check_zoom(xz)
+        lons, lats = geometry.center(_to_geocode(xs, ys, xz))
+    else:
+        lons, lats = tile_to_lonlat(xs, ys, xz, center=True)
+    if grouping is None:
+        mean_lons, mean_lats = weighted_centroids(
+            lons,
+            lats,
+            np.zeros(np.shape(lons), dtype="int64"),
+            weights=weights,
+            num_groups=1,
+            cartesian=cartesian,
+        )
+        return mean_lons[0], mean_lats[0]
+
+    codes, keys = pd.factorize(grouping, sort=True)
+    mean_lons, mean_lats = weighted_centroids(
+        lons,
+        lats,
+        codes,
+        weights=weights,
+        num_groups=len(keys),
+        cartesian=cartesian,
+    )
+    index = pd.Index(keys, name=getattr(grouping, "name", None))
+    return pd.Series(mean_lons, index=index), pd.Series(mean_lats, index=index)
+
+
 def recursive_count_level(df, zoom_level, threshold, max_zoom=16):
     """UNTESTED. Recursively build a tree by Mercator tiles.
 
@@ -122,7 +198,15 @@ def haversine(lonlat1, lonlat2):
     return 6367000 * c
 
 
-def distance_codes(codes1, codes2, z=32):
+def distance_codes(codes1, codes2, z=32, geometry=None):
+    """Return the distance in m between the closest corners of two tiles.
+
+    Neighbouring tiles are at distance 0. If a *geometry* table (see
+    *TileGeometry*) is given, the corners are looked up from it.
+    """
+    if geometry is not None:
+        geometry.check_zoom(z)
+        return _distance_codes_lookup(codes1, codes2, geometry)
     x1, y1 = codes1 // 2**z, codes1 % (2**z)
     x2, y2 = codes2 // 2**z, codes2 % (2**z)
     dxs = np.sign(x1 - x2)
@@ -134,3 +218,139 @@ def distance_codes(codes1, codes2, z=32):
         x2 + np.maximum(dxs, 0), y2 + np.minimum(dys, 0), zoom=z
     )
     return haversine(np.stack([lon1, lat1]).T, np.stack([lon2, lat2]).T)
+
+
+def _distance_codes_lookup(codes1, codes2, geometry):
+    codes1, codes2 = np.broadcast_arrays(
+        _as_geocode(codes1).reshape(-1), _as_geocode(codes2).reshape(-1)
+    )
+    x1, y1 = geometry.tile_xy(codes1)
+    x2, y2 = geometry.tile_xy(codes2)
+    # look both up at once: adding rows to the table shifts the existing ones
+    i1, i2 = np.split(geometry.index(np.concatenate([codes1, codes2])), 2)
+    # same corner choice as distance_codes: the max corner is (x + 1, y - 1)
+    lon1 = np.where(x1 < x2, geometry.max_lon[i1], geometry.min_lon[i1])
+    lat1 = np.where(y1 > y2, geometry.max_lat[i1], geometry.min_lat[i1])
+    lon2 = np.where(x1 > x2, geometry.max_lon[i2], geometry.min_lon[i2])
+    lat2 = np.where(y1 < y2, geometry.max_lat[i2], geometry.min_lat[i2])
+    return haversine(np.stack([lon1, lat1]).T, np.stack([lon2, lat2]).T)
+
+
+def _as_geocode(codes):
+    return np.asarray(codes).astype("uint64")
+
+
+def _to_geocode(xs, ys, z):
+    return _as_geocode(xs) * np.uint64(2**z) + _as_geocode(ys)
+
+
+class TileGeometry:
+    """Lookup table with the geometry of the tiles of zoom level *z*.
+
+    The table is keyed by geocode (see *encode*) and holds the lon/lat of the
+    center and of the min (x, y) and max (x + 1, y - 1) corners of each tile.
+    Rows are computed lazily the first time a geocode is looked up, so the
+    trigonometry runs once per distinct tile instead of once per row. Use
+    *geometry_table* to share a table and *save*/*load* to keep it between
+    runs.
+    """
+
+    columns = ("center_lon", "center_lat", "min_lon", "min_lat", "max_lon", "max_lat")
+
+    def __init__(self, z: int = 32):
+        self.z = z
+        self.codes = np.empty(0, dtype="uint64")
+        self.values = np.empty((len(self.columns), 0), dtype="float64")
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def __getattr__(self, name):
+        if name in self.columns:
+            return self.values[self.columns.index(name)]
+        raise AttributeError(name)
+
+    def check_zoom(self, z):
+        if z != self.z:
+            raise ValueError(f"TileGeometry is for zoom {self.z}, got zoom {z}")
+
+    def tile_xy(self, geocodes):
+        geocodes = _as_geocode(geocodes)
+        n = np.uint64(2**self.z)
+        return geocodes // n, geocodes % n
+
+    def index(self, geocodes) -> np.ndarray:
+        """Return the rows of *geocodes*, adding the missing ones to the table."""
+        geocodes = _as_geocode(geocodes)
+        rows = np.searchsorted(self.codes, geocodes)
+        found = rows < len(self)
+        found[found] = self.codes[rows[found]] == geocodes[found]
+        if not found.all():
+            self._add(np.unique(geocodes[~found]))
+            rows = np.searchsorted(self.codes, geocodes)
+        return rows
+
+    def center(self, geocodes):
+        rows = self.index(geocodes)
+        return self.center_lon[rows], self.center_lat[rows]
+
+    def min_corner(self, geocodes):
+        rows = self.index(geocodes)
+        return self.min_lon[rows], self.min_lat[rows]
+
+    def max_corner(self, geocodes):
+        rows = self.index(geocodes)
+        return self.max_lon[rows], self.max_lat[rows]
+
+    def _add(self, new_codes):
+        x, y = self.tile_xy(new_codes)
+        x, y = x.astype("float64"), y.astype("float64")
+        new_values = np.stack(
+            tile_to_lonlat(x, y, self.z, center=True)
+            + tile_to_lonlat(x, y, self.z)
+            + tile_to_lonlat(x + 1, y - 1, self.z)
+        )
+        # *new_codes* are sorted and missing: insert them in a single merge
+        positions = np.searchsorted(self.codes, new_codes)
+        self.codes = np.insert(self.codes, positions, new_codes)
+        self.values = np.insert(self.values, positions, new_values, axis=1)
+
+    def save(self, path: Union[str, Path]):
+        # written aside and renamed, so that readers never see a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, z=self.z, codes=self.codes, values=self.values)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "TileGeometry":
+        with np.load(path) as data:
+            table = cls(int(data["z"]))
+            table.codes = data["codes"]
+            table.values = data["values"]
+        return table
+
+
+_GEOMETRY_TABLES: Dict[int, TileGeometry] = {}
+
+# Rows of a shared table (of 56 bytes each) before it is started anew.
+GEOMETRY_TABLE_MAX_ROWS = 2**21
+
+
+def geometry_table(z: int = 32, path: Optional[Union[str, Path]] = None):
+    """Return the shared TileGeometry of zoom *z*.
+
+    If the table is not loaded yet and *path* points to a saved table, it is
+    loaded from disk. Tables over GEOMETRY_TABLE_MAX_ROWS are dropped and
+    built again from scratch.
+    """
+    if z in _GEOMETRY_TABLES and len(_GEOMETRY_TABLES[z]) > GEOMETRY_TABLE_MAX_ROWS:
+        del _GEOMETRY_TABLES[z]
+    if z not in _GEOMETRY_TABLES:
+        if path is not None and Path(path).exists():
+            table = TileGeometry.load(path)
+            table.check_zoom(z)
+        else:
+            table = TileGeometry(z)
+        _GEOMETRY_TABLES[z] = table
+    return _GEOMETRY_TABLES[z]
@@ -1,9 +1,12 @@
-import enum
-from typing import Callable, List, Optional
+from typing import Callable, List, Optional, Sequence
 
 import numpy as np
 import pandas as pd
 
+from . import profiling
+from .mercator import distance_codes, geometry_table
+from .time_periods import HourBins, TimeGrouping, TimePeriod
+
 MAX_SPEED = 30 * 1000 / 3600  # 30 km/h
 
 
@@ -11,55 +14,248 @@ def footprint_distance(fp1: pd.Series, fp2: pd.Series) -> pd.Series:
     return pd.Series(np.ones(fp1.shape[0])) * np.inf
 
 
-class TimePeriod(enum.Enum):
-    daily = "D"
-    weekly = "W"
-    monthly = "M"
+def geocode_distance(fp1: np.ndarray, fp2: np.ndarray, zoom: int) -> np.ndarray:
+    """Distance between geocode footprints (see mercator.encode) of zoom *zoom*.
 
+    The tile corners are looked up from the shared mercator.geometry_table.
+    """
+    return distance_codes(fp1, fp2, z=zoom, geometry=geometry_table(zoom))
 
-def get_permanence(
+
+def prefetch_geometry(footprints: pd.Series, zoom: Optional[int]):
+    """Add the tiles of all *footprints* to the geometry table at once.
+
+    Otherwise every user that brings new tiles inserts them in the table.
+    """
+    if zoom is not None:
+        with profiling.stage("prefetch_geometry", len(footprints)):
+            geometry_table(zoom).index(pd.unique(footprints.dropna()))
+
+
+def period_starts(times: pd.Series, grouping: TimeGrouping) -> pd.Series:
+    """Return the start of the period of *grouping* that contains each time.
+
+    Equivalent to `times.dt.to_period(grouping.value).dt.start_time` for a
+    TimePeriod, but computed with datetime64 arithmetic.
+    """
+    values = _wall_times(times)
+    days = values.astype("datetime64[D]")
+    if grouping == TimePeriod.daily:
+        starts = days
+    elif grouping == TimePeriod.weekly:
+        # 1970-01-01 was a Thursday, weeks start on Monday
+        day_numbers = days.astype("int64")
+        starts = (day_numbers - (day_numbers + 3) % 7).astype("datetime64[D]")
+    elif grouping == TimePeriod.monthly:
+        starts = values.astype("datetime64[M]")
+    elif isinstance(grouping, HourBins):
+        edges = np.array(grouping.hours, dtype="timedelta64[h]")
+        bins = np.searchsorted(edges, values - days, side="right") - 1
+        starts = days + edges[bins]
+        starts[bins < 0] -= np.timedelta64(24, "h")
+    else:
+        raise NotImplementedError(f"unexpected time grouping: {grouping}")
+    return pd.Series(
+        starts.astype("datetime64[ns]"), index=times.index, name=times.name
+    )
+
+
+def period_edges(first, last, grouping: TimeGrouping) -> np.ndarray:
+    """Return the sorted starts of all the periods between *first* and *last*.
+
+    The returned edges include the start of the period after *last*, so every
+    time in [first, last] falls between two consecutive edges.
+    """
+    first_day = np.datetime64(first, "D")
+    last_day = np.datetime64(last, "D")
+    if grouping == TimePeriod.daily:
+        edges = np.arange(first_day, last_day + 2)
+    elif grouping == TimePeriod.weekly:
+        first_week = period_starts(pd.Series([first]), grouping).to_numpy()[0]
+        edges = np.arange(np.datetime64(first_week, "D"), last_day + 8, 7)
+    elif grouping == TimePeriod.monthly:
+        edges = np.arange(
+            np.datetime64(first, "M"), np.datetime64(last, "M") + 2
+        ).astype("datetime64[D]")
+    elif isinstance(grouping, HourBins):
+        days = np.arange(first_day - 1, last_day + 2)
+        hours = np.array(grouping.hours, dtype="timedelta64[h]")
+        edges = (days[:, None] + hours[None, :]).ravel()
+    else:
+        raise NotImplementedError(f"unexpected time grouping: {grouping}")
+    return edges.astype("datetime64[ns]")
+
+
+def _wall_times(times: pd.Series) -> np.ndarray:
+    if times.dt.tz is not None:
+        times = times.dt.tz_localize(None)
+    return times.to_numpy(dtype="datetime64[ns]")
+
+
+def permanence_contributions(
     footprints: pd.Series,
     times: pd.Series,
     max_speed: float = MAX_SPEED,
     distance_func: Callable = footprint_distance,
     semi_time_threshold: int = 8 * 60,
     max_dt: int = 12 * 60 * 60,
-    time_grouping: Optional[TimePeriod] = None,
-) -> pd.Series:
+    footprint_zoom: Optional[int] = None,
+) -> pd.DataFrame:
+    """Return the permanence time (in seconds) contributed by each event.
 
-    if time_grouping:
-        axis = [footprints, times.dt.to_period(time_grouping.value).dt.start_time]
-        levels = [0, 1]
-    else:
-        axis = footprints
-        levels = [0]
+    An event contributes the time since the previous event if both share the
+    footprint, or half the time to the previous and to the next events (up
+    to *semi_time_threshold* each) if the user moved slower than *max_speed*
+    between them. The interval covered by each contribution is given by the
+    `start_time` and `end_time` columns. The contributions do not depend on
+    any time grouping and can be aggregated with *aggregate_permanence*.
 
-    times = times.set_axis(axis)
-    footprints = footprints.set_axis(axis)
+    If *footprint_zoom* is given, the footprints are taken to be geocodes of
+    that zoom level and the distance between them is computed with
+    *geocode_distance* instead of *distance_func*.
+    """
+    times = times.reset_index(drop=True)
+    footprints = footprints.reset_index(drop=True)
     dts = (times - times.shift(1)) / pd.Timedelta("1s")
     same_footprint = ((footprints == footprints.shift(1)) & (dts < max_dt)).values
-    semi_times = np.minimum(0.5 * dts, semi_time_threshold) + np.minimum(
+    semi_before = np.minimum(0.5 * dts, semi_time_threshold)
+    semi_after = np.minimum(
         0.5 * (times.shift(-1) - times) / pd.Timedelta("1s"), semi_time_threshold
     )
-    low_speed = (
-        distance_func(footprints.shift(1).values, footprints.shift(-1).values)
-        / (dts.values + dts.shift(-1).values)
-        < max_speed
-    ) & ((dts.values + dts.shift(-1).values) < max_dt)
-
-    d = dts.loc[same_footprint]
-    s = semi_times.loc[(~same_footprint & low_speed).values]
-    return (
-        pd.concat(
-            [
-                d,
-                s,
-            ]
+    semi_times = semi_before + semi_after
+    if footprint_zoom is not None:
+        values = footprints.to_numpy()
+        distances = np.full(values.shape[0], np.inf)
+        if values.shape[0] > 2:
+            distances[1:-1] = geocode_distance(values[:-2], values[2:], footprint_zoom)
+    else:
+        distances = distance_func(
+            footprints.shift(1).values, footprints.shift(-1).values
         )
-        .groupby(level=levels)
-        .sum()
-        .rename("permanence_time")
+    low_speed = (distances / (dts.values + dts.shift(-1).values) < max_speed) & (
+        (dts.values + dts.shift(-1).values) < max_dt
     )
+    slow_move = ~same_footprint & np.asarray(low_speed)
+
+    stays = np.flatnonzero(same_footprint)
+    moves = np.flatnonzero(slow_move)
+    events = np.concatenate([stays, moves])
+    event_times = times.iloc[events].reset_index(drop=True)
+    return pd.DataFrame(
+        {
+            "footprint": footprints.iloc[events].to_numpy(),
+            "time": event_times,
+            "start_time": pd.concat(
+                [
+                    times.iloc[stays - 1],
+                    times.iloc[moves] - pd.to_timedelta(semi_before[moves], unit="s"),
+                ],
+                ignore_index=True,
+            ),
+            "end_time": pd.concat(
+                [
+                    times.iloc[stays],
+                    times.iloc[moves] + pd.to_timedelta(semi_after[moves], unit="s"),
+                ],
+                ignore_index=True,
+            ),
+            "permanence_time": np.concatenate(
+                [dts.values[same_footprint], semi_times.values[slow_move]]
+            ),
+        }
+    )
+
+
+def aggregate_permanence(
+    contributions: pd.DataFrame,
+    time_grouping: Optional[TimeGrouping] = None,
+    by: List[str] = [],
+    split_intervals: bool = False,
+) -> pd.Series:
+    """Sum the *contributions* per *by* columns, footprint and time period.
+
+    Each contribution is attributed to the period of its event, unless
+    *split_intervals* is set, in which case it is apportioned to all the
+    periods its interval overlaps (see *split_contributions*).
+    """
+    if time_grouping and split_intervals:
+        contributions = split_contributions(contributions, time_grouping)
+        period = contributions["time"]
+    elif time_grouping:
+        period = period_starts(contributions["time"], time_grouping)
+    keys = [contributions[col] for col in by + ["footprint"]]
+    if time_grouping:
+        keys.append(period)
+    return contributions["permanence_time"].groupby(keys, observed=True).sum()
+
+
+def split_contributions(
+    contributions: pd.DataFrame, time_grouping: TimeGrouping
+) -> pd.DataFrame:
+    """Split each contribution across the periods its interval overlaps.
+
+    Returns one row per contribution and overlapped period, with the `time`
+    column set to the period start and the permanence time apportioned
+    proportionally to the overlap.
+    """
+    if contributions.empty:
+        return contributions.assign(time=contributions["time"].dt.tz_localize(None))
+    starts = _wall_times(contributions["start_time"])
+    ends = _wall_times(contributions["end_time"])
+    edges = period_edges(starts.min(), ends.max(), time_grouping)
+    first = np.searchsorted(edges, starts, side="right") - 1
+    last = np.maximum(np.searchsorted(edges, ends, side="left") - 1, first)
+
+    counts = last - first + 1
+    rows = np.repeat(np.arange(counts.shape[0]), counts)
+    periods = (
+        first[rows]
+        + np.arange(rows.shape[0])
+        - np.repeat(np.cumsum(counts) - counts, counts)
+    )
+    overlap = np.minimum(ends[rows], edges[periods + 1]) - np.maximum(
+        starts[rows], edges[periods]
+    )
+    length = (ends - starts)[rows]
+    permanence_time = contributions["permanence_time"].to_numpy()[rows]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        share = np.where(length > np.timedelta64(0), overlap / length, 1.0)
+    return contributions.iloc[rows].assign(
+        time=edges[periods], permanence_time=permanence_time * share
+    )
+
+
+def get_permanence(
+    footprints: pd.Series,
+    times: pd.Series,
+    max_speed: float = MAX_SPEED,
+    distance_func: Callable = footprint_distance,
+    semi_time_threshold: int = 8 * 60,
+    max_dt: int = 12 * 60 * 60,
+    time_grouping: Optional[TimeGrouping] = None,
+    footprint_zoom: Optional[int] = None,
+    split_intervals: bool = False,
+) -> pd.Series:
+    """Return the permanence time (in seconds) of a single user per footprint.
+
+    See *permanence_contributions* for the meaning of the parameters. If a
+    *time_grouping* is given, the permanence is also split by time period:
+    by default each contribution counts toward the period of its event, with
+    *split_intervals* it is apportioned across the periods it spans.
+    """
+    contributions = permanence_contributions(
+        footprints,
+        times,
+        max_speed=max_speed,
+        distance_func=distance_func,
+        semi_time_threshold=semi_time_threshold,
+        max_dt=max_dt,
+        footprint_zoom=footprint_zoom,
+    )
+    names = [footprints.name, times.name] if time_grouping else footprints.name
+    return aggregate_permanence(
+        contributions, time_grouping, split_intervals=split_intervals
+    ).rename_axis(names)
 
 
 def permanence_multi_user(
@@ -68,17 +264,75 @@ def permanence_multi_user(
     time_col: str = "time",
     footprint_col: str = "cell",
     user_props: List[str] = [],
+    sort: bool = True,
     **kwargs,
 ) -> pd.DataFrame:
-    permanence = (
+    """Return the permanence of every user (see get_permanence).
+
+    Pass *sort=False* if *df* is already sorted by user and time.
+    """
+    if sort:
+        with profiling.stage("sort_values", len(df)):
+            df = df.sort_values(by=[user_col, time_col])
+    prefetch_geometry(df[footprint_col], kwargs.get("footprint_zoom"))
+    with profiling.stage("permanence", len(df)):
+        permanence = df.groupby(
+            [user_col] + user_props, group_keys=True, observed=True
+        ).apply(
+            lambda x: get_permanence(
+                x.reset_index(drop=True)[footprint_col],
+                x.reset_index(drop=True)[time_col],
+                **kwargs,
+            )
+        )
+    return permanence if permanence.empty else permanence.reset_index()
+
+
+def permanence_multi_resolution(
+    df: pd.DataFrame,
+    time_groupings: Sequence[TimeGrouping],
+    user_col: str = "user",
+    time_col: str = "time",
+    footprint_col: str = "cell",
+    user_props: List[str] = [],
+    split_intervals: bool = False,
+    **kwargs,
+) -> pd.DataFrame:
+    """Return the permanence of every user aggregated to several time groupings.
+
+    The per-event contributions are computed once and then aggregated to each
+    of the *time_groupings*. The result has one row per user, grouping
+    (column `period`, see TimePeriod.label and HourBins.label), footprint and
+    period start (column *time_col*). See *aggregate_permanence* for
+    *split_intervals*.
+    """
+    by = [user_col] + user_props
+    columns = by + ["period", footprint_col, time_col, "permanence_time"]
+    prefetch_geometry(df[footprint_col], kwargs.get("footprint_zoom"))
+    contributions = (
         df.sort_values(by=[user_col, time_col])
-        .groupby([user_col] + user_props, group_keys=True)
+        .groupby(by, group_keys=True, observed=True)
         .apply(
-            lambda x: get_permanence(
+            lambda x: permanence_contributions(
                 x.reset_index(drop=True)[footprint_col],
                 x.reset_index(drop=True)[time_col],
                 **kwargs,
             )
         )
     )
-    return permanence if permanence.empty else permanence.reset_index()
+    if contributions.empty:
+        return pd.DataFrame(columns=columns)
+    contributions = contributions.reset_index(level=by).reset_index(drop=True)
+    return (
+        pd.concat(
+            {
+                grouping.label: aggregate_permanence(
+                    contributions, grouping, by=by, split_intervals=split_intervals
+                )
+                for grouping in time_groupings
+            },
+            names=["period"],
+        )
+        .reset_index()
+        .rename(columns={"footprint": footprint_col, "time": time_col})[columns]
+    )
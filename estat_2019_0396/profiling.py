@@ -0,0 +1,131 @@
+"""Per-stage timing of the processing.
+
+The library functions report the time spent in each stage (and, for the
+digests, in each user) to the active Profiler, if any:
+
+    with profile() as profiler:
+        digest_multi_user(df)
+    print(profiler.report())
+
+Without an active profiler, stage() and user() do nothing.
+"""
+
+import contextlib
+import heapq
+import sys
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None  # type: ignore
+
+
+@dataclass
+class StageStats:
+    wall_time: float = 0.0
+    calls: int = 0
+    events: int = 0
+
+
+class Profiler:
+    def __init__(self, num_slowest_users: int = 10):
+        """Registry of the wall time and events of each stage.
+
+        Also keeps the *num_slowest_users* users that took longest to process.
+        """
+        self.stages: Dict[str, StageStats] = {}
+        self.num_slowest_users = num_slowest_users
+        self._users: List[Tuple[float, int, str, int]] = []
+        self._start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name: str, events: Optional[int] = None) -> Iterator[None]:
+        """Time the code run within the context as (part of) stage *name*."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats = self.stages.setdefault(name, StageStats())
+            stats.wall_time += time.perf_counter() - start
+            stats.calls += 1
+            stats.events += events or 0
+
+    @contextlib.contextmanager
+    def user(self, user, events: int) -> Iterator[None]:
+        """Time the processing of the *events* of *user*."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_user(user, time.perf_counter() - start, events)
+
+    def record_user(self, user, seconds: float, events: int) -> None:
+        entry = (seconds, len(self._users), str(user), events)
+        if len(self._users) < self.num_slowest_users:
+            heapq.heappush(self._users, entry)
+        elif self._users and seconds > self._users[0][0]:
+            heapq.heapreplace(self._users, entry)
+
+    def report(self) -> dict:
+        """Return the statistics as a JSON-serializable dict."""
+        return {
+            "wall_time": time.perf_counter() - self._start,
+            "peak_rss_mb": peak_rss_mb(),
+            "stages": {
+                name: {
+                    "wall_time": stats.wall_time,
+                    "calls": stats.calls,
+                    "events": stats.events,
+                    "events_per_second": (
+                        stats.events / stats.wall_time
+                        if stats.events and stats.wall_time
+                        else None
+                    ),
+                }
+                for name, stats in self.stages.items()
+            },
+            "slowest_users": [
+                {"user": user, "wall_time": seconds, "events": events}
+                for seconds, _, user, events in sorted(self._users, reverse=True)
+            ],
+        }
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Return the peak resident set size of the process in MiB, if known."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+_profiler: Optional[Profiler] = None
+
+
+@contextlib.contextmanager
+def profile(profiler: Optional[Profiler] = None) -> Iterator[Profiler]:
+    """Make *profiler* (or a new one) the active profiler within the context."""
+    global _profiler
+    previous, _profiler = _profiler, profiler or Profiler()
+    try:
+        yield _profiler
+    finally:
+        _profiler = previous
+
+
+def stage(name: str, events: Optional[int] = None):
+    """Report the time spent within the context to the active profiler."""
+    if _profiler is None:
+        return contextlib.nullcontext()
+    return _profiler.stage(name, events)
+
+
+def user(user, events: int):
+    """Report the time spent processing *user* to the active profiler."""
+    if _profiler is None:
+        return contextlib.nullcontext()
+    return _profiler.user(user, events)
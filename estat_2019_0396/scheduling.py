@@ -0,0 +1,95 @@
+"""Balancing of users across work units.
+
+The cost of digesting (or computing the permanence of) a user is roughly
+linear in its number of events, which is known up front from the group
+sizes. A few users (e.g. IoT SIMs) carry orders of magnitude more events
+than the rest, so users are packed into work units largest-first.
+"""
+
+import heapq
+from typing import Dict, List, Sequence
+
+import numpy as np
+import pandas as pd
+
+
+def user_costs(
+    df: pd.DataFrame, user_col: str = "user", user_props: List[str] = []
+) -> pd.Series:
+    """Return the number of events of each user, in the order of groupby."""
+    return df.groupby([user_col] + user_props, observed=True).size().rename("events")
+
+
+def cost_statistics(costs: pd.Series) -> Dict[str, float]:
+    """Return summary statistics of the per-user *costs* (see user_costs).
+
+    *top_1pct_share* is the fraction of the events of the 1% largest users.
+    """
+    if costs.empty:
+        return {"users": 0, "events": 0}
+    total = costs.sum()
+    largest = costs.sort_values(ascending=False)
+    return {
+        "users": len(costs),
+        "events": int(total),
+        "mean": float(costs.mean()),
+        "median": float(costs.median()),
+        "p99": float(costs.quantile(0.99)),
+        "max": int(largest.iloc[0]),
+        "max_share": float(largest.iloc[0] / total),
+        "top_1pct_share": float(
+            largest.iloc[: max(len(costs) // 100, 1)].sum() / total
+        ),
+    }
+
+
+def heavy_users(costs: pd.Series, factor: float = 100.0) -> pd.Index:
+    """Return the users with more than *factor* times the median cost."""
+    if costs.empty:
+        return costs.index
+    return costs.index[costs > factor * costs.median()]
+
+
+def pack_costs(costs: Sequence[float], num_units: int) -> np.ndarray:
+    """Assign each cost to one of *num_units* units, largest first.
+
+    Each cost goes to the unit with the lowest total so far (longest
+    processing time first), which is within 4/3 of the optimal makespan.
+    Returns the unit of each cost.
+    """
+    if num_units < 1:
+        raise ValueError(f"num_units must be positive, not {num_units}")
+    values = np.asarray(costs)
+    units = np.empty(values.shape[0], dtype="int64")
+    loads = [(0, unit) for unit in range(num_units)]
+    for item in np.argsort(-values, kind="stable"):
+        load, unit = heapq.heappop(loads)
+        units[item] = unit
+        heapq.heappush(loads, (load + values[item], unit))
+    return units
+
+
+def work_units(costs: pd.Series, num_units: int) -> pd.Series:
+    """Return the work unit of each user (see pack_costs)."""
+    return pd.Series(
+        pack_costs(costs.to_numpy(), num_units), index=costs.index, name="unit"
+    )
+
+
+def split_work_units(
+    df: pd.DataFrame,
+    num_units: int,
+    user_col: str = "user",
+    user_props: List[str] = [],
+) -> List[pd.DataFrame]:
+    """Split *df* into (at most) *num_units* frames with balanced numbers of events.
+
+    Every user is in a single frame. Rows with missing keys are dropped, as
+    in groupby.
+    """
+    groups = df.groupby([user_col] + user_props, observed=True)
+    codes = groups.ngroup().to_numpy()
+    units = np.append(pack_costs(groups.size().to_numpy(), num_units), -1)
+    # missing keys have code -1, i.e. the unit -1 appended above
+    row_units = units[codes]
+    return [df[row_units == unit] for unit in np.unique(units[:-1])]
@@ -0,0 +1,44 @@
+"""Time groupings of the permanence and the observation windows.
+
+Kept apart from the (pandas) computations so that the CLI can define its
+options without importing pandas.
+"""
+
+import enum
+from dataclasses import dataclass
+from typing import Tuple, Union
+
+
+class TimePeriod(enum.Enum):
+    daily = "D"
+    weekly = "W"
+    monthly = "M"
+
+    @property
+    def label(self) -> str:
+        return self.value
+
+
+@dataclass(frozen=True)
+class HourBins:
+    """Sub-daily periods that start at the given *hours* of every day.
+
+    E.g. HourBins((0, 8, 20)) splits each day into 00:00-08:00, 08:00-20:00
+    and 20:00-24:00. Times before the first hour belong to the last bin of
+    the previous day.
+    """
+
+    hours: Tuple[int, ...] = (0,)
+
+    def __post_init__(self):
+        hours = tuple(sorted(set(self.hours)))
+        if not hours or hours[0] < 0 or hours[-1] >= 24:
+            raise ValueError(f"hours must be in [0, 24), got {self.hours}")
+        object.__setattr__(self, "hours", hours)
+
+    @property
+    def label(self) -> str:
+        return "H" + "-".join(str(hour) for hour in self.hours)
+
+
+TimeGrouping = Union[TimePeriod, HourBins]
@@ -0,0 +1,110 @@
+"""Validation and cleanup of the events before digesting.
+
+The engines expect the events of each user to be ordered in time, and fail
+on the first unordered event, possibly late in a long run. validate_events
+checks all the events at once, with vectorized operations, and drops the
+events that cannot be digested (without a user, a time or a cell) and the
+exact duplicates (same user, time and cell), which would be counted twice.
+"""
+
+from typing import Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .digest_generation import UnorderedEventsError
+
+KEYS = ("user", "time", "cell")
+
+
+def _codes(values: pd.Series) -> Tuple[np.ndarray, int]:
+    # -1 for null values
+    codes, uniques = pd.factorize(values)
+    return codes, len(uniques)
+
+
+def event_flags(df: pd.DataFrame, keys: Tuple[str, str, str] = KEYS) -> pd.DataFrame:
+    """Return boolean columns flagging the invalid events of *df*.
+
+    null_user, null_time and null_cell flag the events without a user, a
+    time or a cell, duplicate the repetitions of a (user, time, cell) event,
+    and unordered the events earlier than the previous event of the same
+    user. *keys* are the user, time and cell columns.
+    """
+    user, time, cell = keys
+    user_codes, n_users = _codes(df[user])
+    time_codes, n_times = _codes(df[time])
+    cell_codes, n_cells = _codes(df[cell])
+    null_user = user_codes < 0
+    null_time = time_codes < 0
+    null_cell = cell_codes < 0
+    null = null_user | null_time | null_cell
+    # the codes are factorized once, and combined into a single key
+    if (n_users + 1) * (n_times + 1) * (n_cells + 1) < 2**63:
+        key = (user_codes + 1).astype("int64")
+        key = key * (n_times + 1) + time_codes + 1
+        key = key * (n_cells + 1) + cell_codes + 1
+        duplicate = pd.Series(key).duplicated().to_numpy()
+    else:
+        duplicate = df.duplicated(subset=list(keys)).to_numpy()
+    duplicate &= ~null
+    # the events of a user need not be contiguous
+    ordered = ~null_time & ~null_user
+    diffs = (
+        pd.Series(df[time].to_numpy()[ordered])
+        .groupby(user_codes[ordered], sort=False)
+        .diff()
+    )
+    unordered = np.zeros(len(df), dtype=bool)
+    unordered[ordered] = (diffs < pd.Timedelta(0)).to_numpy()
+    return pd.DataFrame(
+        {
+            "null_user": null_user,
+            "null_time": null_time,
+            "null_cell": null_cell,
+            "duplicate": duplicate,
+            "unordered": unordered,
+        },
+        index=df.index,
+    )
+
+
+def validate_events(
+    df: pd.DataFrame,
+    drop: bool = True,
+    require_ordered: bool = False,
+    keys: Tuple[str, str, str] = KEYS,
+) -> Tuple[pd.DataFrame, Dict[str, int]]:
+    """Check the events of *df*, returning them and the counts of each issue.
+
+    If *drop*, the events without a user, a time or a cell and the
+    duplicates are dropped. If *require_ordered*, raise UnorderedEventsError
+    if the events of a user are not ordered in time (e.g. before digesting
+    them with sort=False).
+    """
+    user, time, _ = keys
+    flags = event_flags(df, keys)
+    unordered = flags["unordered"].to_numpy()
+    unordered_users = df.loc[unordered, user].nunique()
+    if require_ordered and unordered_users:
+        first = np.flatnonzero(unordered)[0]
+        raise UnorderedEventsError(
+            f"events of {unordered_users} users are not ordered in time. Event "
+            f"{first} of user {df[user].iloc[first]} at {df[time].iloc[first]} "
+            "is earlier than the previous one."
+        )
+    invalid = flags[["null_user", "null_time", "null_cell", "duplicate"]].any(axis=1)
+    invalid = invalid.to_numpy()
+    report = {
+        "events": len(df),
+        "null_users": int(flags["null_user"].sum()),
+        "null_times": int(flags["null_time"].sum()),
+        "null_cells": int(flags["null_cell"].sum()),
+        "duplicates": int(flags["duplicate"].sum()),
+        "unordered_events": int(unordered.sum()),
+        "unordered_users": int(unordered_users),
+        "dropped": int(invalid.sum()) if drop else 0,
+    }
+    if drop and invalid.any():
+        df = df[~invalid]
+    return df, report
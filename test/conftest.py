@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+START = pd.Timestamp("2022-01-01")
+
+# bursts of events separated by long silences (seconds: probability)
+GAPS = {0: 0.1, 5: 0.4, 60: 0.2, 3600: 0.2, 10 * 3600: 0.1}
+
+
+def _choice(rng, values, n):
+    # *values* is a sequence, or a dict of the probability of each value
+    if isinstance(values, dict):
+        return rng.choice(list(values), n, p=list(values.values()))
+    return rng.choice(list(values), n)
+
+
+def random_events(
+    seed,
+    n=1000,
+    users=("u1", "u2", "u3"),
+    cells=("A", "B", "C"),
+    gaps=False,
+    span=3 * 24 * 3600,
+    resolution=1,
+    user_types=None,
+    tiles=False,
+):
+    """Return *n* random events of *users* in *cells*, generated from *seed*.
+
+    The times are uniform over *span* seconds, in steps of *resolution*
+    seconds, or if *gaps* the cumulative sum of random gaps (GAPS), so that
+    the events are ordered. *user_types* is a type for all the events or
+    types to choose from, and *tiles* adds a tile15 column of four tiles.
+    """
+    rng = np.random.default_rng(seed)
+    if gaps:
+        seconds = np.cumsum(_choice(rng, GAPS, n))
+    df = pd.DataFrame({"user": _choice(rng, users, n)})
+    if not gaps:
+        seconds = rng.integers(0, span // resolution, n) * resolution
+    df["time"] = START + pd.to_timedelta(seconds, unit="s")
+    df["cell"] = _choice(rng, cells, n)
+    if isinstance(user_types, str):
+        df["user_type"] = user_types
+    elif user_types is not None:
+        df["user_type"] = _choice(rng, user_types, n)
+    if tiles:
+        df["tile15"] = rng.integers(0, 4, n) + 2**29
+    return df
+
+
+@pytest.fixture()
+def make_events():
+    """Factory of random events frames (see random_events)."""
+    return random_events
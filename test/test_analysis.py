@@ -0,0 +1,124 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from estat_2019_0396.analysis import (
+    generate_digests_observation_window,
+    generate_digests_observation_windows,
+    observation_window_metadata,
+    split_window,
+)
+from estat_2019_0396.digest_pandas import digest_multi_user_clip
+from estat_2019_0396.permanence import TimePeriod
+
+
+@pytest.fixture()
+def random_events_df():
+    rng = np.random.default_rng(2022)
+    n = 400
+    return pd.DataFrame(
+        {
+            "user": rng.choice(["u1", "u2", "u3", "u4"], n),
+            "time": pd.Timestamp("2022-01-01")
+            + pd.to_timedelta(rng.integers(0, 10 * 24 * 3600, n), unit="s"),
+            "cell": rng.choice(["A", "B", "C"], n),
+            "user_type": "resident",
+        }
+    )
+
+
+def mask_metadata(events, ow_start, ow_end):
+    warmup_mask = events["time"] < ow_start
+    buffer_mask = events["time"] > ow_end
+    observation_mask = ~buffer_mask & ~warmup_mask
+    return {
+        name: {
+            "events": int(mask.sum()),
+            "users": events.loc[mask, "user"].nunique(),
+        }
+        for name, mask in [
+            ("warmup", warmup_mask),
+            ("buffer", buffer_mask),
+            ("observation", observation_mask),
+        ]
+    }
+
+
+@pytest.mark.parametrize(
+    "ow_start, ow_end",
+    [
+        (datetime.datetime(2022, 1, 3), datetime.datetime(2022, 1, 5)),
+        (datetime.datetime(2021, 12, 1), datetime.datetime(2022, 2, 1)),
+        (datetime.datetime(2022, 1, 9, 23), datetime.datetime(2022, 1, 10)),
+    ],
+)
+def test_observation_window_metadata(random_events_df, ow_start, ow_end):
+    events = random_events_df.sort_values(by=["user", "time"])
+    meta = observation_window_metadata(events, ow_start, ow_end)
+    expected = mask_metadata(random_events_df, ow_start, ow_end)
+    for part, values in expected.items():
+        for key, value in values.items():
+            assert meta[part][key] == value
+    assert meta["observation"]["duration"] == (ow_end - ow_start).total_seconds()
+    assert meta["warmup"]["duration"] == (
+        ow_start - random_events_df["time"].min()
+    ) / pd.Timedelta("1s")
+
+
+def test_generate_digests_observation_window(random_events_df):
+    ow_start = datetime.datetime(2022, 1, 3)
+    ow_end = datetime.datetime(2022, 1, 5)
+    digests, meta = generate_digests_observation_window(
+        random_events_df, ow_start, ow_end, user_props=["user_type"]
+    )
+    expected = digest_multi_user_clip(
+        random_events_df, ow_start, ow_end, user_props=["user_type"]
+    )
+    pd.testing.assert_frame_equal(digests, expected)
+    assert set(meta) == {"warmup", "buffer", "observation"}
+
+
+def test_generate_digests_observation_windows(random_events_df):
+    windows = [
+        (datetime.datetime(2022, 1, 3), datetime.datetime(2022, 1, 5)),
+        (datetime.datetime(2022, 1, 4), datetime.datetime(2022, 1, 8)),
+        (datetime.datetime(2022, 1, 9, 12), datetime.datetime(2022, 1, 9, 18)),
+        (datetime.datetime(2023, 1, 1), datetime.datetime(2023, 1, 2)),
+    ]
+    digests, meta = generate_digests_observation_windows(
+        random_events_df, windows, user_props=["user_type"]
+    )
+    assert list(digests.columns[:4]) == ["window", "user", "user_type", "digest_id"]
+    assert len(meta) == len(windows)
+    for window, (ow_start, ow_end) in enumerate(windows):
+        expected, expected_meta = generate_digests_observation_window(
+            random_events_df, ow_start, ow_end, user_props=["user_type"]
+        )
+        result = digests[digests["window"] == window].drop(columns="window")
+        if expected.empty:
+            assert result.empty
+            continue
+        pd.testing.assert_frame_equal(result.reset_index(drop=True), expected)
+        assert meta[window]["observation"] == expected_meta["observation"]
+        assert meta[window]["window"]["start"] == str(ow_start)
+
+
+def test_split_window():
+    windows = split_window(
+        datetime.datetime(2022, 1, 1, 12),
+        datetime.datetime(2022, 1, 3, 12),
+        TimePeriod.daily,
+    )
+    assert windows == [
+        (
+            pd.Timestamp("2022-01-01 12:00"),
+            pd.Timestamp("2022-01-01 23:59:59.999999999"),
+        ),
+        (
+            pd.Timestamp("2022-01-02 00:00"),
+            pd.Timestamp("2022-01-02 23:59:59.999999999"),
+        ),
+        (pd.Timestamp("2022-01-03 00:00"), pd.Timestamp("2022-01-03 12:00")),
+    ]
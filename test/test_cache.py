@@ -0,0 +1,169 @@
+import os
+
+import pandas as pd
+import pytest
+
+from estat_2019_0396.cache import (
+    ResultCache,
+    cache_key,
+    columns_from_json,
+    columns_to_json,
+    file_fingerprint,
+    read_csv_cached,
+    sidecar_path,
+)
+
+
+@pytest.fixture()
+def result_df():
+    return pd.DataFrame(
+        {
+            "user": ["u1", "u1", "u2"],
+            "start_time": pd.to_datetime(
+                ["2022-01-01 10:00", "2022-01-01 11:00", "2022-01-02 09:00"]
+            ).tz_localize("Europe/Madrid"),
+            "num_events": [3, 1, 7],
+            "events_in_cell": [{"A": 2, "B": 1}, {"A": 1}, {"C": 7}],
+        }
+    )
+
+
+def test_file_fingerprint(tmp_path):
+    path = tmp_path / "events.csv"
+    path.write_text("user,time,cell\n")
+    fingerprint = file_fingerprint(path)
+    assert file_fingerprint(path) == fingerprint
+    os.utime(path, ns=(0, 0))
+    assert file_fingerprint(path) != fingerprint
+
+    copy = tmp_path / "copy.csv"
+    copy.write_text("user,time,cell\n")
+    assert file_fingerprint(copy, content=True) == file_fingerprint(path, content=True)
+
+
+def test_cache_key():
+    fingerprint = {"size": 1, "sha256": "abc"}
+    key = cache_key("presence", fingerprint, {"zoom": 15, "split": False})
+    assert key == cache_key("presence", fingerprint, {"split": False, "zoom": 15})
+    assert key != cache_key("analysis", fingerprint, {"zoom": 15, "split": False})
+    assert key != cache_key("presence", fingerprint, {"zoom": 14, "split": False})
+
+
+def test_result_cache(tmp_path, result_df):
+    cache = ResultCache(tmp_path)
+    assert cache.get("key") is None
+
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return result_df, {"users": 2}
+
+    for _ in range(2):
+        df, metadata = cache.cached("key", compute)
+        pd.testing.assert_frame_equal(df, result_df)
+        assert metadata == {"users": 2}
+    assert len(calls) == 1
+
+    cache.put("other", result_df.assign(events_in_cell=[{1: 3}, {2: 1}, {1: 7}]))
+    df, metadata = cache.get("other")
+    assert df["events_in_cell"].tolist() == [{1: 3}, {2: 1}, {1: 7}]
+    assert metadata is None
+
+
+def test_result_cache_eviction(tmp_path, result_df):
+    cache = ResultCache(tmp_path)
+    cache.put("a", result_df)
+    cache.max_bytes = 2 * cache.path("a").stat().st_size
+    cache.put("b", result_df)
+    os.utime(cache.path("a"), ns=(0, 0))
+    os.utime(cache.path("b"), ns=(1, 1))
+    # a is read, so b is now the least recently used
+    assert cache.get("a") is not None
+    cache.put("c", result_df)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+
+
+def test_result_cache_unsupported(tmp_path, result_df):
+    cache = ResultCache(tmp_path)
+    df = result_df.assign(events_in_cell=[{1: 2}, {"A": 1}, {2: 7}])
+    with pytest.warns(UserWarning):
+        assert cache.cached("key", lambda: (df, None))[0] is df
+    assert cache.get("key") is None
+
+
+def test_result_cache_multiindex_columns(tmp_path):
+    # as returned by permanence_multi_user
+    df = pd.DataFrame(
+        [["u1", 10.0, 20.0], ["u2", 0.0, 5.5]],
+        columns=pd.MultiIndex.from_tuples(
+            [("user", pd.NaT), (1000, pd.Timestamp("2022-01-01")), (1001, pd.NaT)],
+            names=["tile15", "time"],
+        ),
+    )
+    cache = ResultCache(tmp_path)
+    cache.put("key", df)
+    pd.testing.assert_frame_equal(cache.get("key")[0], df)
+
+
+@pytest.mark.parametrize(
+    "columns",
+    [
+        pd.Index(["user", "num_events"]),
+        pd.Index([1000, 1001], name="tile15"),
+        pd.DatetimeIndex(["2022-01-01", None], tz="Europe/Madrid", name="time"),
+        pd.MultiIndex.from_tuples(
+            [("user", pd.NaT), (1000, pd.Timestamp("2022-01-01"))],
+            names=["tile15", "time"],
+        ),
+    ],
+)
+def test_columns_json(columns):
+    pd.testing.assert_index_equal(columns_from_json(columns_to_json(columns)), columns)
+
+
+@pytest.mark.parametrize("damage", ["truncate", "garbage", "metadata"])
+def test_result_cache_unreadable(tmp_path, result_df, damage):
+    cache = ResultCache(tmp_path)
+    cache.put("key", result_df)
+    path = cache.path("key")
+    if damage == "truncate":
+        path.write_bytes(path.read_bytes()[: path.stat().st_size // 2])
+    elif damage == "garbage":
+        path.write_bytes(b"PAR1" + os.urandom(100) + b"PAR1")
+    else:  # written by another program
+        result_df.drop(columns="events_in_cell").to_parquet(path)
+    with pytest.warns(UserWarning, match="unreadable"):
+        assert cache.get("key") is None
+    assert not path.exists()
+    cache.cached("key", lambda: (result_df, None))
+    pd.testing.assert_frame_equal(cache.get("key")[0], result_df)
+
+
+@pytest.mark.parametrize("in_directory", [False, True])
+def test_read_csv_cached(tmp_path, in_directory):
+    path = tmp_path / "events.csv"
+    path.write_text("user,time,cell\nu1,2022-01-01 10:00:00,A\n")
+    directory = tmp_path / "sidecars" if in_directory else None
+    sidecar = sidecar_path(path, directory)
+    assert not sidecar.exists()
+
+    df = read_csv_cached(path, directory, parse_dates=["time"])
+    pd.testing.assert_frame_equal(df, pd.read_csv(path, parse_dates=["time"]))
+    assert sidecar.exists()
+    assert sidecar.parent == (tmp_path / "sidecars" if in_directory else tmp_path)
+
+    # read from the sidecar while the CSV does not change
+    mtime = sidecar.stat().st_mtime_ns
+    pd.testing.assert_frame_equal(
+        read_csv_cached(path, directory, parse_dates=["time"]), df
+    )
+    assert sidecar.stat().st_mtime_ns == mtime
+
+    # parsed again with other arguments
+    assert read_csv_cached(path, directory)["time"].dtype == object
+    path.write_text("user,time,cell\nu2,2022-01-01 10:00:00,B\n")
+    os.utime(path, ns=(0, 0))
+    assert read_csv_cached(path, directory)["user"].tolist() == ["u2"]
@@ -0,0 +1,136 @@
+import bz2
+import gzip
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from typer.testing import CliRunner
+
+from estat_2019_0396.__main__ import app
+from estat_2019_0396.compression import (
+    CompressedWriter,
+    delta_encoding_supported,
+    write_parquet,
+)
+from estat_2019_0396.digest_pandas import digest_multi_user
+
+
+def decompress(path, codec):
+    if codec == "gzip":
+        return gzip.decompress(path.read_bytes())
+    elif codec == "bz2":
+        return bz2.decompress(path.read_bytes())
+    with pa.input_stream(str(path), compression=codec) as f:
+        return f.read()
+
+
+@pytest.fixture()
+def events_df(make_events):
+    return make_events(49)
+
+
+@pytest.mark.parametrize("codec", ["gzip", "bz2", "zstd", "lz4"])
+def test_compressed_writer(tmp_path, codec):
+    data = np.random.default_rng(0).bytes(10_000) * 3
+    path = tmp_path / f"data.{codec}"
+    with CompressedWriter(open(path, "wb"), codec, threads=3, block_size=1000) as f:
+        for start in range(0, len(data), 777):
+            assert f.write(data[start : start + 777]) == len(data[start : start + 777])
+        f.flush()
+        assert decompress(path, codec) == data
+        f.write(b"end")
+    assert decompress(path, codec) == data + b"end"
+
+
+def test_compressed_writer_level(tmp_path):
+    data = b"0123456789" * 100_000
+    sizes = []
+    for level in [1, 19]:
+        path = tmp_path / f"{level}.zst"
+        with CompressedWriter(open(path, "wb"), "zstd", level=level) as f:
+            f.write(data)
+        sizes.append(path.stat().st_size)
+    assert sizes[1] < sizes[0]
+
+
+def test_write_parquet(events_df, tmp_path):
+    df = digest_multi_user(events_df)
+    path = tmp_path / "digests.parquet"
+    write_parquet(df.drop(columns="events_in_cell"), path, "zstd", 5)
+    pd.testing.assert_frame_equal(
+        pd.read_parquet(path), df.drop(columns="events_in_cell")
+    )
+    columns = pq.ParquetFile(path).metadata.row_group(0)
+    for i in range(columns.num_columns):
+        column = columns.column(i)
+        assert column.compression == "ZSTD"
+        if column.path_in_schema in ("start_time", "end_time") and (
+            delta_encoding_supported()
+        ):
+            assert "DELTA_BINARY_PACKED" in column.encodings
+        else:
+            assert "RLE_DICTIONARY" in column.encodings
+
+
+@pytest.mark.parametrize("output_format", ["csv", "jsonl"])
+@pytest.mark.parametrize("compression", ["zstd", "lz4", "gzip"])
+def test_cli_compression(events_df, tmp_path, output_format, compression):
+    events_df.to_csv(tmp_path / "events.csv", index=False)
+    output = tmp_path / f"digests.{output_format}.{compression}"
+    result = CliRunner().invoke(
+        app,
+        [
+            "digests",
+            str(tmp_path / "events.csv"),
+            "--output",
+            str(output),
+            "--input-format",
+            "csv",
+            "--output-format",
+            output_format,
+            "--compression",
+            compression,
+            "--compression-level",
+            "3",
+            "--compression-threads",
+            "2",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    expected = CliRunner().invoke(
+        app,
+        [
+            "digests",
+            str(tmp_path / "events.csv"),
+            "--input-format",
+            "csv",
+            "--output-format",
+            output_format,
+        ],
+    )
+    assert decompress(output, compression).decode() == expected.output[:-1]
+
+
+def test_cli_parquet_column_compression(events_df, tmp_path):
+    events_df.to_csv(tmp_path / "events.csv", index=False)
+    job = tmp_path / "job.json"
+    job.write_text(
+        '{"input": "events.csv", "outputs": [{"command": "digests",'
+        ' "output": "digests.parquet", "format": "parquet", "compression": "zstd",'
+        ' "column_compression": {"user": "lz4"}, "column_encoding": {"digest_id":'
+        ' "PLAIN"}}]}'
+    )
+    result = CliRunner().invoke(app, ["run-all", str(job)])
+    assert result.exit_code == 0, result.output
+    columns = pq.ParquetFile(tmp_path / "digests.parquet").metadata.row_group(0)
+    codecs = {
+        columns.column(i).path_in_schema: columns.column(i).compression
+        for i in range(columns.num_columns)
+    }
+    assert codecs["user"] == "LZ4"
+    assert codecs["start_cell"] == "ZSTD"
+    assert columns.column(1).path_in_schema == "digest_id"
+    assert "PLAIN" in columns.column(1).encodings
+    assert "RLE_DICTIONARY" not in columns.column(1).encodings
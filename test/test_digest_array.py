@@ -0,0 +1,127 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from estat_2019_0396 import digest_array
+from estat_2019_0396.digest_array import (
+    CLOSE,
+    LONG_ONE_CELL,
+    ONE_CELL,
+    THREE_CELL,
+    TWO_CELL,
+    digest_arrays,
+    split_segments,
+    transition_table,
+)
+from estat_2019_0396.digest_pandas import digest_multi_user
+
+
+@pytest.fixture()
+def random_events_df(make_events):
+    return make_events(
+        11,
+        n=2000,
+        users=["u1", "u2", "u3", "u4", "u5"],
+        cells={"A": 0.5, "B": 0.3, "C": 0.1, "D": 0.1},
+        gaps=True,
+    ).sample(frac=1, random_state=3)
+
+
+def test_transition_table():
+    table = transition_table()
+    # dt_class: 3 (dt < short_dt), 1 (dt < long_dt), 0 (otherwise)
+    assert table[ONE_CELL, 3, 0] == ONE_CELL
+    assert table[ONE_CELL, 3, 1] == TWO_CELL
+    assert table[ONE_CELL, 1, 0] == LONG_ONE_CELL
+    assert table[ONE_CELL, 1, 1] == CLOSE
+    assert table[TWO_CELL, 3, 1] == THREE_CELL
+    assert table[THREE_CELL, 3, 1] == CLOSE
+    assert table[LONG_ONE_CELL, 1, 0] == LONG_ONE_CELL
+    assert (table[:, 0] == CLOSE).all()
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        {},
+        {"short_dt": 3600},
+        {"short_dt": 20000, "long_dt": 30000, "cutoff": 40000},
+        {"long_dt": 60, "cutoff": 100},
+    ],
+)
+def test_numpy_engine(random_events_df, params):
+    expected = digest_multi_user(random_events_df, **params)
+    result = digest_multi_user(random_events_df, engine="numpy", **params)
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_numpy_engine_user_props(random_events_df):
+    df = random_events_df.assign(
+        time=random_events_df["time"].dt.tz_localize("Europe/Madrid"),
+        cell=random_events_df["cell"].map({"A": 1, "B": 2, "C": 3, "D": 4}),
+        prop=random_events_df["user"].str.upper(),
+    )
+    expected = digest_multi_user(df, user_props=["prop"])
+    result = digest_multi_user(df, user_props=["prop"], engine="numpy")
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_digest_arrays_empty():
+    digests = digest_arrays(
+        np.array([], dtype="int64"),
+        np.array([], dtype="int32"),
+        np.array([], dtype="int64"),
+        np.array([], dtype="int64"),
+    )
+    assert len(digests) == 0
+    assert digests.cells.shape == (0, 3)
+
+
+def test_digest_arrays_unordered():
+    times = np.array([0, 10, 5, 0, 1]) * 10**9
+    with pytest.raises(Exception, match="not ordered"):
+        digest_arrays(times, np.zeros(5), np.array([0, 3]), np.array([3, 5]))
+    # decreasing times between segments are fine
+    digests = digest_arrays(
+        times[[0, 1, 3, 4]], np.zeros(4), np.array([0, 2]), np.array([2, 4])
+    )
+    assert digests.segment.tolist() == [0, 1]
+    assert digests.num_events.tolist() == [2, 2]
+
+
+def test_digest_arrays_missing_times():
+    times = pd.DatetimeIndex(["2022-01-01 10:00", "2022-01-01 11:00", None]).asi8
+    with pytest.raises(ValueError, match="validate_events"):
+        digest_arrays(times, np.zeros(3), np.array([0]), np.array([3]))
+
+
+def test_split_segments():
+    times = np.array([0, 1, 12, 13, 30, 0, 50, 51])
+    starts, stops, segments = split_segments(
+        times, np.array([0, 5, 7]), np.array([5, 7, 8]), 10
+    )
+    assert starts.tolist() == [0, 2, 4, 5, 6, 7]
+    assert stops.tolist() == [2, 4, 5, 6, 7, 8]
+    assert segments.tolist() == [0, 0, 0, 1, 1, 2]
+
+
+@pytest.mark.parametrize("step_cost", [0, 20, 10**9])
+def test_numpy_engine_skewed_users(monkeypatch, step_cost):
+    # many short users and one long user, in lockstep or one event at a time
+    monkeypatch.setattr(digest_array, "STEP_COST_EVENTS", step_cost)
+    rng = np.random.default_rng(34)
+    users = np.repeat([f"u{i}" for i in range(51)], [20] * 50 + [3000])
+    seconds = np.concatenate(
+        [np.sort(rng.integers(0, 10 * 24 * 3600, 20)) for _ in range(50)]
+        + [np.cumsum(rng.choice([5, 60, 3600, 10 * 3600], 3000))]
+    )
+    df = pd.DataFrame(
+        {
+            "user": users,
+            "time": pd.Timestamp("2022-01-01") + pd.to_timedelta(seconds, unit="s"),
+            "cell": rng.choice(["A", "B", "C", "D"], len(users)),
+        }
+    )
+    expected = digest_multi_user(df)
+    result = digest_multi_user(df, engine="numpy")
+    pd.testing.assert_frame_equal(result, expected)
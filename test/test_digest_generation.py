@@ -1,10 +1,14 @@
 import dataclasses
 import datetime
+import itertools
 import json
 
+import numpy as np
+import pandas as pd
 import pytest
 
 from estat_2019_0396.digest_generation import (
+    MAX_CELLS,
     Digest,
     DigestEncoder,
     DigestType,
@@ -12,6 +16,8 @@ from estat_2019_0396.digest_generation import (
     digest_generation,
     digest_generation_dict,
     digest_generation_iter,
+    iter_digests,
+    iter_digests_dict,
 )
 
 
@@ -300,3 +306,79 @@ def test_digest_cutoff():
 def test_digest_empty():
     assert digest_generation([]) == []
     assert digest_generation_iter([], []) == []
+
+
+def test_digest_max_cells():
+    cells = "ABCDEABACDDBE" * 3
+    times = [
+        datetime.datetime(2022, 1, 1, 10, 0, 0) + datetime.timedelta(seconds=5 * i)
+        for i in range(len(cells))
+    ]
+    digests = digest_generation_iter(times, list(cells))
+    assert max(digest.num_cells for digest in digests) == MAX_CELLS
+    for digest in digests:
+        assert len(digest.events_in_cell) <= MAX_CELLS
+
+
+def test_iter_digests(algo_default_params):
+    elist = [
+        ["2022-01-01 10:00:00", "A"],
+        ["2022-01-01 10:00:05", "B"],
+        ["2022-01-01 10:00:10", "A"],
+        ["2022-01-01 12:00:00", "A"],
+        ["2022-01-01 12:00:01", "C"],
+        ["2022-01-02 12:00:00", "C"],
+    ]
+    times, cells = times_cells_from_str(elist)
+    digests = iter_digests(iter(times), iter(cells), **algo_default_params)
+    assert not isinstance(digests, list)
+    assert list(digests) == digest_generation_iter(times, cells, **algo_default_params)
+    assert list(
+        iter_digests_dict(events_from_str(elist), **algo_default_params)
+    ) == digest_generation(events_from_str(elist), **algo_default_params)
+
+
+def test_iter_digests_lazy():
+    # digests are yielded as soon as they are closed, even from endless streams
+    start = datetime.datetime(2022, 1, 1)
+    times = (start + datetime.timedelta(hours=10 * i) for i in itertools.count())
+    digests = iter_digests(times, itertools.repeat("A"))
+    first, second = itertools.islice(digests, 2)
+    assert first.start_time == first.end_time == start
+    assert second.start_time == start + datetime.timedelta(hours=10)
+
+
+def test_iter_digests_unequal():
+    times = [datetime.datetime(2022, 1, 1)] * 3
+    with pytest.raises(Exception, match="Unequal number of entries"):
+        list(iter_digests(times, ["A", "A"]))
+
+
+@pytest.mark.parametrize("tz", [None, "Europe/Madrid"])
+@pytest.mark.parametrize(
+    "params", [{}, {"short_dt": 3600}, {"long_dt": 60, "cutoff": 100}]
+)
+def test_digest_epoch_times(tz, params):
+    rng = np.random.default_rng(3)
+    seconds = np.cumsum(rng.choice([0, 5, 60, 3600, 10 * 3600], 500))
+    times = pd.Series(
+        pd.Timestamp("2022-01-01", tz=tz) + pd.to_timedelta(seconds, unit="s")
+    )
+    cells = pd.Series(rng.choice(["A", "B", "C", "D"], 500))
+    # datetime64 series are digested as int64 nanoseconds
+    digests = digest_generation_iter(times, cells, **params)
+    assert digests == digest_generation_iter(list(times), list(cells), **params)
+    assert all(isinstance(digest.start_time, pd.Timestamp) for digest in digests)
+    assert str(digests[0].start_time.tz) == str(times.dt.tz)
+
+
+def test_digest_epoch_times_unordered():
+    times = pd.Series(pd.to_datetime(["2022-01-01 10:00", "2022-01-01 09:00"]))
+    with pytest.raises(Exception, match="not ordered"):
+        digest_generation_iter(times, pd.Series(["A", "B"]))
+
+
+def test_digest_epoch_times_missing():
+    times = pd.Series(pd.to_datetime(["2022-01-01 10:00", None, "2022-01-01 11:00"]))
+    with pytest.raises(ValueError, match="1 events have no time"):
+        digest_generation_iter(times, pd.Series(["A", "B", "C"]))
@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from estat_2019_0396.digest_array import digest_arrays
+from estat_2019_0396.digest_generation import digest_generation_iter
+from estat_2019_0396.digest_numba import (
+    _digest_kernel,
+    digest_arrays_compiled,
+    digest_events_compiled,
+    digest_kernel,
+)
+from estat_2019_0396.digest_pandas import digest_multi_user, group_segments, time_values
+
+PARAMS = [
+    {},
+    {"short_dt": 3600},
+    {"short_dt": 20000, "long_dt": 30000, "cutoff": 40000},
+    {"long_dt": 60, "cutoff": 100},
+]
+
+
+@pytest.fixture()
+def random_events_df(make_events):
+    return make_events(
+        5,
+        n=2000,
+        users=["u1", "u2", "u3", "u4", "u5"],
+        cells={"A": 0.5, "B": 0.3, "C": 0.1, "D": 0.1},
+        gaps=True,
+    )
+
+
+@pytest.mark.parametrize("params", PARAMS)
+def test_kernel(random_events_df, params):
+    df, starts, stops = group_segments(
+        random_events_df.sort_values(by=["user", "time"]), ["user"]
+    )
+    times = time_values(df["time"])
+    cells = pd.factorize(df["cell"])[0]
+    expected = digest_arrays(times, cells, starts, stops, **params)
+    result = digest_arrays_compiled(
+        times, cells, starts, stops, kernel=_digest_kernel, **params
+    )
+    for name, values in vars(expected).items():
+        np.testing.assert_array_equal(vars(result)[name], values)
+
+
+@pytest.mark.parametrize("params", PARAMS)
+def test_kernel_single_user(random_events_df, params):
+    times = random_events_df["time"]
+    cells = random_events_df["cell"]
+    expected = digest_generation_iter(times, cells, **params)
+    result = digest_events_compiled(times, cells, kernel=_digest_kernel, **params)
+    assert result == expected
+
+
+def test_kernel_unordered():
+    times = pd.Series(pd.to_datetime(["2022-01-02", "2022-01-01"]))
+    with pytest.raises(Exception, match="not ordered"):
+        digest_events_compiled(times, pd.Series(["A", "A"]), kernel=_digest_kernel)
+
+
+@pytest.mark.parametrize("params", PARAMS[:2])
+def test_numba_engine(random_events_df, params):
+    # falls back to the python engine if numba is not installed
+    expected = digest_multi_user(random_events_df, **params)
+    result = digest_multi_user(random_events_df, engine="numba", **params)
+    pd.testing.assert_frame_equal(result, expected)
+    times = random_events_df["time"]
+    cells = random_events_df["cell"]
+    assert digest_generation_iter(
+        times, cells, engine="numba", **params
+    ) == digest_generation_iter(times, cells, **params)
+
+
+@pytest.mark.skipif(digest_kernel is None, reason="numba is not installed")
+def test_compiled_kernel(random_events_df):
+    times = random_events_df["time"]
+    cells = random_events_df["cell"]
+    assert digest_events_compiled(times, cells) == digest_events_compiled(
+        times, cells, kernel=_digest_kernel
+    )
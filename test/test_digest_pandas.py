@@ -1,10 +1,12 @@
 import datetime
 
+import numpy as np
 import pandas as pd
 import pytest
 
 from estat_2019_0396.digest_generation import Digest, DigestType
 from estat_2019_0396.digest_pandas import (
+    clip_bounds,
     clip_from_last_renewal,
     clip_until_first_renewal,
     digest_multi_user,
@@ -12,7 +14,11 @@ from estat_2019_0396.digest_pandas import (
     digest_single_user,
     digest_single_user_clip,
     digest_to_dataframe,
+    segment_bounds,
+    segment_ranges,
+    segment_searchsorted,
     series_to_events,
+    time_values,
 )
 
 
@@ -435,3 +441,87 @@ def test_digest_multi_user_clip_empty(simple_events_df, mixed_events_df):
         min_time=events_df["time"].max() + pd.Timedelta("1d"),
         max_time=events_df["time"].min() - pd.Timedelta("1d"),
     ).empty
+
+
+def test_segment_bounds():
+    starts, stops = segment_bounds(pd.Series(["a", "a", "b", "c", "c", "c", None]))
+    assert list(starts) == [0, 2, 3, 6]
+    assert list(stops) == [2, 3, 6, 7]
+    starts, stops = segment_bounds(pd.Series([], dtype=object))
+    assert starts.shape == stops.shape == (0,)
+
+
+def test_segment_searchsorted():
+    rng = np.random.default_rng(42)
+    lengths = rng.integers(0, 20, 50)
+    stops = np.cumsum(lengths)
+    starts = stops - lengths
+    values = np.concatenate([np.sort(rng.integers(0, 10, n)) for n in lengths])
+    for side in ["left", "right"]:
+        for value in [-1, 0, 4, 9, 10]:
+            expected = [
+                start + np.searchsorted(values[start:stop], value, side=side)
+                for start, stop in zip(starts, stops)
+            ]
+            result = segment_searchsorted(values, starts, stops, value, side=side)
+            assert list(result) == expected
+
+
+@pytest.fixture()
+def random_multi_user_df():
+    rng = np.random.default_rng(7)
+    n = 600
+    # bursts of events separated by long silences
+    seconds = np.cumsum(rng.choice([5, 60, 3600, 10 * 3600], n, p=[0.4, 0.3, 0.2, 0.1]))
+    return pd.DataFrame(
+        {
+            "user": rng.choice(["u1", "u2", "u3"], n),
+            "time": pd.Timestamp("2022-01-01") + pd.to_timedelta(seconds, unit="s"),
+            "cell": rng.choice(["A", "B", "C", "D"], n, p=[0.5, 0.3, 0.1, 0.1]),
+        }
+    ).sort_values(by=["user", "time"], ignore_index=True)
+
+
+@pytest.mark.parametrize("day", [3, 10, 20])
+def test_clip_bounds(random_multi_user_df, day):
+    df = random_multi_user_df
+    min_time = pd.Timestamp(2022, 1, day)
+    max_time = min_time + pd.Timedelta("2d")
+    renewal_dt = 8 * 60 * 60
+    starts, stops = segment_bounds(df["user"])
+    clip_start, clip_stop = clip_bounds(
+        time_values(df["time"]), starts, stops, min_time, max_time, renewal_dt
+    )
+    for user_start, user_stop, start, stop in zip(starts, stops, clip_start, clip_stop):
+        times = df["time"].iloc[user_start:user_stop]
+        warmup = times[times < min_time]
+        buffer = times[times > max_time]
+        expected_start = (
+            clip_from_last_renewal(warmup, renewal_dt)
+            if len(warmup)
+            else times.index[0]
+        )
+        expected_stop = (
+            clip_until_first_renewal(buffer, renewal_dt) + 1
+            if len(buffer)
+            else times.index[-1] + 1
+        )
+        assert (start, stop) == (expected_start, expected_stop)
+
+
+def test_digest_multi_user_clip_safe(random_multi_user_df):
+    min_time = pd.Timestamp("2022-01-08")
+    max_time = pd.Timestamp("2022-01-12")
+    df_clipped = digest_multi_user_clip(random_multi_user_df, min_time, max_time)
+    df_full = digest_multi_user(random_multi_user_df)
+    df_manual_clip = df_full[df_full["start_time"].between(min_time, max_time)]
+    df_manual_clip = df_manual_clip.assign(
+        digest_id=df_manual_clip.groupby("user").cumcount()
+    ).reset_index(drop=True)
+    assert len(df_clipped) > 0
+    pd.testing.assert_frame_equal(df_clipped, df_manual_clip)
+
+
+def test_segment_ranges():
+    ranges = segment_ranges(np.array([0, 5, 7, 7]), np.array([2, 5, 10, 8]))
+    assert list(ranges) == [0, 1, 7, 8, 9, 7]
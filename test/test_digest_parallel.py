@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from estat_2019_0396.digest_pandas import digest_multi_user
+from estat_2019_0396.digest_parallel import digest_multi_user_parallel, renewal_chunks
+
+
+@pytest.fixture()
+def heavy_user_df(make_events):
+    return make_events(
+        21,
+        n=3000,
+        users={"heavy": 0.8, "u1": 0.1, "u2": 0.1},
+        cells={"A": 0.5, "B": 0.3, "C": 0.1, "D": 0.1},
+        gaps=True,
+        user_types="sim",
+    ).sample(frac=1, random_state=4)
+
+
+def test_renewal_chunks():
+    seconds = np.array([0, 1, 100, 101, 102, 200, 201, 0, 100, 200])
+    times = seconds * 10**9
+    starts, stops = np.array([0, 7]), np.array([7, 10])
+    # renewals (gap > 50s) at 2 and 5, and at 8 and 9 in the second segment
+    chunk_starts, chunk_stops, segments = renewal_chunks(times, starts, stops, 50, 2)
+    assert chunk_starts.tolist() == [0, 2, 5, 7, 9]
+    assert chunk_stops.tolist() == [2, 5, 7, 9, 10]
+    assert segments.tolist() == [0, 0, 0, 1, 1]
+    # segments shorter than chunk_events are not split
+    chunk_starts, chunk_stops, segments = renewal_chunks(times, starts, stops, 50, 7)
+    assert chunk_starts.tolist() == [0, 7]
+    assert segments.tolist() == [0, 1]
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        {"max_workers": 1, "chunk_events": 100},
+        {"max_workers": 2, "chunk_events": 500},
+        {"max_workers": 1, "chunk_events": 100, "short_dt": 3600, "cutoff": 7200},
+        {"max_workers": 1, "chunk_events": 100, "engine": "numpy"},
+    ],
+)
+def test_digest_multi_user_parallel(heavy_user_df, params):
+    digest_params = {
+        name: value
+        for name, value in params.items()
+        if name not in ["max_workers", "chunk_events", "engine"]
+    }
+    expected = digest_multi_user(
+        heavy_user_df, user_props=["user_type"], **digest_params
+    )
+    result = digest_multi_user_parallel(
+        heavy_user_df, user_props=["user_type"], **params
+    )
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_digest_multi_user_parallel_empty(heavy_user_df):
+    result = digest_multi_user_parallel(heavy_user_df.iloc[:0], max_workers=1)
+    assert result.empty
+    assert "digest_id" in result.columns
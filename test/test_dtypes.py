@@ -0,0 +1,72 @@
+import pandas as pd
+import pytest
+
+from estat_2019_0396.digest_pandas import digest_multi_user
+from estat_2019_0396.dtypes import memory_report, optimize_dtypes
+from estat_2019_0396.permanence import TimePeriod, permanence_multi_user
+
+
+@pytest.fixture()
+def events_df(make_events):
+    return make_events(
+        45,
+        n=2000,
+        users=["u3", "u1", "u10", "u2"],
+        cells=["C", "A", "B"],
+        # users of several types, so that groups are not nested
+        user_types=["visitor", "resident"],
+        tiles=True,
+    )
+
+
+def test_optimize_dtypes(events_df):
+    df = optimize_dtypes(events_df)
+    for col in ["user", "cell", "user_type"]:
+        assert df[col].dtype == "category"
+        assert list(df[col].cat.categories) == sorted(events_df[col].unique())
+    assert df["tile15"].dtype == "int32"
+    assert df["time"].dtype == events_df["time"].dtype
+    pd.testing.assert_frame_equal(
+        df.astype(events_df.dtypes.to_dict()), events_df, check_categorical=False
+    )
+
+
+def test_optimize_dtypes_order(events_df):
+    df = optimize_dtypes(events_df)
+    for data in (df, events_df):
+        assert data.sort_values(["user", "time"]).index.equals(
+            events_df.sort_values(["user", "time"]).index
+        )
+    pd.testing.assert_frame_equal(
+        digest_multi_user(df, user_props=["user_type"]).astype(
+            {"user": object, "user_type": object}
+        ),
+        digest_multi_user(events_df, user_props=["user_type"]),
+    )
+    pd.testing.assert_frame_equal(
+        permanence_multi_user(
+            df,
+            footprint_col="tile15",
+            user_props=["user_type"],
+            time_grouping=TimePeriod.daily,
+        ),
+        permanence_multi_user(
+            events_df,
+            footprint_col="tile15",
+            user_props=["user_type"],
+            time_grouping=TimePeriod.daily,
+        ),
+        check_categorical=False,
+        check_dtype=False,
+    )
+
+
+def test_memory_report(events_df):
+    report = memory_report(events_df, optimize_dtypes(events_df))
+    total = report["total"]
+    assert total["saved_mb"] == pytest.approx(total["before_mb"] - total["after_mb"])
+    assert total["ratio"] > 4
+    assert report["columns"]["user"]["dtype"] == "category"
+    assert (
+        report["columns"]["time"]["before_mb"] == report["columns"]["time"]["after_mb"]
+    )
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from estat_2019_0396.digest_pandas import digest_multi_user
+from estat_2019_0396.external_sort import external_sort, merge_runs, sort_runs
+
+
+@pytest.fixture()
+def events_df(make_events):
+    # coarse times, so that many events tie
+    df = make_events(
+        4, n=3000, users=range(60), cells=range(8), span=3000 * 60, resolution=600
+    )
+    return df.assign(time=df["time"].dt.tz_localize("UTC"))
+
+
+def chunks(df, size):
+    return [df.iloc[i : i + size] for i in range(0, len(df), size)]
+
+
+@pytest.mark.parametrize("batch_size", [1, 250, 10_000])
+def test_external_sort(events_df, batch_size):
+    frames = list(external_sort(chunks(events_df, 700), batch_size=batch_size))
+    expected = events_df.sort_values(by=["user", "time"], ignore_index=True)
+    pd.testing.assert_frame_equal(pd.concat(frames, ignore_index=True), expected)
+    # every user is in a single frame
+    users = pd.concat([frame["user"].drop_duplicates() for frame in frames])
+    assert users.is_unique
+    assert all(len(frame) >= batch_size for frame in frames[:-1])
+
+
+def test_external_sort_empty(events_df):
+    assert list(external_sort([])) == []
+    assert list(external_sort([events_df.iloc[:0]])) == []
+
+
+def test_sort_runs_drops_missing_users(events_df, tmp_path):
+    df = events_df.astype({"user": "float"})
+    df.loc[:9, "user"] = np.nan
+    paths = sort_runs(chunks(df, 1000), tmp_path)
+    assert len(paths) == 3
+    merged = pd.concat(merge_runs(paths, batch_size=100), ignore_index=True)
+    assert len(merged) == len(df) - 10
+
+
+def test_external_sort_digests(events_df):
+    digests = pd.concat(
+        [
+            digest_multi_user(frame)
+            for frame in external_sort(chunks(events_df, 500), batch_size=400)
+        ],
+        ignore_index=True,
+    )
+    pd.testing.assert_frame_equal(digests, digest_multi_user(events_df))
@@ -0,0 +1,28 @@
+import subprocess
+import sys
+
+import pytest
+
+import estat_2019_0396
+
+
+@pytest.mark.parametrize("module", ["estat_2019_0396", "estat_2019_0396.__main__"])
+def test_import_is_lazy(module):
+    # in a fresh interpreter, as the tests import pandas in this one
+    code = (
+        f"import sys, {module}; print(sorted({{'pandas', 'numpy'}} & set(sys.modules)))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == "[]"
+
+
+def test_lazy_attributes():
+    from estat_2019_0396 import digest_pandas, permanence
+
+    assert estat_2019_0396.digest_multi_user is digest_pandas.digest_multi_user
+    assert estat_2019_0396.TimePeriod is permanence.TimePeriod
+    assert set(estat_2019_0396.__all__) <= set(dir(estat_2019_0396))
+    with pytest.raises(AttributeError):
+        estat_2019_0396.missing
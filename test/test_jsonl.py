@@ -0,0 +1,114 @@
+import gzip
+import io
+import json
+
+import pandas as pd
+import pytest
+from typer.testing import CliRunner
+
+from estat_2019_0396 import jsonl
+from estat_2019_0396.__main__ import app
+from estat_2019_0396.digest_generation import DigestEncoder, iter_digests
+from estat_2019_0396.digest_pandas import digest_multi_user
+
+
+@pytest.fixture()
+def events_df(make_events):
+    return make_events(48).sort_values(["user", "time"], ignore_index=True)
+
+
+@pytest.fixture()
+def digests(events_df):
+    events = events_df[events_df["user"] == "u1"]
+    return list(iter_digests(events["time"], events["cell"]))
+
+
+def test_digest_encoder(digests):
+    digest = digests[0]
+    data = json.loads(json.dumps(digest, cls=DigestEncoder))
+    assert data["start_cell"] == digest.start_cell
+    assert data["events_in_cell"] == digest.events_in_cell
+    assert data["start_time"] == digest.start_time.isoformat()
+
+
+@pytest.mark.parametrize("batch_size", [1, 7, 10_000])
+def test_write_digests_jsonl(digests, monkeypatch, batch_size):
+    f = io.BytesIO()
+    assert jsonl.write_digests_jsonl(digests, f, batch_size=batch_size) == len(digests)
+    lines = f.getvalue().splitlines()
+    assert len(lines) == len(digests)
+    assert json.loads(lines[-1])["num_events"] == digests[-1].num_events
+
+    # the same bytes without orjson
+    monkeypatch.setattr(jsonl, "orjson", None)
+    fallback = io.BytesIO()
+    jsonl.write_digests_jsonl(digests, fallback, batch_size=batch_size)
+    assert fallback.getvalue() == f.getvalue()
+
+
+def test_dataframe_to_jsonl(events_df):
+    df = digest_multi_user(events_df)
+    df.loc[0, "end_cell"] = None
+    records = [json.loads(line) for line in jsonl.dataframe_to_jsonl(df).splitlines()]
+    expected = json.loads(df.to_json(orient="records", date_format="iso"))
+    for record in expected:
+        for col in ["start_time", "end_time"]:
+            record[col] = pd.Timestamp(record[col]).isoformat()
+    assert records == expected
+    assert records[0]["end_cell"] is None
+
+
+def test_dataframe_to_jsonl_tz():
+    df = pd.DataFrame(
+        {"time": pd.to_datetime(["2022-01-01 01:00", None]).tz_localize("CET")}
+    )
+    assert jsonl.dataframe_to_jsonl(df) == (
+        '{"time":"2022-01-01T00:00:00Z"}\n{"time":null}\n'
+    )
+    assert jsonl.dataframe_to_jsonl(df.iloc[:0]) == ""
+
+
+def test_write_dataframe_jsonl(events_df):
+    df = digest_multi_user(events_df)
+    f = io.BytesIO()
+    assert jsonl.write_dataframe_jsonl(df, f, batch_size=10) == len(df)
+    assert f.getvalue().decode() == jsonl.dataframe_to_jsonl(df)
+
+
+def test_cli_jsonl(events_df, tmp_path):
+    events_df.to_csv(tmp_path / "events.csv", index=False)
+    output = tmp_path / "digests.jsonl.gz"
+    result = CliRunner().invoke(
+        app,
+        [
+            "digests",
+            str(tmp_path / "events.csv"),
+            "--output",
+            str(output),
+            "--input-format",
+            "csv",
+            "--output-format",
+            "jsonl",
+            "--compression",
+            "gzip",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    expected = digest_multi_user(
+        pd.read_csv(tmp_path / "events.csv", parse_dates=["time"])
+    )
+    assert gzip.decompress(output.read_bytes()).decode() == jsonl.dataframe_to_jsonl(
+        expected
+    )
+
+
+@pytest.mark.parametrize("tz", [None, "Europe/Madrid"])
+def test_read_jsonl(events_df, tmp_path, tz):
+    df = events_df.assign(time=events_df["time"].dt.tz_localize(tz), tile15=2**29)
+    path = tmp_path / "events.jsonl.gz"
+    path.write_bytes(gzip.compress(jsonl.dataframe_to_jsonl(df).encode()))
+    expected = df if tz is None else df.assign(time=df["time"].dt.tz_convert("UTC"))
+    pd.testing.assert_frame_equal(jsonl.read_jsonl(path), expected)
+    chunks = list(jsonl.read_jsonl(path, chunksize=300))
+    assert [len(chunk) for chunk in chunks] == [300, 300, 300, 100]
+    pd.testing.assert_frame_equal(pd.concat(chunks), expected)
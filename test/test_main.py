@@ -0,0 +1,165 @@
+import datetime
+import json
+
+import pandas as pd
+import pytest
+from typer.testing import CliRunner
+
+from estat_2019_0396 import mercator
+from estat_2019_0396.__main__ import app
+from estat_2019_0396.analysis import generate_digests_observation_windows, split_window
+from estat_2019_0396.digest_pandas import digest_multi_user
+from estat_2019_0396.jsonl import dataframe_to_jsonl
+from estat_2019_0396.permanence import TimePeriod, permanence_multi_user
+
+runner = CliRunner()
+
+
+@pytest.fixture()
+def events_csv(make_events, tmp_path):
+    df = make_events(47, n=500, user_types="resident", tiles=True)
+    path = tmp_path / "events.csv"
+    df.to_csv(path, index=False)
+    return path
+
+
+def test_run_all(events_csv, tmp_path):
+    job = {
+        "input": events_csv.name,
+        "outputs": [
+            {"command": "digests", "output": "digests.csv"},
+            {
+                "command": "analysis",
+                "output": "ow.csv",
+                "meta": "ow.json",
+                "ow_start": "2022-01-01 12:00:00",
+                "ow_end": "2022-01-02 12:00:00",
+                "window_period": ["D"],
+            },
+            {"command": "presence", "output": "presence.csv", "split_intervals": True},
+        ],
+    }
+    job_file = tmp_path / "job.json"
+    job_file.write_text(json.dumps(job))
+    result = runner.invoke(app, ["run-all", str(job_file)])
+    assert result.exit_code == 0, result.output
+
+    df = pd.read_csv(events_csv, parse_dates=["time"])
+    expected = digest_multi_user(df, user_props=["user_type"])
+    assert (tmp_path / "digests.csv").read_text() == expected.to_csv(index=False)
+
+    ow_start = datetime.datetime(2022, 1, 1, 12)
+    ow_end = datetime.datetime(2022, 1, 2, 12)
+    windows = [(ow_start, ow_end)] + split_window(ow_start, ow_end, TimePeriod.daily)
+    expected, metadata = generate_digests_observation_windows(
+        df, windows, user_props=["user_type"]
+    )
+    assert (tmp_path / "ow.csv").read_text() == expected.to_csv(index=False)
+    assert json.loads((tmp_path / "ow.json").read_text()) == metadata
+
+    expected = permanence_multi_user(
+        df,
+        footprint_col="tile15",
+        user_props=["user_type"],
+        footprint_zoom=15,
+        time_grouping=TimePeriod.daily,
+        split_intervals=True,
+    )
+    assert (tmp_path / "presence.csv").read_text() == expected.to_csv(index=False)
+
+
+def test_run_all_yaml(events_csv, tmp_path):
+    pytest.importorskip("yaml")
+    job_file = tmp_path / "job.yaml"
+    job_file.write_text(
+        f"input: {events_csv.name}\n"
+        "optimize_dtypes: true\n"
+        "outputs:\n"
+        "  - command: digests\n"
+        "    output: digests.csv\n"
+        "    engine: numpy\n"
+    )
+    result = runner.invoke(app, ["run-all", str(job_file)])
+    assert result.exit_code == 0, result.output
+    assert len(pd.read_csv(tmp_path / "digests.csv")) == len(
+        digest_multi_user(pd.read_csv(events_csv, parse_dates=["time"]))
+    )
+
+
+def test_run_all_unknown_command(events_csv, tmp_path):
+    job_file = tmp_path / "job.json"
+    job_file.write_text(
+        json.dumps({"input": str(events_csv), "outputs": [{"command": "x"}]})
+    )
+    result = runner.invoke(app, ["run-all", str(job_file)])
+    assert isinstance(result.exception, NotImplementedError)
+
+
+def test_presence_geometry_file(events_csv, tmp_path, monkeypatch):
+    monkeypatch.setattr(mercator, "_GEOMETRY_TABLES", {})
+    geometry_file = tmp_path / "tile15.npz"
+    args = ["presence", str(events_csv), "--input-format", "csv"]
+    args += ["--output-format", "csv", "--geometry-file", str(geometry_file)]
+    first = runner.invoke(app, args)
+    assert first.exit_code == 0, first.output
+    table = mercator.TileGeometry.load(geometry_file)
+    tiles = pd.read_csv(events_csv)["tile15"].unique()
+    assert set(table.codes) == set(tiles)
+
+    monkeypatch.setattr(mercator, "_GEOMETRY_TABLES", {})
+    second = runner.invoke(app, args)
+    assert second.output == first.output
+    assert mercator.geometry_table(15).codes.tolist() == table.codes.tolist()
+
+
+@pytest.mark.parametrize("command", ["digests", "presence"])
+def test_chunksize_options(events_csv, tmp_path, command):
+    args = [command, str(events_csv), "--input-format", "csv"]
+    args += ["--output-format", "csv"]
+    expected = runner.invoke(app, args)
+    assert expected.exit_code == 0, expected.output
+    chunked = CliRunner(mix_stderr=False).invoke(
+        app, args + ["--chunksize", "100", "--optimize-dtypes"]
+    )
+    assert chunked.exit_code == 0, chunked.output
+    assert chunked.stdout == expected.output
+    # one report of the optimized dtypes per sorted frame
+    reports = [json.loads(line) for line in chunked.stderr.splitlines()]
+    assert len(reports) > 1
+    assert all(report["columns"]["user"]["dtype"] == "category" for report in reports)
+
+    result = runner.invoke(app, args + ["--chunksize", "100", "--sidecar"])
+    assert result.exit_code == 2
+    assert "Invalid value for --chunksize" in result.output
+
+
+@pytest.mark.parametrize("command", ["analysis", "presence"])
+def test_cache_key_options(events_csv, tmp_path, command):
+    args = [command, str(events_csv), "--input-format", "csv"]
+    args += ["--output-format", "csv", "--cache-dir", str(tmp_path / "cache")]
+    if command == "analysis":
+        args[1:1] = ["2022-01-01", "2022-01-02"]
+    for options in [[], [], ["--optimize-dtypes"], ["--validate"]]:
+        result = runner.invoke(app, args + options)
+        assert result.exit_code == 0, result.output
+    # one result per set of options that changes it
+    assert len(list((tmp_path / "cache").glob("*.parquet"))) == 3
+
+
+@pytest.mark.parametrize("chunksize", [None, 100])
+def test_jsonl_input(events_csv, tmp_path, chunksize):
+    events_jsonl = tmp_path / "events.jsonl"
+    events_jsonl.write_text(
+        dataframe_to_jsonl(pd.read_csv(events_csv, parse_dates=["time"]))
+    )
+    args = ["--output-format", "csv"]
+    if chunksize:
+        args += ["--chunksize", str(chunksize)]
+    expected = runner.invoke(
+        app, ["digests", str(events_csv), "--input-format", "csv"] + args
+    )
+    result = runner.invoke(
+        app, ["digests", str(events_jsonl), "--input-format", "jsonl"] + args
+    )
+    assert result.exit_code == 0, result.output
+    assert result.output == expected.output
@@ -1,4 +1,6 @@
+import numpy as np
 import pandas as pd
+import pytest
 
 from estat_2019_0396 import mercator
 
@@ -98,3 +100,137 @@ def test_distance_codes_zs():
         print(z, prev_distance, distance)
         assert distance < prev_distance
         prev_distance = distance
+
+
+def test_weighted_centroids_grouped():
+    lons = [0.0, 2.0, 10.0, 20.0]
+    lats = [0.0, 2.0, 10.0, 20.0]
+    codes = [0, 0, 1, 1]
+    mean_lons, mean_lats = mercator.weighted_centroids(lons, lats, codes)
+    assert list(mean_lons) == [1.0, 15.0]
+    assert list(mean_lats) == [1.0, 15.0]
+
+    weights = [1.0, 3.0, 1.0, 0.0]
+    mean_lons, mean_lats = mercator.weighted_centroids(
+        lons, lats, codes, weights=weights, num_groups=3
+    )
+    assert list(mean_lons[:2]) == [1.5, 10.0]
+    assert np.isnan(mean_lons[2])
+
+
+def test_weighted_centroids_antimeridian():
+    lons = [179.0, -179.0]
+    lats = [10.0, 10.0]
+    planar_lons, _ = mercator.weighted_centroids(lons, lats, [0, 0])
+    cartesian_lons, cartesian_lats = mercator.weighted_centroids(
+        lons, lats, [0, 0], cartesian=True
+    )
+    assert planar_lons[0] == 0
+    assert abs(abs(cartesian_lons[0]) - 180) < 1.0e-8
+    assert 10 < cartesian_lats[0] < 10.1
+
+
+def test_average_tiles():
+    xs = pd.Series([8, 8, 9, 12])
+    ys = pd.Series([6, 6, 6, 2])
+    grouping = pd.Series(["b", "b", "b", "a"], name="user")
+    lons, lats = mercator.average_tiles(xs, ys, 4, grouping=grouping)
+    assert list(lons.index) == ["a", "b"]
+    assert lons.index.name == "user"
+    expected = mercator.tile_to_lonlat(np.array([12.0]), np.array([2.0]), 4, True)
+    assert lons["a"] == expected[0][0]
+    assert lats["a"] == expected[1][0]
+    assert list(xs) == [8, 8, 9, 12]  # inputs are not modified
+
+    lon, lat = mercator.average_tiles(xs, ys, 4, weights=pd.Series([1, 0, 0, 0]))
+    expected = mercator.tile_to_lonlat(np.array([8.0]), np.array([6.0]), 4, True)
+    assert lon == expected[0][0]
+    assert lat == expected[1][0]
+
+
+def test_tile_geometry_lookup():
+    z = 15
+    ny = [-74.017161, 40.704705]
+    la = [-118.196496, 33.768214]
+    codes = mercator.encode(
+        np.array([ny[0], la[0], ny[0]]), np.array([ny[1], la[1], ny[1]]), z=z
+    )
+    table = mercator.TileGeometry(z)
+    lons, lats = mercator.decode(codes, z=z, geometry=table)
+    assert len(table) == 2
+    expected_lons, expected_lats = mercator.decode(codes, z=z)
+    assert np.allclose(lons, expected_lons)
+    assert np.allclose(lats, expected_lats)
+    lons, lats = mercator.decode(codes, z=z, center=False, geometry=table)
+    expected_lons, expected_lats = mercator.decode(codes, z=z, center=False)
+    assert np.allclose(lons, expected_lons)
+    assert np.allclose(lats, expected_lats)
+
+
+def test_tile_geometry_distance_codes():
+    x = 8
+    y = 6
+    z = 4
+    neighbors = pd.DataFrame(
+        [(x + dx, y + dy) for dx in range(-2, 3) for dy in range(-2, 3)],
+        columns=["x", "y"],
+    )
+    neighbors["code"] = neighbors["x"] * 2**z + neighbors["y"]
+    code1 = x * 2**z + y
+    table = mercator.TileGeometry(z)
+    expected = mercator.distance_codes(code1, neighbors["code"], z=z)
+    distance = mercator.distance_codes(code1, neighbors["code"], z=z, geometry=table)
+    assert np.allclose(distance, expected)
+    assert len(table) == neighbors.shape[0]
+
+
+def test_tile_geometry_average_tiles():
+    xs = pd.Series([8, 8, 9, 12])
+    ys = pd.Series([6, 6, 6, 2])
+    table = mercator.TileGeometry(4)
+    lon, lat = mercator.average_tiles(xs, ys, 4, geometry=table)
+    expected_lon, expected_lat = mercator.average_tiles(xs, ys, 4)
+    assert np.isclose(lon, expected_lon)
+    assert np.isclose(lat, expected_lat)
+
+
+def test_tile_geometry_zoom_mismatch():
+    with pytest.raises(ValueError):
+        mercator.decode(np.array([1]), z=15, geometry=mercator.TileGeometry(16))
+
+
+def test_tile_geometry_save_load(tmp_path):
+    table = mercator.TileGeometry(15)
+    table.index(np.array([5, 1, 2**20 + 7]))
+    path = tmp_path / "tile15.npz"
+    table.save(path)
+    loaded = mercator.TileGeometry.load(path)
+    assert loaded.z == 15
+    assert list(loaded.codes) == [1, 5, 2**20 + 7]
+    assert np.array_equal(loaded.values, table.values)
+
+
+def test_geometry_table_shared(tmp_path):
+    path = tmp_path / "tile7.npz"
+    mercator.TileGeometry(7).save(path)
+    assert mercator.geometry_table(7, path=path) is mercator.geometry_table(7)
+
+
+def test_tile_geometry_incremental():
+    codes = np.random.default_rng(27).integers(0, 2**30, 300).astype("uint64")
+    table = mercator.TileGeometry(15)
+    for batch in np.array_split(codes, 7):
+        table.index(batch)
+    expected = mercator.TileGeometry(15)
+    expected.index(codes)
+    assert np.array_equal(table.codes, np.unique(codes))
+    assert np.array_equal(table.values, expected.values)
+
+
+def test_geometry_table_max_rows(monkeypatch):
+    monkeypatch.setattr(mercator, "GEOMETRY_TABLE_MAX_ROWS", 2)
+    monkeypatch.setattr(mercator, "_GEOMETRY_TABLES", {})
+    table = mercator.geometry_table(9)
+    table.index(np.array([1, 2, 3]))
+    assert mercator.geometry_table(9) is not table
+    assert len(mercator.geometry_table(9)) == 0
@@ -2,7 +2,15 @@ import numpy as np
 import pandas as pd
 import pytest
 
-from estat_2019_0396.permanence import TimePeriod, get_permanence
+from estat_2019_0396 import mercator
+from estat_2019_0396.permanence import (
+    HourBins,
+    TimePeriod,
+    get_permanence,
+    period_starts,
+    permanence_multi_resolution,
+    permanence_multi_user,
+)
 
 
 @pytest.fixture()
@@ -201,3 +209,162 @@ def test_get_permanence_bydate(simple_events_multiday_df):
     )
     print("RESULT", p)
     assert p.shape == (1,)
+
+
+def test_get_permanence_footprint_zoom():
+    z = 15
+    elist = [
+        ["2022-01-01 10:00:00", (16384, 11000)],
+        ["2022-01-01 10:10:00", (16385, 11000)],
+        ["2022-01-01 10:20:00", (16384, 11001)],
+        ["2022-01-01 10:30:00", (16384, 11001)],
+        ["2022-01-01 11:00:00", (16400, 11050)],
+        ["2022-01-01 11:10:00", (16384, 11000)],
+    ]
+    times = pd.to_datetime([e[0] for e in elist]).to_series()
+    codes = pd.Series([x * 2**z + y for _, (x, y) in elist])
+
+    def series_distance(c1, c2):
+        return pd.Series(mercator.distance_codes(c1, c2, z=z))
+
+    expected = get_permanence(codes, times, distance_func=series_distance)
+    p = get_permanence(codes, times, footprint_zoom=z)
+    print("RESULT", p)
+    assert p.shape == (3,)
+    pd.testing.assert_series_equal(p, expected)
+    assert not get_permanence(codes, times).equals(p)
+
+
+def test_permanence_multi_user_prefetch_geometry(monkeypatch):
+    monkeypatch.setattr(mercator, "_GEOMETRY_TABLES", {})
+    added = []
+    add = mercator.TileGeometry._add
+    monkeypatch.setattr(
+        mercator.TileGeometry,
+        "_add",
+        lambda self, codes: added.append(len(codes)) or add(self, codes),
+    )
+    rng = np.random.default_rng(28)
+    n = 300
+    df = pd.DataFrame(
+        {
+            "user": rng.choice([f"u{i}" for i in range(20)], n),
+            "time": pd.Timestamp("2022-01-01")
+            + pd.to_timedelta(rng.integers(0, 24 * 3600, n), unit="s"),
+            "tile15": rng.integers(0, 50, n) + 2**29,
+        }
+    )
+    permanence_multi_user(df, footprint_col="tile15", footprint_zoom=15)
+    # all the tiles are added at once, not user by user
+    assert added == [df["tile15"].nunique()]
+
+
+@pytest.fixture()
+def random_times():
+    rng = np.random.default_rng(1234)
+    return pd.Series(
+        pd.Timestamp("2021-12-01")
+        + pd.to_timedelta(rng.integers(0, 90 * 24 * 3600, 500), unit="s"),
+        name="time",
+    )
+
+
+@pytest.mark.parametrize("grouping", list(TimePeriod))
+def test_period_starts(random_times, grouping):
+    expected = random_times.dt.to_period(grouping.value).dt.start_time
+    pd.testing.assert_series_equal(period_starts(random_times, grouping), expected)
+
+
+def test_period_starts_hour_bins():
+    times = pd.Series(
+        pd.to_datetime(
+            ["2022-01-02 03:00:00", "2022-01-02 08:00:00", "2022-01-02 23:59:59"]
+        )
+    )
+    starts = period_starts(times, HourBins((20, 8)))
+    assert list(starts) == list(
+        pd.to_datetime(
+            ["2022-01-01 20:00:00", "2022-01-02 08:00:00", "2022-01-02 20:00:00"]
+        )
+    )
+    assert HourBins((20, 8)).label == "H8-20"
+    with pytest.raises(ValueError):
+        HourBins((24,))
+
+
+def test_permanence_multi_resolution(simple_events_multiday_df, mixed_events_df):
+    df = pd.concat(
+        {"Agent1": simple_events_multiday_df, "Agent2": mixed_events_df},
+        names=["user"],
+    ).reset_index(level="user")
+    groupings = [TimePeriod.daily, TimePeriod.weekly, HourBins((0, 12))]
+    p = permanence_multi_resolution(df, groupings)
+    print("RESULT", p)
+    assert list(p.columns) == ["user", "period", "cell", "time", "permanence_time"]
+    assert set(p["period"]) == {"D", "W", "H0-12"}
+    for grouping in groupings:
+        expected = permanence_multi_user(df, time_grouping=grouping)
+        result = p[p["period"] == grouping.label].drop(columns="period")
+        pd.testing.assert_frame_equal(result.reset_index(drop=True), expected)
+
+
+def test_permanence_multi_resolution_empty():
+    df = pd.DataFrame(
+        {"user": ["A"], "time": pd.to_datetime(["2022-01-01"]), "cell": ["A"]}
+    )
+    assert permanence_multi_resolution(df, [TimePeriod.daily]).empty
+
+
+def test_get_permanence_split_intervals():
+    elist = [
+        ["2022-01-01 23:00:00", "A"],
+        ["2022-01-02 07:00:00", "A"],
+        ["2022-01-02 07:10:00", "B"],
+    ]
+    times = pd.to_datetime([e[0] for e in elist]).to_series()
+    cells = pd.Series([e[1] for e in elist], name="cell")
+    p = get_permanence(cells, times, time_grouping=TimePeriod.daily)
+    print("RESULT", p)
+    assert p.shape == (1,)
+    assert p[("A", pd.Timestamp("2022-01-02"))] == 8 * 60 * 60
+
+    p = get_permanence(
+        cells, times, time_grouping=TimePeriod.daily, split_intervals=True
+    )
+    print("RESULT", p)
+    assert p.shape == (2,)
+    assert p[("A", pd.Timestamp("2022-01-01"))] == 1 * 60 * 60
+    assert p[("A", pd.Timestamp("2022-01-02"))] == 7 * 60 * 60
+
+
+def test_get_permanence_split_intervals_semi_times(zero_distance):
+    elist = [
+        ["2022-01-01 10:00:00", "A"],
+        ["2022-01-01 11:50:00", "B"],
+        ["2022-01-01 12:30:00", "A"],
+    ]
+    times = pd.to_datetime([e[0] for e in elist]).to_series()
+    cells = pd.Series([e[1] for e in elist])
+    p = get_permanence(
+        cells,
+        times,
+        distance_func=zero_distance,
+        semi_time_threshold=999999,
+        time_grouping=HourBins((0, 12)),
+        split_intervals=True,
+    )
+    print("RESULT", p)
+    assert p[("B", pd.Timestamp("2022-01-01 00:00:00"))] == (55 + 10) * 60
+    assert p[("B", pd.Timestamp("2022-01-01 12:00:00"))] == 10 * 60
+
+
+def test_get_permanence_split_intervals_total(random_times):
+    cells = pd.Series(np.where(np.arange(500) % 7 < 5, "A", "B"))
+    times = random_times.sort_values().reset_index(drop=True)
+    for grouping in [TimePeriod.weekly, TimePeriod.monthly, HourBins((6, 18))]:
+        p = get_permanence(cells, times, time_grouping=grouping)
+        p_split = get_permanence(
+            cells, times, time_grouping=grouping, split_intervals=True
+        )
+        assert np.isclose(p.sum(), p_split.sum())
+        assert p_split.shape[0] >= p.shape[0]
@@ -0,0 +1,58 @@
+import json
+
+import pandas as pd
+
+from estat_2019_0396 import profiling
+from estat_2019_0396.digest_pandas import digest_multi_user
+
+
+def test_stage():
+    with profiling.profile() as profiler:
+        for _ in range(3):
+            with profiling.stage("work", events=10):
+                pass
+    stats = profiler.stages["work"]
+    assert stats.calls == 3
+    assert stats.events == 30
+    assert stats.wall_time >= 0
+    # without an active profiler, stages are not recorded
+    with profiling.stage("work", events=10):
+        pass
+    assert profiler.stages["work"].calls == 3
+
+
+def test_nested_profiles():
+    with profiling.profile() as outer:
+        with profiling.profile() as inner:
+            with profiling.stage("inner"):
+                pass
+        with profiling.stage("outer"):
+            pass
+    assert list(inner.stages) == ["inner"]
+    assert list(outer.stages) == ["outer"]
+
+
+def test_slowest_users():
+    profiler = profiling.Profiler(num_slowest_users=2)
+    for user, seconds in [("a", 1.0), ("b", 3.0), ("c", 2.0), ("d", 0.5)]:
+        profiler.record_user(user, seconds, events=1)
+    report = profiler.report()
+    assert [entry["user"] for entry in report["slowest_users"]] == ["b", "c"]
+
+
+def test_profile_digest_multi_user():
+    events = pd.DataFrame(
+        {
+            "user": ["a"] * 3 + ["b"] * 2,
+            "time": pd.date_range("2022-01-01", periods=5, freq="1H"),
+            "cell": list("AABBA"),
+        }
+    )
+    with profiling.profile() as profiler:
+        digest_multi_user(events)
+    report = json.loads(json.dumps(profiler.report()))
+    assert {"sort_values", "digest", "digest_generation"} <= set(report["stages"])
+    assert report["stages"]["digest"]["events"] == 5
+    assert report["stages"]["digest_generation"]["calls"] == 2
+    assert sorted(user["events"] for user in report["slowest_users"]) == [2, 3]
+    assert report["peak_rss_mb"] > 0
@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from estat_2019_0396.scheduling import (
+    cost_statistics,
+    heavy_users,
+    pack_costs,
+    split_work_units,
+    user_costs,
+    work_units,
+)
+
+
+@pytest.fixture()
+def skewed_events_df():
+    rng = np.random.default_rng(9)
+    # a few heavy users among many light ones
+    sizes = np.concatenate([rng.integers(1, 20, 200), [5000, 3000]])
+    users = np.repeat([f"u{i}" for i in range(sizes.shape[0])], sizes)
+    return pd.DataFrame(
+        {
+            "user": users,
+            "user_type": np.where(np.char.endswith(users.astype(str), "0"), "a", "b"),
+            "time": pd.Timestamp("2022-01-01")
+            + pd.to_timedelta(np.arange(users.shape[0]), unit="s"),
+        }
+    ).sample(frac=1, random_state=1)
+
+
+def test_user_costs(skewed_events_df):
+    costs = user_costs(skewed_events_df, user_props=["user_type"])
+    assert costs.sum() == len(skewed_events_df)
+    assert costs.index.names == ["user", "user_type"]
+    assert costs.max() == 5000
+
+
+def test_cost_statistics(skewed_events_df):
+    stats = cost_statistics(user_costs(skewed_events_df))
+    assert stats["users"] == 202
+    assert stats["events"] == len(skewed_events_df)
+    assert stats["max"] == 5000
+    assert stats["max_share"] == pytest.approx(5000 / len(skewed_events_df))
+    assert stats["top_1pct_share"] == pytest.approx(8000 / len(skewed_events_df))
+    assert cost_statistics(user_costs(skewed_events_df.iloc[:0]))["users"] == 0
+
+
+def test_heavy_users(skewed_events_df):
+    heavy = heavy_users(user_costs(skewed_events_df), factor=50)
+    assert sorted(heavy) == ["u200", "u201"]
+
+
+def test_pack_costs():
+    units = pack_costs([1, 7, 3, 5, 2, 2], 3)
+    loads = np.bincount(units, weights=[1, 7, 3, 5, 2, 2])
+    assert sorted(loads) == [6, 7, 7]
+    with pytest.raises(ValueError):
+        pack_costs([1], 0)
+
+
+def test_work_units(skewed_events_df):
+    costs = user_costs(skewed_events_df)
+    units = work_units(costs, 4)
+    loads = costs.groupby(units).sum()
+    # the heaviest users get their own units
+    assert units["u200"] != units["u201"]
+    assert loads.max() == 5000
+
+
+def test_split_work_units(skewed_events_df):
+    parts = split_work_units(skewed_events_df, 4)
+    assert len(parts) == 4
+    assert sum(len(part) for part in parts) == len(skewed_events_df)
+    users = [set(part["user"]) for part in parts]
+    assert sum(len(part) for part in users) == len(set.union(*users))
+    assert split_work_units(skewed_events_df.iloc[:0], 4) == []
@@ -0,0 +1,120 @@
+import datetime
+import json
+
+import pandas as pd
+import pytest
+from typer.testing import CliRunner
+
+from estat_2019_0396.__main__ import app
+from estat_2019_0396.digest_generation import UnorderedEventsError, iter_digests
+from estat_2019_0396.digest_pandas import digest_multi_user
+from estat_2019_0396.dtypes import optimize_dtypes
+from estat_2019_0396.validation import event_flags, validate_events
+
+
+@pytest.fixture()
+def events_df(make_events):
+    df = make_events(50, n=2000, user_types="resident")
+    df = pd.concat([df, df.sample(100, random_state=0)], ignore_index=True)
+    df.loc[::97, "cell"] = None
+    df.loc[::101, "time"] = pd.NaT
+    df.loc[5::89, "user"] = None
+    return df
+
+
+def test_event_flags():
+    df = pd.DataFrame(
+        {
+            "user": ["u1", "u2", "u1", "u1", "u2", "u1", "u1", None, None],
+            "time": pd.to_datetime(
+                [
+                    "2022-01-01 10:00",
+                    "2022-01-01 12:00",
+                    "2022-01-01 11:00",
+                    "2022-01-01 11:00",
+                    "2022-01-01 11:00",
+                    None,
+                    "2022-01-01 10:30",
+                    "2022-01-01 10:00",
+                    "2022-01-01 10:00",
+                ]
+            ),
+            "cell": ["A", "A", "B", "B", "A", "A", None, "A", "A"],
+        },
+        index=[5, 5, 6, 7, 8, 9, 10, 11, 12],
+    )
+    flags = event_flags(df)
+    assert flags.index.equals(df.index)
+    assert flags.to_dict("list") == {
+        "null_user": [False] * 7 + [True, True],
+        "null_time": [False, False, False, False, False, True, False, False, False],
+        "null_cell": [False, False, False, False, False, False, True, False, False],
+        "duplicate": [False, False, False, True, False, False, False, False, False],
+        "unordered": [False, False, False, False, True, False, True, False, False],
+    }
+
+
+@pytest.mark.parametrize("optimize", [False, True])
+def test_event_flags_reference(events_df, optimize):
+    df = events_df.sample(frac=1, random_state=1)
+    flags = event_flags(optimize_dtypes(df) if optimize else df)
+    null = df["user"].isna() | df["time"].isna() | df["cell"].isna()
+    assert flags["duplicate"].equals(df.duplicated(["user", "time", "cell"]) & ~null)
+    diffs = df[df["time"].notna()].groupby("user")["time"].diff()
+    unordered = (diffs < pd.Timedelta(0)).reindex(df.index, fill_value=False)
+    assert flags["unordered"].equals(unordered)
+    assert flags["unordered"].any()
+
+
+def test_validate_events(events_df):
+    df, report = validate_events(events_df)
+    expected = events_df.dropna(subset=["user", "time", "cell"]).drop_duplicates(
+        ["user", "time", "cell"]
+    )
+    pd.testing.assert_frame_equal(df, expected)
+    assert report["events"] == len(events_df)
+    assert report["dropped"] == len(events_df) - len(df)
+    assert report["null_users"] == events_df["user"].isna().sum() > 0
+    assert report["null_times"] == events_df["time"].isna().sum()
+    assert report["null_cells"] == events_df["cell"].isna().sum()
+    assert report["duplicates"] > 0
+    assert report["unordered_users"] == 3
+
+    df, report = validate_events(events_df, drop=False)
+    assert df is events_df
+    assert report["dropped"] == 0
+
+
+def test_validate_events_ordered(events_df):
+    with pytest.raises(UnorderedEventsError, match="events of 3 users"):
+        validate_events(events_df, require_ordered=True)
+    df = events_df.sort_values(["user", "time"])
+    df, report = validate_events(df, require_ordered=True)
+    assert report["unordered_events"] == 0
+    digest_multi_user(df, sort=False)
+
+
+def test_unordered_events_error():
+    times = [datetime.datetime(2022, 1, 1, 10), datetime.datetime(2022, 1, 1, 9)]
+    with pytest.raises(UnorderedEventsError):
+        list(iter_digests(times, ["A", "B"]))
+    with pytest.raises(UnorderedEventsError):
+        list(iter_digests(pd.Series(times), ["A", "B"]))
+
+
+@pytest.mark.parametrize("chunksize", [None, 500])
+def test_cli_validate(events_df, tmp_path, chunksize):
+    events_df.to_csv(tmp_path / "events.csv", index=False)
+    args = ["digests", str(tmp_path / "events.csv"), "--input-format", "csv"]
+    args += ["--output-format", "csv", "--validate"]
+    if chunksize:
+        args += ["--chunksize", str(chunksize)]
+    result = CliRunner(mix_stderr=False).invoke(app, args)
+    assert result.exit_code == 0, result.output
+    reports = [json.loads(line) for line in result.stderr.splitlines()]
+    df = pd.read_csv(tmp_path / "events.csv", parse_dates=["time"])
+    assert sum(report["dropped"] for report in reports) == len(df) - len(
+        validate_events(df)[0]
+    )
+    expected = digest_multi_user(validate_events(df)[0], user_props=["user_type"])
+    assert result.stdout == expected.to_csv(index=False) + "\n"